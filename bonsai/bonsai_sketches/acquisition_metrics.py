@@ -0,0 +1,232 @@
+import os
+import time
+import argparse
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from file_mover import read_config, file_box, file_timestamp
+
+# Acquisition health from the growth of the files bonsai is writing (runs next to move_files.py)
+# Every `sample_sec` the newest file of each box and stream is stat-ed (never read), which gives
+# the data rate against aq_freq_hz x channels x bytes per sample, how long a stream has not grown
+# and chunk_file_list-style discontinuities between consecutive files.
+# The counters are served as Prometheus text on http://<host>:<metrics_port>/metrics,
+# status_monitor.py in the bot can read them (metrics_url of a rig).
+# Extra config.yaml keys:
+#   aq_freq_hz: 1000 # SampleRate of the Rhd2000 node
+#   eeg_channels: 3 # number of channels in the selectChannels node
+#   ttl_channels: 8
+#   metrics_port: 9108
+
+# bytes per sample of each stream, vid_timestamp grows with the camera and has no fixed rate
+STREAM_BYTES = {"eegdata": 4, "ttl_in_state": 1}
+METRICS = [
+    ("expected_bytes_per_second", "gauge", "aq_freq_hz x channels x bytes per sample"),
+    ("bytes_per_second", "gauge", "Growth of the stream over the last window"),
+    ("rate_ratio", "gauge", "bytes_per_second / expected_bytes_per_second (1 when no samples are dropped)"),
+    ("stalled_seconds", "gauge", "Seconds since the stream last grew"),
+    ("stalls_total", "counter", "Times the stream stopped growing for longer than stall_sec"),
+    ("files_total", "counter", "Files of the stream seen so far"),
+    ("discontinuities_total", "counter", "Consecutive files further apart than period +/- discontinuity_tolerance_sec"),
+    ("last_gap_seconds", "gauge", "Time between the start of the last two files minus the period"),
+    ("last_file_missing_samples", "gauge", "Samples expected from the start times of the last two files minus the samples in the first one"),
+    ("bytes_total", "counter", "Bytes written to the stream since the collector started"),
+]
+
+
+def stream_of(file_name):
+    for stream in STREAM_BYTES:
+        if stream in file_name:
+            return stream
+    return None
+
+
+class StreamStats:
+
+    def __init__(self, expected_rate, frame_bytes, window_sec, now):
+        self.expected_rate = expected_rate
+        self.frame_bytes = frame_bytes
+        self.window_sec = window_sec
+        self.path = None
+        self.started = None
+        self.size = 0
+        self.last_growth = now
+        self.stalled = False
+        self.history = deque()
+        self.values = {"stalls_total": 0, "files_total": 0, "discontinuities_total": 0, "bytes_total": 0}
+
+    def grow(self, nbytes, now):
+        if nbytes > 0:
+            self.values["bytes_total"] += nbytes
+            self.last_growth = now
+            self.stalled = False
+        self.history.append((now, self.values["bytes_total"]))
+        while now - self.history[0][0] > self.window_sec:
+            self.history.popleft()
+
+    def rate(self):
+        (t0, b0), (t1, b1) = self.history[0], self.history[-1]
+        return (b1 - b0) / (t1 - t0) if t1 > t0 else None
+
+
+class AcquisitionMetrics:
+    """
+    Sampled health of the files bonsai is writing in `directory`.
+
+    Parameters:
+    - config: The move_files config (read_config) with the extra keys above.
+    - directory: Folder bonsai writes to (directory_to_watch).
+    - window_sec: The data rate is measured over this window.
+    - stall_sec: A stream that does not grow for this long counts as a stall.
+    - clock: Time source, time.monotonic by default.
+    """
+
+    def __init__(self, config, directory, window_sec=60, stall_sec=30, clock=time.monotonic):
+        self.config = config
+        self.directory = directory
+        self.window_sec = window_sec
+        self.stall_sec = stall_sec
+        self.clock = clock
+        self.aq_freq_hz = config.get("aq_freq_hz", 1000)
+        self.channels = {"eegdata": config.get("eeg_channels"), "ttl_in_state": config.get("ttl_channels", 8)}
+        self.tolerance_sec = config.get("discontinuity_tolerance_sec", 60)
+        self.streams = {}
+        self.lock = threading.Lock()
+
+    def _stats(self, key, now):
+        if key not in self.streams:
+            stream = key[1]
+            channels = self.channels[stream]
+            frame_bytes = channels * STREAM_BYTES[stream] if channels else None
+            expected = self.aq_freq_hz * frame_bytes if frame_bytes else None
+            self.streams[key] = StreamStats(expected, frame_bytes, self.window_sec, now)
+        return self.streams[key]
+
+    def _newest_files(self):
+        newest = {}
+        for entry in os.scandir(self.directory):
+            stream = stream_of(entry.name)
+            started = file_timestamp(entry.name)
+            box = file_box(entry.name, self.config["boxes"], self.config.get("default_box"))
+            if not entry.is_file() or stream is None or started is None or box is None:
+                continue
+            key = (box, stream)
+            if key not in newest or started > newest[key][1]:
+                newest[key] = (entry.path, started)
+        return newest
+
+    def _rotate(self, stats, path, started, now):
+        # a new file started, close the books on the previous one
+        stats.values["files_total"] += 1
+        if stats.path is not None:
+            try:
+                final_size = os.path.getsize(stats.path)
+                stats.grow(final_size - stats.size, now)
+            except FileNotFoundError:
+                # already moved to the NAS (the mover takes it shortly after it closes), the size
+                # from the last sample is its final size unless it grew after that sample
+                final_size = stats.size
+            gap = (started - stats.started).total_seconds()
+            stats.values["last_gap_seconds"] = gap - self.config["period_sec"]
+            if abs(gap - self.config["period_sec"]) > self.tolerance_sec:
+                stats.values["discontinuities_total"] += 1
+            if final_size is not None and stats.frame_bytes:
+                stats.values["last_file_missing_samples"] = round(gap * self.aq_freq_hz) - final_size // stats.frame_bytes
+        first = stats.path is None
+        stats.path = path
+        stats.started = started
+        stats.size = 0
+        if first:
+            # what was written before the collector started is not growth
+            try:
+                stats.size = os.path.getsize(path)
+            except FileNotFoundError:
+                pass
+
+    def sample(self):
+        """
+        Stat the newest file of every box and stream and update the metrics.
+        """
+        now = self.clock()
+        with self.lock:
+            for key, (path, started) in self._newest_files().items():
+                stats = self._stats(key, now)
+                if path != stats.path:
+                    self._rotate(stats, path, started, now)
+                try:
+                    size = os.path.getsize(path)
+                except FileNotFoundError:
+                    continue
+                stats.grow(size - stats.size, now)
+                stats.size = size
+            for stats in self.streams.values():
+                stalled_for = now - stats.last_growth
+                stats.values["stalled_seconds"] = stalled_for
+                if stalled_for > self.stall_sec and not stats.stalled:
+                    stats.stalled = True
+                    stats.values["stalls_total"] += 1
+                rate = stats.rate()
+                if rate is not None and len(stats.history) > 1:
+                    stats.values["bytes_per_second"] = rate
+                    if stats.expected_rate:
+                        stats.values["rate_ratio"] = rate / stats.expected_rate
+                if stats.expected_rate:
+                    stats.values["expected_bytes_per_second"] = stats.expected_rate
+
+    def render(self):
+        """
+        Metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        with self.lock:
+            for name, kind, help_text in METRICS:
+                series = [(key, stats.values[name]) for key, stats in sorted(self.streams.items()) if name in stats.values]
+                if not series:
+                    continue
+                lines.append(f"# HELP bonsai_stream_{name} {help_text}")
+                lines.append(f"# TYPE bonsai_stream_{name} {kind}")
+                for (box, stream), value in series:
+                    lines.append(f'bonsai_stream_{name}{{box="{box}",stream="{stream}"}} {value:g}')
+        return "\n".join(lines) + "\n"
+
+
+def serve(metrics, port):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("", port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def main(config_file="config.yaml", sample_sec=10):
+    config = read_config(config_file)
+    metrics = AcquisitionMetrics(config, config["directory_to_watch"])
+    port = config.get("metrics_port", 9108)
+    server = serve(metrics, port)
+    print(f"Serving acquisition metrics on port {port}")
+    try:
+        while True:
+            metrics.sample()
+            time.sleep(sample_sec)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve data rate and gap metrics of the files bonsai is writing")
+    parser.add_argument("--config", default="config.yaml", help="The config.yaml of move_files.py")
+    parser.add_argument("--sample_sec", type=float, default=10, help="Seconds between samples")
+    args = parser.parse_args()
+    main(args.config, args.sample_sec)
@@ -0,0 +1,435 @@
+import os
+import re
+import time
+import shutil
+import hashlib
+import json
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import yaml
+
+# Shared mover for the continuous_*_ephys_TTL sketches (any number of boxes)
+# Files are copied to the database_path (usually the NAS) by a bounded pool of threads,
+# the copy is checksummed against the source and the source is only removed after that.
+# os.rename() does not work across file systems (local disk -> NAS) so we never rely on it
+# for the transfer itself, only to put the verified copy in place.
+
+DEFAULT_MAX_TRANSFERS = 4
+# 8 Mb reads keep the NAS link busy without holding much memory per transfer
+DEFAULT_BLOCK_SIZE = 8 * 1024 * 1024
+PART_SUFFIX = ".part"
+
+
+class ChecksumError(Exception):
+    pass
+
+
+def period_to_seconds(period):
+    # "HH:MM:SS" from the bonsai Timer node
+    hours, minutes, seconds = (int(x) for x in str(period).split(":"))
+    return hours * 3600 + minutes * 60 + seconds
+
+# Function to get new directory name if the id already exists (e.g., you forgot to update the config.yaml)
+# It's basically a glorified way to check that you are writing in the proper place
+def get_new_dir_name(box_id):
+    new_id = input(f"The directory for `{box_id}` already exists.\n>> Please enter a new id or press enter to use the old one: ")
+    return new_id if new_id else box_id
+
+def read_config(config_file="config.yaml"):
+    """
+    Read the mover configuration.
+
+    Every `boxN` key with a value is a box, so the same file works for 1, 2, 4 or more boxes.
+    Empty boxes (no animal) are left out. Optional keys:
+    - max_transfers: Number of concurrent copies (default 4).
+    - checksum: Any hashlib algorithm (default blake2b).
+    - default_box: Box of the files without a box mark (default the first box).
+
+    Returns:
+    - The config dict with `boxes` ({'box1': id1, ...}, sorted by box number) and `period_sec` added.
+    """
+    with open(config_file, "r") as f:
+        config = yaml.safe_load(f)
+    box_keys = sorted((key for key in config if re.fullmatch(r"box\d+", key)), key=lambda key: int(key[3:]))
+    config["boxes"] = {key: str(config[key]) for key in box_keys if config[key]}
+    config["period_sec"] = period_to_seconds(config["period"])
+    config.setdefault("max_transfers", DEFAULT_MAX_TRANSFERS)
+    config.setdefault("checksum", "blake2b")
+    config.setdefault("default_box", None)
+    if config["default_box"] is not None and config["default_box"] not in config["boxes"]:
+        raise ValueError(f"default_box `{config['default_box']}` is not one of the boxes {list(config['boxes'])}")
+    return config
+
+def box_directories(boxes, database_path, ask=True):
+    """
+    {'box1': <database_path>/<id1>, ...}. When `ask` is True and a directory already exists
+    the user can give a new id (the animal id in `boxes` is updated in place).
+    """
+    directories = {}
+    for box, box_id in boxes.items():
+        directory = os.path.join(database_path, box_id)
+        if ask and os.path.exists(directory):
+            boxes[box] = get_new_dir_name(box_id)
+            directory = os.path.join(database_path, boxes[box])
+        directories[box] = directory
+    return directories
+
+def file_box(file_name, boxes, default_box=None):
+    """
+    Box key of a bonsai file. Files without a box mark (vid_timestamp, ttl_in_state)
+    go to `default_box`, or the first box when it is None.
+    """
+    # longest keys first, box1 would otherwise match box10
+    for box in sorted(boxes, key=len, reverse=True):
+        if re.search(rf"{box}(?!\d)", file_name):
+            return box
+    if ("vid_timestamp" in file_name or "ttl_in_state" in file_name) and boxes:
+        return default_box if default_box is not None else next(iter(boxes))
+    return None
+
+def file_timestamp(file_name):
+    match = re.search(r"\d{4}-\d{2}-\d{2}T\d{2}_\d{2}_\d{2}", file_name)
+    if not match:
+        return None
+    return datetime.strptime(match.group(), "%Y-%m-%dT%H_%M_%S")
+
+def destination_path(file_path, box_id, box_directory, timestamp):
+    """
+    New path of a bonsai file following the naming convention
+    <box_directory>/<YYYY-mm-dd>/[eeg|video|ttl]/sub-<box_id>_ses-<YYYYmmddTHHMMSS>_<suffix>,
+    None if the file is not one of ours.
+    """
+    file_name = os.path.basename(file_path)
+    base_name, extension = os.path.splitext(file_name)
+    destination_folder = os.path.join(box_directory, timestamp.strftime("%Y-%m-%d"))
+    ses = timestamp.strftime("%Y%m%dT%H%M%S")
+    match file_name:
+        case f if f.startswith("box") and "eegdata" in base_name:
+            new_file_name = f"sub-{box_id}_ses-{ses}_eeg{extension}"
+            destination_folder = os.path.join(destination_folder, "eeg")
+        case f if f.startswith("box") and "vid" in base_name:
+            new_file_name = f"sub-{box_id}_ses-{ses}_video{extension}"
+            destination_folder = os.path.join(destination_folder, "video")
+        case f if f.startswith("box"):
+            new_file_name = f"sub-{box_id}_ses-{ses}_{base_name}{extension}"
+        case f if f.startswith("vid_timestamp"):
+            new_file_name = f"sub-{box_id}_ses-{ses}_timestamp{extension}"
+            destination_folder = os.path.join(destination_folder, "video")
+        case f if f.startswith("ttl_in_state"):
+            new_file_name = f"sub-{box_id}_ses-{ses}_ttl_in{extension}"
+            destination_folder = os.path.join(destination_folder, "ttl")
+        case _:
+            return None
+    return os.path.join(destination_folder, new_file_name)
+
+def file_checksum(path, algorithm="blake2b", block_size=DEFAULT_BLOCK_SIZE):
+    digest = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        while block := f.read(block_size):
+            digest.update(block)
+    return digest.hexdigest()
+
+def transfer_file(src, dst, algorithm="blake2b", block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Copy `src` to `dst` and remove `src` once the copy is verified.
+
+    The source is hashed while it is copied into `dst.part`, the part file is then read back
+    and hashed again (this is what actually landed on the NAS). Only when both match the
+    part file is renamed to `dst` (same file system, atomic) and the source deleted.
+    On a mismatch the part file is removed, the source is kept and ChecksumError is raised.
+
+    Returns:
+    - The checksum of the file.
+    """
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    part = dst + PART_SUFFIX
+    digest = hashlib.new(algorithm)
+    try:
+        with open(src, "rb") as fsrc, open(part, "wb") as fdst:
+            while block := fsrc.read(block_size):
+                digest.update(block)
+                fdst.write(block)
+            fdst.flush()
+            os.fsync(fdst.fileno())
+        shutil.copystat(src, part)
+        checksum = digest.hexdigest()
+        if file_checksum(part, algorithm, block_size) != checksum:
+            raise ChecksumError(f"Checksum mismatch copying {src} to {dst}")
+        os.replace(part, dst)
+    except BaseException:
+        if os.path.exists(part):
+            os.remove(part)
+        raise
+    os.remove(src)
+    return checksum
+
+
+class FileMover:
+    """
+    Bounded pool of transfers. A path is never submitted twice while its transfer is running.
+
+    Parameters:
+    - boxes: {'box1': id1, ...} as returned by read_config().
+    - directories: {'box1': <database_path>/<id1>, ...} as returned by box_directories().
+    - max_transfers: Number of files copied at the same time.
+    - algorithm: hashlib algorithm used to verify the copies.
+    - default_box: Box of the files without a box mark (see file_box()).
+    - log: Function used to report (e.g. spinner.write), defaults to print.
+    - on_finalized: Functions called as f(dst, checksum) from the transfer thread once a
+      file is verified in its final place (see FinalizedJournal).
+    """
+
+    def __init__(self, boxes, directories, max_transfers=DEFAULT_MAX_TRANSFERS, algorithm="blake2b", default_box=None, log=print, on_finalized=()):
+        self.boxes = boxes
+        self.default_box = default_box
+        self.directories = directories
+        self.algorithm = algorithm
+        self.log = log
+        self.on_finalized = list(on_finalized)
+        self.executor = ThreadPoolExecutor(max_workers=max_transfers, thread_name_prefix="transfer")
+        self.in_flight = {}
+        self.lock = threading.Lock()
+
+    def destination(self, file_path):
+        file_name = os.path.basename(file_path)
+        box = file_box(file_name, self.boxes, self.default_box)
+        if box is None:
+            self.log(f"> Failed to determine box from {file_name}. Skipping the file.")
+            return None
+        timestamp = file_timestamp(file_name)
+        if timestamp is None:
+            self.log(f"> Failed to extract timestamp from {file_name}. Skipping the file.")
+            return None
+        dst = destination_path(file_path, self.boxes[box], self.directories[box], timestamp)
+        if dst is None:
+            self.log(f"Skipping {file_name} as it doesn't match any file type.")
+        return dst
+
+    def submit(self, file_path):
+        """
+        Queue the transfer of a finished file. Empty files are removed.
+
+        Returns:
+        - The Future of the transfer, None if nothing was queued.
+        """
+        with self.lock:
+            if file_path in self.in_flight:
+                return None
+        if PART_SUFFIX in os.path.basename(file_path):
+            return None
+        if os.path.getsize(file_path) == 0:
+            self.log(f"Removing empty file: {os.path.basename(file_path)}")
+            os.remove(file_path)
+            return None
+        dst = self.destination(file_path)
+        if dst is None:
+            return None
+        with self.lock:
+            if file_path in self.in_flight:
+                return None
+            future = self.executor.submit(self._transfer, file_path, dst)
+            self.in_flight[file_path] = future
+        return future
+
+    def _transfer(self, src, dst):
+        start = time.time()
+        try:
+            checksum = transfer_file(src, dst, self.algorithm)
+        except Exception as e:
+            self.log(f"✘ Failed to move {os.path.basename(src)}: {e}")
+            raise
+        finally:
+            with self.lock:
+                self.in_flight.pop(src, None)
+        self.log(f"✔ Moved {os.path.basename(src)} to {dst} in {time.time() - start:.1f} sec")
+        for callback in self.on_finalized:
+            try:
+                callback(dst, checksum)
+            except Exception as e:
+                self.log(f"✘ on_finalized failed for {os.path.basename(dst)}: {e}")
+        return dst
+
+    def wait(self):
+        # block until the transfers queued so far are done
+        with self.lock:
+            futures = list(self.in_flight.values())
+        for future in futures:
+            future.exception()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+class FinalizedJournal:
+    """
+    Append-only log of the files that reached the database_path, one json line per file.
+    Other machines mounting the same storage follow it to react to new files
+    (see ephys/continuous/server/ingest.py). Paths are relative to the database_path with `/`
+    separators because the NAS is mounted at different places on each machine.
+    """
+
+    def __init__(self, journal_file, database_path):
+        self.journal_file = journal_file
+        self.database_path = database_path
+        self.lock = threading.Lock()
+
+    def __call__(self, dst, checksum):
+        entry = {
+            "path": os.path.relpath(dst, self.database_path).replace(os.sep, "/"),
+            "checksum": checksum,
+            "size": os.path.getsize(dst),
+            "finalized": datetime.now().isoformat(timespec="seconds"),
+        }
+        # a single write of a whole line, readers never see half an entry from us
+        with self.lock, open(self.journal_file, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+
+
+def is_held_open(path):
+    """
+    True if another process still has the file open for writing.
+    Windows (where bonsai runs) refuses to rename a file that is open, renaming it onto itself
+    is a cheap probe that does not change anything. Other systems have no such lock, there we
+    only rely on the size/mtime stability.
+    """
+    if os.name != "nt":
+        return False
+    try:
+        os.rename(path, path)
+    except PermissionError:
+        return True
+    except OSError:
+        return False
+    return False
+
+
+class DebounceQueue:
+    """
+    Coalesce file system events per path and release each path once it is finished.
+
+    Watchdog fires many modified events while bonsai writes a file, `touch()` only records
+    the time of the last one. A path is ready when there were no events for `quiet_sec`,
+    its size and mtime did not change since the previous check and nobody holds it open.
+    Each path is released once, it only comes back if it is touched again.
+
+    Parameters:
+    - quiet_sec: Seconds without events before checking a path.
+    - clock: Function returning the current time in seconds (for tests).
+    """
+
+    def __init__(self, quiet_sec=5, clock=time.monotonic):
+        self.quiet_sec = quiet_sec
+        self.clock = clock
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def touch(self, path):
+        with self.lock:
+            stat = self.pending.get(path, (None, None))[1]
+            self.pending[path] = (self.clock(), stat)
+
+    def ready(self):
+        """
+        Paths that are finished, removed from the queue. Paths that vanished are dropped.
+        """
+        now = self.clock()
+        with self.lock:
+            candidates = [path for path, (last_event, _) in self.pending.items() if now - last_event >= self.quiet_sec]
+        finished = []
+        for path in candidates:
+            try:
+                stat = os.stat(path)
+                stat = (stat.st_size, stat.st_mtime_ns)
+            except FileNotFoundError:
+                stat = None
+            with self.lock:
+                if path not in self.pending:
+                    continue
+                last_event, previous = self.pending[path]
+                if last_event > now - self.quiet_sec:
+                    # touched while we were looking
+                    continue
+                if stat is None:
+                    del self.pending[path]
+                elif stat != previous or is_held_open(path):
+                    # still being written (or first look), check again after another quiet period
+                    self.pending[path] = (now, stat)
+                else:
+                    del self.pending[path]
+                    finished.append(path)
+        return finished
+
+    def __len__(self):
+        return len(self.pending)
+
+
+def watch(directory, queue):
+    """
+    Start a watchdog observer that feeds `queue`. Files already in `directory` are queued too.
+    """
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+
+    class Handler(FileSystemEventHandler):
+        def on_created(self, event):
+            if not event.is_directory:
+                queue.touch(event.src_path)
+
+        def on_modified(self, event):
+            if not event.is_directory:
+                queue.touch(event.src_path)
+
+        def on_moved(self, event):
+            if not event.is_directory:
+                queue.touch(event.dest_path)
+
+    for entry in os.scandir(directory):
+        if entry.is_file():
+            queue.touch(entry.path)
+    observer = Observer()
+    observer.schedule(Handler(), directory, recursive=False)
+    observer.start()
+    return observer
+
+def main(config_file="config.yaml"):
+    from yaspin import yaspin
+    from yaspin.spinners import Spinners
+
+    config = read_config(config_file)
+    boxes = config["boxes"]
+    directories = box_directories(boxes, config["database_path"])
+    spinner = yaspin(Spinners.moon)
+    journal = FinalizedJournal(config.get("finalized_journal") or os.path.join(config["database_path"], "finalized.jsonl"), config["database_path"])
+    mover = FileMover(boxes, directories, config["max_transfers"], config["checksum"], config["default_box"], log=spinner.write, on_finalized=[journal])
+    queue = DebounceQueue(config.get("quiet_sec", 5))
+    observer = watch(config["directory_to_watch"], queue)
+    # network shares do not always deliver events, a slow rescan makes sure nothing is left behind
+    rescan_sec = config.get("rescan_sec", 60)
+    last_scan = time.monotonic()
+    spinner.start()
+    try:
+        while observer.is_alive():
+            for path in queue.ready():
+                mover.submit(path)
+            if time.monotonic() - last_scan > rescan_sec:
+                for entry in os.scandir(config["directory_to_watch"]):
+                    if entry.is_file() and entry.path not in queue.pending and entry.path not in mover.in_flight:
+                        queue.touch(entry.path)
+                last_scan = time.monotonic()
+            spinner.text = f"Watching {len(queue)} files, {len(mover.in_flight)} transfers running"
+            time.sleep(1)
+    except KeyboardInterrupt:
+        spinner.fail("Received keyboard interrupt, stopping.")
+    finally:
+        observer.stop()
+        observer.join()
+        mover.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Move bonsai files to the database_path with verified copies")
+    parser.add_argument("--config", default="config.yaml", help="config.yaml with boxN ids, period, database_path and directory_to_watch")
+    args = parser.parse_args()
+    main(args.config)
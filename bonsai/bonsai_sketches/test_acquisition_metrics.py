@@ -0,0 +1,108 @@
+import os
+import tempfile
+import unittest
+import urllib.request
+from acquisition_metrics import AcquisitionMetrics, serve
+
+CONFIG = {"boxes": {"box1": "MLA1", "box2": "MLA2"}, "period_sec": 60, "aq_freq_hz": 1000,
+          "eeg_channels": 3, "ttl_channels": 8, "discontinuity_tolerance_sec": 5}
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class TestAcquisitionMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.clock = FakeClock()
+        self.metrics = AcquisitionMetrics(CONFIG, self.tmp.name, window_sec=30, stall_sec=20, clock=self.clock)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.tmp.name, name)
+
+    def write(self, name, nbytes):
+        with open(self.path(name), "ab") as f:
+            f.write(b"\0" * nbytes)
+
+    def run_for(self, seconds, writes, step=10):
+        # writes: {file name: bytes per second}
+        for _ in range(int(seconds / step)):
+            self.clock.now += step
+            for name, rate in writes.items():
+                self.write(name, int(rate * step))
+            self.metrics.sample()
+
+    def value(self, name, box, stream):
+        return self.metrics.streams[(box, stream)].values[name]
+
+    def test_rate_and_dropped_samples(self):
+        eeg1 = "box1_eegdata2024-03-01T10_00_00.bin"
+        eeg2 = "box2_eegdata2024-03-01T10_00_00.bin"
+        ttl = "ttl_in_state2024-03-01T10_00_00.bin"
+        # files already there when the collector starts are not counted as growth
+        self.write(eeg1, 12_000 * 50)
+        self.metrics.sample()
+        self.run_for(40, {eeg1: 12_000, eeg2: 12_000 * 0.9, ttl: 8_000})
+        self.assertAlmostEqual(self.value("rate_ratio", "box1", "eegdata"), 1)
+        self.assertAlmostEqual(self.value("rate_ratio", "box2", "eegdata"), 0.9)
+        self.assertAlmostEqual(self.value("rate_ratio", "box1", "ttl_in_state"), 1)
+        self.assertEqual(self.value("expected_bytes_per_second", "box1", "eegdata"), 12_000)
+        self.assertEqual(self.value("expected_bytes_per_second", "box1", "ttl_in_state"), 8_000)
+
+    def test_stall_and_discontinuity(self):
+        ttl = "ttl_in_state2024-03-01T10_00_00.bin"
+        eeg = "box1_eegdata2024-03-01T10_00_00.bin"
+        self.run_for(30, {ttl: 8_000, eeg: 12_000})
+        # ttl stops, eeg goes on but 900 samples short by the end of its 60 s
+        self.run_for(30, {eeg: 12_000 - 900 * 12 / 30})
+        self.assertEqual(self.value("stalls_total", "box1", "ttl_in_state"), 1)
+        self.assertEqual(self.value("stalled_seconds", "box1", "ttl_in_state"), 30)
+        self.assertEqual(self.value("stalls_total", "box1", "eegdata"), 0)
+        self.run_for(30, {})
+        self.assertEqual(self.value("stalls_total", "box1", "ttl_in_state"), 1)
+        # next file on time
+        self.run_for(30, {"box1_eegdata2024-03-01T10_01_00.bin": 12_000})
+        self.assertEqual(self.value("stalls_total", "box1", "eegdata"), 1)
+        self.assertEqual(self.value("discontinuities_total", "box1", "eegdata"), 0)
+        self.assertEqual(self.value("last_file_missing_samples", "box1", "eegdata"), 900)
+        # the previous file is moved away and the next one starts 10 minutes late
+        os.remove(self.path("box1_eegdata2024-03-01T10_01_00.bin"))
+        self.run_for(30, {"box1_eegdata2024-03-01T10_12_00.bin": 12_000})
+        self.assertEqual(self.value("discontinuities_total", "box1", "eegdata"), 1)
+        self.assertEqual(self.value("last_gap_seconds", "box1", "eegdata"), 600)
+        self.assertEqual(self.value("files_total", "box1", "eegdata"), 3)
+        self.assertAlmostEqual(self.value("rate_ratio", "box1", "eegdata"), 1)
+
+    def test_file_moved_before_rotation(self):
+        # the mover takes a closed file away before the collector sees the next one
+        eeg = "box1_eegdata2024-03-01T10_00_00.bin"
+        self.run_for(60, {eeg: 12_000 - 900 * 12 / 60})
+        # closed, nothing more written until the next sample
+        self.run_for(10, {})
+        os.remove(self.path(eeg))
+        self.run_for(30, {"box1_eegdata2024-03-01T10_01_00.bin": 12_000})
+        self.assertEqual(self.value("last_file_missing_samples", "box1", "eegdata"), 900)
+        self.assertEqual(self.value("discontinuities_total", "box1", "eegdata"), 0)
+        self.assertEqual(self.value("files_total", "box1", "eegdata"), 2)
+
+    def test_endpoint(self):
+        self.run_for(20, {"box1_eegdata2024-03-01T10_00_00.bin": 12_000})
+        server = serve(self.metrics, 0)
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{server.server_port}/metrics") as response:
+                text = response.read().decode()
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertIn("# TYPE bonsai_stream_stalls_total counter", text)
+        self.assertIn('bonsai_stream_rate_ratio{box="box1",stream="eegdata"} 1\n', text)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import os
+import json
+import tempfile
+import unittest
+from unittest import mock
+from datetime import datetime
+import numpy as np
+from file_mover import read_config, file_box, destination_path, transfer_file, file_checksum, FileMover, FinalizedJournal, ChecksumError, DebounceQueue
+
+class TestFileMover(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.watch = os.path.join(self.tmp.name, "watch")
+        self.nas = os.path.join(self.tmp.name, "nas")
+        os.makedirs(self.watch)
+        self.boxes = {f"box{i}": f"MLA{i}" for i in range(1, 11)}
+        self.directories = {box: os.path.join(self.nas, box_id) for box, box_id in self.boxes.items()}
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name, n=10_000):
+        path = os.path.join(self.watch, name)
+        np.random.default_rng(len(name)).normal(size=n).astype(np.float32).tofile(path)
+        return path
+
+    def test_read_config_any_number_of_boxes(self):
+        config_file = os.path.join(self.tmp.name, "config.yaml")
+        with open(config_file, "w") as f:
+            f.write("box1: MLA153\nbox2:\nbox12: MLA160\nbox3: MLA154\nperiod: 01:00:00\n"
+                    "database_path: /nas\ndirectory_to_watch: /watch\n")
+        config = read_config(config_file)
+        self.assertEqual(config["boxes"], {"box1": "MLA153", "box3": "MLA154", "box12": "MLA160"})
+        self.assertEqual(config["period_sec"], 3600)
+        self.assertEqual(config["max_transfers"], 4)
+        self.assertIsNone(config["default_box"])
+
+    def test_destination(self):
+        self.assertEqual(file_box("box10_eegdata2024-03-01T10_00_00.bin", self.boxes), "box10")
+        self.assertEqual(file_box("box1_eegdata2024-03-01T10_00_00.bin", self.boxes), "box1")
+        self.assertEqual(file_box("ttl_in_state2024-03-01T10_00_00.bin", self.boxes), "box1")
+        self.assertIsNone(file_box("other.bin", self.boxes))
+        self.assertEqual(file_box("ttl_in_state2024-03-01T10_00_00.bin", self.boxes, "box2"), "box2")
+        self.assertEqual(file_box("box1_eegdata2024-03-01T10_00_00.bin", self.boxes, "box2"), "box1")
+        timestamp = datetime(2024, 3, 1, 10)
+        self.assertEqual(destination_path("box2_eegdata2024-03-01T10_00_00.bin", "MLA2", "/nas/MLA2", timestamp),
+                         os.path.join("/nas/MLA2", "2024-03-01", "eeg", "sub-MLA2_ses-20240301T100000_eeg.bin"))
+        self.assertEqual(destination_path("ttl_in_state2024-03-01T10_00_00.bin", "MLA1", "/nas/MLA1", timestamp),
+                         os.path.join("/nas/MLA1", "2024-03-01", "ttl", "sub-MLA1_ses-20240301T100000_ttl_in.bin"))
+
+    def test_transfer_verifies_before_removing(self):
+        src = self.write("box1_eegdata2024-03-01T10_00_00.bin")
+        checksum = file_checksum(src)
+        dst = os.path.join(self.nas, "out.bin")
+        self.assertEqual(transfer_file(src, dst, block_size=1000), checksum)
+        self.assertFalse(os.path.exists(src))
+        self.assertEqual(file_checksum(dst), checksum)
+        # a bad copy keeps the source and leaves nothing behind
+        src = self.write("box1_eegdata2024-03-01T11_00_00.bin")
+        dst = os.path.join(self.nas, "bad.bin")
+        with mock.patch("file_mover.file_checksum", return_value="0"):
+            with self.assertRaises(ChecksumError):
+                transfer_file(src, dst)
+        self.assertTrue(os.path.exists(src))
+        self.assertEqual(os.listdir(self.nas), ["out.bin"])
+
+    def test_mover_concurrent(self):
+        names = [f"box{box}_eegdata2024-03-01T{hour:02d}_00_00.bin" for box in (1, 2, 10) for hour in range(5)]
+        checksums = {name: file_checksum(self.write(name)) for name in names}
+        open(os.path.join(self.watch, "box1_vid2024-03-01T10_00_00.avi"), "w").close()
+        os.makedirs(self.nas)
+        journal_file = os.path.join(self.nas, "finalized.jsonl")
+        mover = FileMover(self.boxes, self.directories, max_transfers=3, log=lambda msg: None, on_finalized=[FinalizedJournal(journal_file, self.nas)])
+        futures = [mover.submit(os.path.join(self.watch, name)) for name in sorted(os.listdir(self.watch))]
+        # empty files are removed, not moved
+        self.assertEqual(sum(future is None for future in futures), 1)
+        mover.wait()
+        mover.shutdown()
+        self.assertEqual(os.listdir(self.watch), [])
+        for name, checksum in checksums.items():
+            box = name.split("_")[0]
+            hour = name[-12:-10]
+            dst = os.path.join(self.nas, self.boxes[box], "2024-03-01", "eeg", f"sub-{self.boxes[box]}_ses-20240301T{hour}0000_eeg.bin")
+            self.assertEqual(file_checksum(dst), checksum)
+        # every file is announced once, relative to the database_path
+        with open(journal_file) as f:
+            entries = [json.loads(line) for line in f]
+        self.assertEqual(len(entries), len(names))
+        self.assertEqual(sorted(entry["checksum"] for entry in entries), sorted(checksums.values()))
+        self.assertTrue(all(os.path.isfile(os.path.join(self.nas, entry["path"])) for entry in entries))
+
+    def test_debounce_queue(self):
+        now = [0.0]
+        queue = DebounceQueue(quiet_sec=5, clock=lambda: now[0])
+        path = self.write("box1_eegdata2024-03-01T10_00_00.bin")
+        # a burst of modified events is a single entry
+        for _ in range(100):
+            queue.touch(path)
+        self.assertEqual(len(queue), 1)
+        self.assertEqual(queue.ready(), [])
+        # first look records size/mtime, the file keeps growing
+        now[0] = 5
+        self.assertEqual(queue.ready(), [])
+        with open(path, "ab") as f:
+            f.write(b"\0" * 4)
+        queue.touch(path)
+        now[0] = 10
+        self.assertEqual(queue.ready(), [])
+        # stable for a whole quiet period: released exactly once
+        now[0] = 15
+        self.assertEqual(queue.ready(), [path])
+        now[0] = 100
+        self.assertEqual(queue.ready(), [])
+        self.assertEqual(len(queue), 0)
+        # files that vanish are dropped
+        queue.touch(os.path.join(self.watch, "gone.bin"))
+        now[0] = 105
+        self.assertEqual(queue.ready(), [])
+        self.assertEqual(len(queue), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,17 +1,17 @@
 from telegram import Update, ForceReply
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackContext
-import pandas as pd
-from datetime import datetime, timedelta
 import yaml
 import logging
+from status_monitor import read_rigs, AlertSender, StatusMonitor
 
 # Load configuration from YAML file
 with open("config.yaml", "r") as f:
     config = yaml.safe_load(f)
 
 bot_token = config['bot_token']
-csv_file_path = config['csv_file_path']
-threshold_minutes = config['threshold_minutes']
+# one entry per rig under `rigs:` (see status_monitor.py), each check only reads the new rows of their csv
+rigs = read_rigs(config)
+monitor = None
 
 # Set up logging
 logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
@@ -51,59 +51,31 @@ async def unsubscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text('You are no longer subscribed to alerts.')
 
 
-alert_enabled = True
-
 async def stop_bonsai(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global alert_enabled
-    alert_enabled = False
-    await update.message.reply_text("Alerts are now disabled. Use `/restart_bonsai` to restart alerts")
+    """/stop_bonsai [rig ...] silences the given rigs, all of them without arguments."""
+    silenced = monitor.silence(context.args)
+    await update.message.reply_text(f"Alerts are now disabled for {', '.join(silenced) or 'no rig'}. Use `/restart_bonsai` to restart alerts")
 
 async def restart_bonsai(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global alert_enabled
-    alert_enabled = True
-    await update.message.reply_text("Alerts are now re-enabled.")
+    """/restart_bonsai [rig ...] re-enables the alerts of the given rigs, all of them without arguments."""
+    enabled = monitor.silence(context.args, silenced=False)
+    await update.message.reply_text(f"Alerts are now re-enabled for {', '.join(enabled) or 'no rig'}.")
 
-async def check_bonsai_status(context: CallbackContext):
-    if not alert_enabled:
-        return
-    else:
-        alert_data = await fetch_bonsai_status()
-    if alert_data:
-        await send_alerts(context, alert_data)
+async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(monitor.status_text())
 
-async def fetch_bonsai_status():
-    """Fetch the latest status from the Bonsai CSV and determine if an alert is needed."""
-    try:
-        logger.info(f"Checking Bonsai Status at {csv_file_path}")
-        data = pd.read_csv(csv_file_path)
-        data['local_dt'] = pd.to_datetime(data['local_dt'], utc=True)
-        latest_timestamp = data['local_dt'].iloc[-1].to_pydatetime()
-        current_time_utc = datetime.utcnow().replace(tzinfo=latest_timestamp.tzinfo)
-
-        if current_time_utc - latest_timestamp > timedelta(minutes=threshold_minutes):
-            return {
-                'working_dir': data['working_dir'].iloc[-1],
-                'workflow_name': data['workflow_name'].iloc[-1],
-                'last_update': latest_timestamp.astimezone()
-            }
-    except Exception as e:
-        logger.error(f"Error checking Bonsai status: {e}")
-    return None
-
-async def send_alerts(context: CallbackContext, alert_data):
-    """Send alert messages to all subscribed users."""
-    message = (f"⚠️ *Bonsai System Alert* ⚠️\n\n"
-               f"The Bonsai system at `{alert_data['working_dir']}` "
-               f"running workflow `{alert_data['workflow_name']}` "
-               f"has not updated since `{alert_data['last_update'].strftime('%Y-%m-%d %H:%M:%S %Z')}`. "
-               f"Please check the system!")
-    for chat_id in subscribers:
-        await context.bot.send_message(chat_id=chat_id, text=message, parse_mode='Markdown')
+async def check_bonsai_status(context: CallbackContext):
+    """Check all the rigs concurrently and send the new alerts to the subscribers."""
+    logger.info(f"Checking Bonsai Status of {len(rigs)} rigs")
+    await monitor.check_all()
 
 
 def main():
     """Start the bot and set up job queue for monitoring."""
+    global monitor
     application = Application.builder().token(bot_token).build()
+    sender = AlertSender(application.bot, rate=config.get('messages_per_second', 25), max_concurrent=config.get('max_concurrent_sends', 8))
+    monitor = StatusMonitor(rigs, sender, subscribers, repeat_minutes=config.get('repeat_minutes'))
 
     # Register command handlers
     application.add_handler(CommandHandler("start", start))
@@ -113,6 +85,7 @@ def main():
 
     application.add_handler(CommandHandler("stop_bonsai", stop_bonsai))
     application.add_handler(CommandHandler("restart_bonsai", restart_bonsai))
+    application.add_handler(CommandHandler("status", status))
 
     # Set up and start the job queue
     job_queue = application.job_queue
@@ -0,0 +1,254 @@
+import re
+import time
+import asyncio
+import logging
+import urllib.request
+from datetime import datetime, timedelta, timezone
+import pandas as pd
+from status_tail import StatusTail
+
+# Monitoring of many rigs for the status bot, kept apart from telegram so it can be tested with a fake bot
+# config.yaml:
+#   threshold_minutes: 5            # default for all rigs
+#   repeat_minutes: 30              # optional, remind every 30 min while a rig is down
+#   rigs:
+#     - name: beelink1
+#       csv_file_path: //rig1/bonsai_status.csv
+#     - name: beelink2
+#       csv_file_path: //rig2/bonsai_status.csv
+#       threshold_minutes: 10
+#       metrics_url: http://rig2:9108/metrics   # optional, acquisition_metrics.py on the rig
+#       min_rate_ratio: 0.99                    # optional, alert below this fraction of the expected data rate
+#       max_stall_sec: 60                       # optional, alert when a stream has not grown for this long
+# A config with a single top level csv_file_path (the old format) is one rig called "bonsai".
+
+logger = logging.getLogger(__name__)
+
+
+class Rig:
+    """
+    One bonsai status csv. check() is blocking (the csv usually lives on a network share),
+    the monitor runs it in a thread.
+    """
+
+    def __init__(self, name, csv_file_path, threshold_minutes, metrics_url=None, min_rate_ratio=0.99, max_stall_sec=60):
+        self.name = name
+        self.csv_file_path = csv_file_path
+        self.threshold = timedelta(minutes=threshold_minutes)
+        self.tail = StatusTail(csv_file_path)
+        self.silenced = False
+        self.metrics_url = metrics_url
+        self.min_rate_ratio = min_rate_ratio
+        self.max_stall_sec = max_stall_sec
+        self.discontinuities = {}
+
+    def health_problems(self, metrics):
+        """
+        Problems in the acquisition metrics of the rig, as {key: description}.
+        Keys are stable while a problem lasts so the alert is only sent once.
+        """
+        problems = {}
+        for name, labels, value in metrics:
+            stream = f"{labels.get('box')} {labels.get('stream')}"
+            if name == "bonsai_stream_rate_ratio" and value < self.min_rate_ratio:
+                problems[f"{stream} rate"] = f"{stream} is at {value:.1%} of the expected data rate (dropped samples)"
+            elif name == "bonsai_stream_stalled_seconds" and value > self.max_stall_sec:
+                problems[f"{stream} stalled"] = f"{stream} has not grown for {value:.0f} s"
+            elif name == "bonsai_stream_discontinuities_total":
+                # the first reading is the baseline, only new discontinuities are reported
+                previous = self.discontinuities.setdefault(stream, value)
+                if value > previous:
+                    problems[f"{stream} gap {value:g}"] = f"{stream} has a new gap between files"
+                self.discontinuities[stream] = value
+        return problems
+
+    def check_health(self):
+        with urllib.request.urlopen(self.metrics_url, timeout=10) as response:
+            metrics = parse_metrics(response.read().decode())
+        problems = self.health_problems(metrics)
+        if not problems:
+            return None
+        return {'rig': self.name, 'problems': problems}
+
+    def check(self, now=None):
+        """
+        Returns:
+        - An alert dict if the last status row is older than the threshold or the acquisition
+          metrics (when the rig has a metrics_url) show a problem, None otherwise.
+        """
+        latest = self.tail.latest()
+        if latest is None:
+            logger.warning(f"No complete status row in {self.csv_file_path} yet")
+            return None
+        last_update = pd.to_datetime(latest['local_dt'], utc=True).to_pydatetime()
+        now = now or datetime.now(timezone.utc)
+        if now - last_update <= self.threshold:
+            return self.check_health() if self.metrics_url else None
+        return {
+            'rig': self.name,
+            'working_dir': latest['working_dir'],
+            'workflow_name': latest['workflow_name'],
+            'last_update': last_update.astimezone(),
+            'down_for': now - last_update,
+        }
+
+
+def read_rigs(config):
+    threshold = config.get('threshold_minutes', 5)
+    rigs = config.get('rigs') or [{'name': 'bonsai', 'csv_file_path': config['csv_file_path']}]
+    return [Rig(rig['name'], rig['csv_file_path'], rig.get('threshold_minutes', threshold), rig.get('metrics_url'),
+                **{key: rig[key] for key in ['min_rate_ratio', 'max_stall_sec'] if key in rig}) for rig in rigs]
+
+def parse_metrics(text):
+    """
+    Prometheus text format -> [(name, {label: value}, value)], enough for what acquisition_metrics.py writes.
+    """
+    metrics = []
+    for line in text.splitlines():
+        match = re.fullmatch(r'(\w+)(?:\{(.*)\})?\s+(\S+)', line.strip())
+        if line.startswith('#') or not match:
+            continue
+        name, labels, value = match.groups()
+        metrics.append((name, dict(re.findall(r'(\w+)="([^"]*)"', labels or '')), float(value)))
+    return metrics
+
+def alert_message(alert):
+    if 'problems' in alert:
+        problems = "\n".join(f"- {problem}" for problem in alert['problems'].values())
+        return f"⚠️ *Bonsai Acquisition Alert* ({alert['rig']}) ⚠️\n\n{problems}"
+    return (f"⚠️ *Bonsai System Alert* ({alert['rig']}) ⚠️\n\n"
+            f"The Bonsai system at `{alert['working_dir']}` "
+            f"running workflow `{alert['workflow_name']}` "
+            f"has not updated since `{alert['last_update'].strftime('%Y-%m-%d %H:%M:%S %Z')}`. "
+            f"Please check the system!")
+
+
+class RateLimiter:
+    """
+    Token bucket shared by all the sends, telegram allows ~30 messages per second per bot
+    (a burst as big as the rate would let through twice the rate in a second, AlertSender paces them).
+    """
+
+    def __init__(self, rate=25, burst=25, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.clock = clock
+        self.updated = clock()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = self.clock()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class AlertSender:
+    """
+    Concurrent fan-out of messages with at most `max_concurrent` requests in flight,
+    rate limited and deduplicated: a (key, chat_id) pair is only sent once.
+
+    Parameters:
+    - bot: Anything with `async send_message(chat_id=..., text=..., parse_mode=...)` (telegram.Bot).
+    """
+
+    def __init__(self, bot, rate=25, max_concurrent=8):
+        self.bot = bot
+        self.limiter = RateLimiter(rate, burst=1)
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+        self.sent = {}
+
+    async def _send(self, chat_id, text):
+        async with self.semaphore:
+            await self.limiter.acquire()
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=text, parse_mode='Markdown')
+                return True
+            except Exception as e:
+                logger.error(f"Could not send alert to {chat_id}: {e}")
+                return False
+
+    async def fan_out(self, chat_ids, text, key):
+        """
+        Send `text` to the chats that did not get `key` yet. Failed sends are retried on the next call.
+
+        Returns:
+        - Number of messages sent.
+        """
+        done = self.sent.setdefault(key, set())
+        pending = [chat_id for chat_id in dict.fromkeys(chat_ids) if chat_id not in done]
+        results = await asyncio.gather(*(self._send(chat_id, text) for chat_id in pending))
+        done.update(chat_id for chat_id, ok in zip(pending, results) if ok)
+        return sum(results)
+
+    def forget(self, prefix):
+        # drop the keys of a rig that recovered so its next outage is announced again
+        for key in [key for key in self.sent if key[0] == prefix]:
+            del self.sent[key]
+
+
+class StatusMonitor:
+    """
+    Check all the rigs concurrently and alert the subscribers once per outage
+    (and every `repeat_minutes` while it lasts, if given). Silences are per rig.
+    """
+
+    def __init__(self, rigs, sender, subscribers, repeat_minutes=None):
+        self.rigs = {rig.name: rig for rig in rigs}
+        self.sender = sender
+        self.subscribers = subscribers
+        self.repeat = timedelta(minutes=repeat_minutes) if repeat_minutes else None
+
+    def silence(self, names=None, silenced=True):
+        """
+        (Un)silence the given rigs, all of them if names is empty.
+
+        Returns:
+        - The names that were changed.
+        """
+        names = list(names) if names else list(self.rigs)
+        changed = [name for name in names if name in self.rigs]
+        for name in changed:
+            self.rigs[name].silenced = silenced
+        return changed
+
+    def _alert_key(self, alert):
+        if 'problems' in alert:
+            return (alert['rig'], 'health') + tuple(sorted(alert['problems']))
+        key = (alert['rig'], alert['last_update'].isoformat())
+        if self.repeat is not None:
+            key += (alert['down_for'] // self.repeat,)
+        return key
+
+    async def check_all(self):
+        """
+        Returns:
+        - The alerts of this round (silenced rigs are not checked).
+        """
+        rigs = [rig for rig in self.rigs.values() if not rig.silenced]
+        checks = await asyncio.gather(*(asyncio.to_thread(rig.check) for rig in rigs), return_exceptions=True)
+        alerts = []
+        for rig, alert in zip(rigs, checks):
+            if isinstance(alert, Exception):
+                logger.error(f"Error checking {rig.name}: {alert}")
+                continue
+            if alert is None:
+                self.sender.forget(rig.name)
+                continue
+            alerts.append(alert)
+        await asyncio.gather(*(self.sender.fan_out(list(self.subscribers), alert_message(alert), self._alert_key(alert)) for alert in alerts))
+        return alerts
+
+    def status_text(self):
+        lines = []
+        for rig in self.rigs.values():
+            row = rig.tail.last_row
+            last = row['local_dt'] if row else "no data"
+            lines.append(f"{rig.name}: {'silenced' if rig.silenced else 'watching'}, last update {last}")
+        return "\n".join(lines)
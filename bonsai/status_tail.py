@@ -0,0 +1,105 @@
+import os
+import csv
+import io
+
+# Incremental reader for the bonsai status csv (a heartbeat row every few seconds, it grows for weeks)
+# Each read only parses the bytes appended since the previous one.
+
+
+class StatusTail:
+    """
+    Follow an append-only csv with a header line.
+
+    The first read() seeks from the end to find the last complete row instead of parsing the
+    whole history. Later reads start at the byte offset where the previous one stopped and only
+    consume complete lines (a row bonsai is still writing is left for the next read).
+    If the file is truncated or replaced (rotation, bonsai overwriting it on restart),
+    it is read again like the first time.
+
+    Parameters:
+    - csv_file: Path to the status csv.
+    - block_size: Bytes read at a time when looking for the last row from the end.
+    """
+
+    def __init__(self, csv_file, block_size=4096):
+        self.csv_file = csv_file
+        self.block_size = block_size
+        self.offset = None
+        self.header = None
+        self.identity = None
+        self.last_row = None
+
+    def _reset(self):
+        self.offset = None
+        self.header = None
+        self.last_row = None
+
+    def _read_header(self, f):
+        line = f.readline()
+        if not line.endswith(b"\n"):
+            return False
+        self.header = next(csv.reader([line.decode().rstrip("\r\n")]))
+        self.offset = f.tell()
+        return True
+
+    def _seek_last_row(self, f, size):
+        # start of the last complete line, never before the end of the header
+        end = size
+        pos = size
+        tail = b""
+        while pos > self.offset:
+            pos = max(pos - self.block_size, self.offset)
+            f.seek(pos)
+            tail = f.read(end - pos) + tail
+            end = pos
+            last_newline = tail.rfind(b"\n")
+            if last_newline == -1:
+                continue
+            previous = tail.rfind(b"\n", 0, last_newline)
+            if previous != -1:
+                return pos + previous + 1
+        return self.offset
+
+    def read(self):
+        """
+        Rows appended since the previous call, as dicts (all values are strings).
+        The first call only returns the last row.
+        """
+        try:
+            stat = os.stat(self.csv_file)
+        except FileNotFoundError:
+            self._reset()
+            return []
+        identity = (stat.st_dev, stat.st_ino)
+        if identity != self.identity or (self.offset is not None and stat.st_size < self.offset):
+            self._reset()
+            self.identity = identity
+        with open(self.csv_file, "rb") as f:
+            if self.header is not None:
+                # a file overwritten by bonsai can grow past our offset before we look again,
+                # we always stop right after a newline so anything else means it changed
+                f.seek(self.offset - 1)
+                if f.read(1) != b"\n":
+                    self._reset()
+                    f.seek(0)
+            if self.header is None:
+                if not self._read_header(f):
+                    return []
+                self.offset = self._seek_last_row(f, stat.st_size)
+            f.seek(self.offset)
+            data = f.read(stat.st_size - self.offset)
+        end = data.rfind(b"\n") + 1
+        if end == 0:
+            return []
+        self.offset += end
+        rows = [dict(zip(self.header, values)) for values in csv.reader(io.StringIO(data[:end].decode())) if values]
+        if rows:
+            self.last_row = rows[-1]
+        return rows
+
+    def latest(self):
+        """
+        Last complete row of the file (None if there is none yet).
+        """
+        self.read()
+        return self.last_row
@@ -0,0 +1,191 @@
+import os
+import time
+import asyncio
+import tempfile
+import unittest
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import datetime, timedelta, timezone
+from status_monitor import Rig, AlertSender, StatusMonitor, read_rigs, parse_metrics
+
+HEADER = "local_dt,working_dir,workflow_name\n"
+
+METRICS = """# HELP bonsai_stream_rate_ratio bytes_per_second / expected_bytes_per_second (1 when no samples are dropped)
+# TYPE bonsai_stream_rate_ratio gauge
+bonsai_stream_rate_ratio{{box="box1",stream="eegdata"}} {ratio}
+bonsai_stream_rate_ratio{{box="box2",stream="eegdata"}} 1
+# TYPE bonsai_stream_stalled_seconds gauge
+bonsai_stream_stalled_seconds{{box="box1",stream="ttl_in_state"}} {stalled}
+# TYPE bonsai_stream_discontinuities_total counter
+bonsai_stream_discontinuities_total{{box="box1",stream="eegdata"}} {gaps}
+"""
+
+def serve_text(state):
+    # stands in for acquisition_metrics.py on the rig
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = METRICS.format(**state).encode()
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+class FakeTelegram:
+    # stands in for telegram.Bot: slow requests, a 429 when going over `limit` messages per second
+    def __init__(self, latency=0.02, limit=30, blocked=()):
+        self.latency = latency
+        self.limit = limit
+        self.blocked = set(blocked)
+        self.messages = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def send_message(self, chat_id, text, parse_mode=None):
+        now = time.monotonic()
+        if len([t for t, _, _ in self.messages if now - t < 1]) >= self.limit:
+            raise RuntimeError("429 Too Many Requests")
+        if chat_id in self.blocked:
+            raise RuntimeError("403 Forbidden: bot was blocked by the user")
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(self.latency)
+        self.in_flight -= 1
+        self.messages.append((now, chat_id, text))
+
+class TestStatusMonitor(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        # the bot runs every check on the same loop
+        self.loop = asyncio.new_event_loop()
+        self.run = self.loop.run_until_complete
+
+    def tearDown(self):
+        self.loop.close()
+        self.tmp.cleanup()
+
+    def write_status(self, name, minutes_ago):
+        fn = os.path.join(self.tmp.name, f"{name}.csv")
+        last = datetime.now(timezone.utc) - timedelta(minutes=minutes_ago)
+        # bonsai appends a row to its status csv
+        new = not os.path.exists(fn)
+        with open(fn, "a") as f:
+            f.write((HEADER if new else "") + f"{last.isoformat()},C:/{name},eeg.bonsai\n")
+        return fn
+
+    def make_monitor(self, bot, subscribers, stale=("rig1", "rig3"), rate=25, repeat_minutes=None):
+        rigs = [Rig(name, self.write_status(name, 30 if name in stale else 0), 5) for name in ["rig1", "rig2", "rig3"]]
+        return StatusMonitor(rigs, AlertSender(bot, rate=rate, max_concurrent=8), subscribers, repeat_minutes)
+
+    def test_alerts_once_per_outage(self):
+        bot = FakeTelegram()
+        subscribers = {1, 2, 3}
+        monitor = self.make_monitor(bot, subscribers)
+        alerts = self.run(monitor.check_all())
+        self.assertEqual(sorted(alert["rig"] for alert in alerts), ["rig1", "rig3"])
+        self.assertEqual(len(bot.messages), 6)
+        self.assertTrue(all("rig2" not in text for _, _, text in bot.messages))
+        # still down: nothing new, a new subscriber gets the pending alerts
+        self.run(monitor.check_all())
+        self.assertEqual(len(bot.messages), 6)
+        subscribers.add(4)
+        self.run(monitor.check_all())
+        self.assertEqual(sorted(chat_id for _, chat_id, _ in bot.messages[6:]), [4, 4])
+        # rig1 comes back and goes down again with a new last update
+        self.write_status("rig1", 0)
+        self.run(monitor.check_all())
+        self.assertEqual(len(bot.messages), 8)
+        self.write_status("rig1", 10)
+        self.run(monitor.check_all())
+        self.assertEqual(len(bot.messages), 12)
+
+    def test_silences_are_per_rig(self):
+        bot = FakeTelegram()
+        monitor = self.make_monitor(bot, {1})
+        self.assertEqual(monitor.silence(["rig1", "nope"]), ["rig1"])
+        self.run(monitor.check_all())
+        self.assertEqual([text.split("(")[1].split(")")[0] for _, _, text in bot.messages], ["rig3"])
+        monitor.silence()
+        self.assertEqual(self.run(monitor.check_all()), [])
+        monitor.silence(["rig1"], silenced=False)
+        self.run(monitor.check_all())
+        self.assertEqual(len(bot.messages), 2)
+        self.assertIn("rig1: watching", monitor.status_text())
+        self.assertIn("rig3: silenced", monitor.status_text())
+
+    def test_fan_out_is_concurrent_and_rate_limited(self):
+        bot = FakeTelegram(latency=0.05, limit=30, blocked={7})
+        monitor = self.make_monitor(bot, set(range(40)), stale=("rig1",), rate=20)
+        start = time.monotonic()
+        self.run(monitor.check_all())
+        elapsed = time.monotonic() - start
+        # 39 messages (one chat blocked the bot) without a 429, paced at 20 per second
+        self.assertEqual(len(bot.messages), 39)
+        self.assertGreater(bot.max_in_flight, 1)
+        self.assertLessEqual(bot.max_in_flight, 8)
+        # one after the other it would take 39 * (0.05 + 0.05) seconds
+        self.assertGreater(elapsed, 38 / 20)
+        self.assertLess(elapsed, 38 / 20 + 0.5)
+        # the failed send is retried on the next round
+        bot.blocked.clear()
+        self.run(monitor.check_all())
+        self.assertEqual(bot.messages[-1][1], 7)
+        self.assertEqual(len(bot.messages), 40)
+
+    def test_repeat_reminders(self):
+        bot = FakeTelegram()
+        monitor = self.make_monitor(bot, {1}, stale=("rig1",), repeat_minutes=20)
+        rig = monitor.rigs["rig1"]
+        alert = rig.check()
+        later = rig.check(now=datetime.now(timezone.utc) + timedelta(minutes=20))
+        self.assertNotEqual(monitor._alert_key(alert), monitor._alert_key(later))
+        self.run(monitor.check_all())
+        self.run(monitor.check_all())
+        self.assertEqual(len(bot.messages), 1)
+
+    def test_acquisition_metrics_alerts(self):
+        state = {"ratio": 1, "stalled": 0, "gaps": 2}
+        server = serve_text(state)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        bot = FakeTelegram()
+        rig = Rig("rig1", self.write_status("rig1", 0), 5, f"http://127.0.0.1:{server.server_port}/metrics")
+        monitor = StatusMonitor([rig], AlertSender(bot), {1})
+        # old gaps are not news
+        self.assertEqual(self.run(monitor.check_all()), [])
+        state.update(ratio=0.9, stalled=120)
+        alerts = self.run(monitor.check_all())
+        self.assertEqual(sorted(alerts[0]["problems"]), ["box1 eegdata rate", "box1 ttl_in_state stalled"])
+        self.assertIn("90.0% of the expected data rate", bot.messages[0][2])
+        self.run(monitor.check_all())
+        self.assertEqual(len(bot.messages), 1)
+        # a new gap on top is a new alert, once
+        state.update(gaps=3)
+        self.run(monitor.check_all())
+        self.assertIn("new gap", bot.messages[1][2])
+        self.assertEqual(len(bot.messages), 2)
+        state.update(ratio=1, stalled=0)
+        self.assertEqual(self.run(monitor.check_all()), [])
+
+    def test_parse_metrics(self):
+        metrics = parse_metrics(METRICS.format(ratio=0.5, stalled=3, gaps=0))
+        self.assertEqual(metrics[0], ("bonsai_stream_rate_ratio", {"box": "box1", "stream": "eegdata"}, 0.5))
+        self.assertEqual(len(metrics), 4)
+
+    def test_read_rigs(self):
+        rigs = read_rigs({"csv_file_path": "status.csv", "threshold_minutes": 3})
+        self.assertEqual([(rig.name, rig.threshold) for rig in rigs], [("bonsai", timedelta(minutes=3))])
+        rigs = read_rigs({"rigs": [{"name": "a", "csv_file_path": "a.csv"},
+                                   {"name": "b", "csv_file_path": "b.csv", "threshold_minutes": 10,
+                                    "metrics_url": "http://b:9108/metrics", "min_rate_ratio": 0.9}]})
+        self.assertEqual([rig.threshold for rig in rigs], [timedelta(minutes=5), timedelta(minutes=10)])
+        self.assertEqual([(rig.metrics_url, rig.min_rate_ratio) for rig in rigs], [(None, 0.99), ("http://b:9108/metrics", 0.9)])
+
+if __name__ == '__main__':
+    unittest.main()
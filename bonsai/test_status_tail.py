@@ -0,0 +1,60 @@
+import os
+import tempfile
+import unittest
+from status_tail import StatusTail
+
+HEADER = "working_dir,workflow_name,utc_dt,local_dt,total_day_ms\n"
+
+def row(i):
+    return f"C:\\rig,continuous.bonsai,2024-03-01T10:00:{i:02d}Z,2024-03-01T05:00:{i:02d}-05:00,{i}\n"
+
+class TestStatusTail(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.fn = os.path.join(self.tmp.name, "bonsai_status.csv")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, text, mode="a"):
+        with open(self.fn, mode) as f:
+            f.write(text)
+
+    def test_first_read_only_parses_the_end(self):
+        # the old rows are not even valid text, they would break any full read
+        with open(self.fn, "wb") as f:
+            f.write(HEADER.encode() + b"\xff\xfe\n" * 1000 + row(49).encode())
+        tail = StatusTail(self.fn, block_size=64)
+        self.assertEqual(tail.latest()["total_day_ms"], "49")
+        self.write(row(50))
+        self.assertEqual([r["total_day_ms"] for r in tail.read()], ["50"])
+
+    def test_incremental_and_partial_rows(self):
+        self.write(HEADER, "w")
+        tail = StatusTail(self.fn)
+        self.assertIsNone(tail.latest())
+        self.write(row(0) + row(1))
+        self.assertEqual([r["total_day_ms"] for r in tail.read()], ["0", "1"])
+        # bonsai in the middle of a row
+        self.write(row(2) + row(3)[:10])
+        self.assertEqual([r["total_day_ms"] for r in tail.read()], ["2"])
+        self.write(row(3)[10:] + row(4))
+        self.assertEqual([r["total_day_ms"] for r in tail.read()], ["3", "4"])
+        self.assertEqual(tail.read(), [])
+        self.assertEqual(tail.latest()["local_dt"], "2024-03-01T05:00:04-05:00")
+
+    def test_truncation_and_overwrite(self):
+        self.write(HEADER + "".join(row(i) for i in range(10)), "w")
+        tail = StatusTail(self.fn)
+        tail.latest()
+        # bonsai restarted with Overwrite=true and already wrote more than we had read
+        self.write(HEADER + "".join(row(i) for i in range(20, 32)), "w")
+        self.assertEqual(tail.latest()["total_day_ms"], "31")
+        self.write(HEADER + row(40), "w")
+        self.assertEqual(tail.latest()["total_day_ms"], "40")
+        os.remove(self.fn)
+        self.assertIsNone(tail.latest())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -10,6 +10,9 @@ import mne
 from mne.io import RawArray
 from utils import *
 from rlist_files import list_files
+# camera frame counters are split with the server reader (appended, this folder's utils comes first)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server"))
+from camera_frames import count_camera_channels, read_demux, write_camera_index
 
 console.log("Choose EEG file")
 eeg_file = ui_find_file(title="Choose EEG file", initialdir=os.path.expanduser("~"))
@@ -27,17 +30,12 @@ f_aq = config['aq_freq_hz']
 # TODO: better split the reading so that we don't attempt to read 100 Gb of data
 num_channels = len(config['selected_channels'])
 
-# look for camera saved as an integer at the start or end of the sequence
-# because the sampling rate is so high, the frames will be repeated so we can use this fact
-# we read 2 samples from each channel and the frames that correspond to those
-head = np.fromfile(eeg_file, dtype=np.float32,count=(num_channels + 1) * 2)
-# we reshape to 2 columns for easier subtraction
-two_col = head.reshape(2, (num_channels + 1)).T
-has_camera = any(np.subtract(two_col[:, 0], two_col[:, 1]) == 0)
+# look for the camera frame counter saved as an extra channel at the end of the sequence
+# because the sampling rate is so high, the frames repeat on consecutive samples
+camera_channels = count_camera_channels(eeg_file, num_channels)
 
-if has_camera:
-  num_channels = num_channels + 1
-  console.info(f"camera frame present in dataset, new channel_num is {num_channels}", severe=True)
+if camera_channels:
+  console.info(f"camera frame present in dataset, {camera_channels} extra channel(s) after the {num_channels} eeg channels")
 
 num_files = len(file_list)
 #combined_data = np.zeros((num_files, num_channels, 0), dtype=np.float32)
@@ -45,31 +43,23 @@ num_files = len(file_list)
 # Iterate over the files
 for file_idx, file in enumerate(file_list):
   console.log(f"Read data from file {file} ({file_idx+1}/{num_files})")
-  # data is stored as np.float32
-  eeg_array = np.fromfile(file, dtype=np.float32)
-  # first integer division, then blowup.
-  n_samples_all_channels = eeg_array.shape[0] // num_channels
-  console.info(f"Reading all dataset. Reshaping and transposing into {num_channels, n_samples_all_channels}")
-  # subset and reshape
-  eeg_array = eeg_array.reshape(n_samples_all_channels, num_channels).T
+  if camera_channels:
+    # split the camera counters while reading, only their run-length index is saved
+    eeg_array, frame_index = read_demux(file, num_channels, camera_channels)
+    write_camera_index(file, frame_index)
+  else:
+    # data is stored as np.float32
+    eeg_array = np.fromfile(file, dtype=np.float32)
+    # first integer division, then blowup.
+    n_samples_all_channels = eeg_array.shape[0] // num_channels
+    console.info(f"Reading all dataset. Reshaping and transposing into {num_channels, n_samples_all_channels}")
+    # subset and reshape
+    eeg_array = eeg_array.reshape(n_samples_all_channels, num_channels).T
 
   # Filtering
-  channel_map = create_channel_map(eeg_array, config)
-  # create filtered and raw array
   bandpass_freqs = config['bandpass']['eeg']
   emg_bandpass = config['bandpass']['emg']
 
-  # remove cam stamp if present
-  if has_camera:
-    cam_index = np.where(['cam' in value for value in list(channel_map.values())])
-    cam_array = eeg_array[cam_index[0], :]
-    eeg_array = np.delete(eeg_array, cam_index, axis=0)
-    # save camera
-    suffix = f"_camframes.npy"
-    outfile = os.path.join(ephys_folder, f"{Path(eeg_file).stem}{suffix}")
-    console.success(f"Saving camera frames as {outfile}")
-    np.save(outfile, cam_array)
-
   if file_idx == 0:
       # For the first file, initialize combined_data with the shape of eeg_array
       combined_data = np.expand_dims(eeg_array, axis=0)
@@ -7,9 +7,6 @@ from py_console import console
 from pathlib import Path
 from utils import *
 from rlist_files import list_files
-# photometry sync
-import tdt
-import phototdt
 from pathlib import Path
 import argparse
 # filtering
@@ -18,6 +15,9 @@ from mne.io import RawArray
 import polars as pl
 from scipy.signal import decimate
 from bonsai_dat_to_npy_eeg import *
+from time_map import TimeMap
+from tdt_matching import index_tdt_blocks, match_tdt_block, read_tdt_block_info, session_datetime
+from ttl_events import load_chunk_events, find_ttl_channel, select_edges, RISING, FALLING
 
 def align_ttl_to_eeg(eeg_samples, ttl_samples):
     '''
@@ -147,18 +147,8 @@ def find_mismatch(array1, array2):
     # If both arrays match, return -1
     return -1
 
-def fix_tdt_names(string, append): 
-  # if the epocs have less than 3 letters, they would be stored as
-  # "PC0/" but can only be accessed using "PC0_" on the dict
-  # this little helper gives a hand to avoid errors if they happened to occur
-  if len(string) < 4:
-    return f"{string}{append}"
-  else:
-    return string
-
-
-def create_params_dict(eeg_t0_sec, max_t, alignment_idx, tdt_pulse_onset, pulse_onset):
-    return {
+def create_params_dict(eeg_t0_sec, max_t, alignment_idx, tdt_pulse_onset, pulse_onset, time_map=None, tdt_folder=None):
+    params = {
         "eeg_t0_sec": {
             "description": "the time in seconds to subtract from the time vector on the ephys recording",
             "value": float(eeg_t0_sec)
@@ -180,6 +170,17 @@ def create_params_dict(eeg_t0_sec, max_t, alignment_idx, tdt_pulse_onset, pulse_
             "value": len(pulse_onset)
         }
     }
+    if tdt_folder is not None:
+        params["tdt_block_folder"] = {
+            "description": "the TDT block recorded together with this session",
+            "value": tdt_folder
+        }
+    if time_map is not None:
+        params["time_map"] = {
+            "description": "knots of the piecewise-linear map between eeg time (sec from first eeg sample) and tdt time (sec), read with time_map.read_time_maps()",
+            "value": time_map.to_dict()
+        }
+    return params
 
 def save_alignment_params(params, output_folder):
   params_file = os.path.join(
@@ -192,22 +193,20 @@ def save_alignment_params(params, output_folder):
         sort_keys=False)
   console.success(f"Saved alignment params in {params_file}")
 
-def align_single_chunk(ttl_chunk, config, output_folder):
+def align_single_chunk(ttl_chunk, config, output_folder, tdt_index=None):
   '''
   This function should align a single chunk by matching with respective eeg_files
+  If tdt_index (see tdt_matching.index_tdt_blocks) is provided, the TDT block is matched automatically
+  otherwise the user has to select it
   '''
   session_id = parse_bids_session(ttl_chunk[0])
   console.info(f"Processing aligned recording with session_id: {session_id}")
   # ttl data comes demultiplexed in ColumMajor
   # dtype for ttl it's np.int8
-  num_channels = len(config['ttl_names'])
-  ttl_array, ttl_samples = read_stack_chunks(ttl_chunk, 
-                                             num_channels,
-                                             dtype=np.int8, 
-                                             return_nsamples = True)
-  # normalize so max values go from 1, 2, 3, 4, 5, 6, 7, 8 to all being 1 
-  ttl_array = normalize_ttl(ttl_array, method="max")
-  console.success("TTL data read and normalized")
+  # we only use the edge tables stored next to the ttl files
+  # they are extracted (once) from the memory mapped files if not there yet
+  ttl_events, ttl_samples = load_chunk_events(ttl_chunk, config['ttl_names'])
+  console.success("TTL edges loaded")
   # TODO: We might want to save the TTL it at some point, but not for now
 
   # We want to chunk the ephys data so that it matches the ttl_data
@@ -216,42 +215,51 @@ def align_single_chunk(ttl_chunk, config, output_folder):
   matching_eeg_files = [val.replace("ttl_in", "eeg") for val in ttl_chunk]
   # replace the /ttl/ for /eeg/
   matching_eeg_files = [val.replace('/ttl/', '/eeg/') for val in matching_eeg_files]
-  # Iterate over the files and combine data
-  #combined_data, eeg_samples = read_stack_chunks(matching_eeg_files, len(config['selected_channels']), dtype = np.float32, return_nsamples = True)
-  # filter, downsample, and save
-  eeg_downsampled, nsamples_dict = filter_down_bonsai_eeg(config=config, file_list=matching_eeg_files, output_folder=output_folder)
+  # Reuse the downsampled output of the whole day (from run_pipeline) and slice the rows of these files
+  # nsamples per file come from the file sizes, only filters again if there's no previous output
+  session_eeg_file, eeg_samples = slice_downsampled_eeg(config=config, file_list=matching_eeg_files, output_folder=output_folder)
   
   # -------------------------------------------- #
   # --------- Now we perform alignment --------- #
   # -------------------------------------------- #
+  photo_ttl_idx = find_ttl_channel(config["ttl_names"], "photometry")
+  pulse_onset = select_edges(ttl_events, photo_ttl_idx, RISING)
+  pulse_offset = select_edges(ttl_events, photo_ttl_idx, FALLING)
+
   # Finding the photometry file
-  # This must be done manually because we have to find the proper TDT file
-  console.log(f"Choose any Matching Photometry file for session {session_id}")
-  photometry_file = ui_find_file(title=f"Choose any Matching Photometry file for session {session_id}", initialdir=ephys_folder)
-  tdt_folder = os.path.dirname(photometry_file)
+  if tdt_index is not None:
+    # match by timestamp overlap and pulse train cross-correlation
+    matched_block = match_tdt_block(
+      chunk_start=session_datetime(ttl_chunk[0]),
+      chunk_duration_sec=sum(ttl_samples) / config['aq_freq_hz'],
+      bonsai_onset_sec=pulse_onset / config['aq_freq_hz'],
+      tdt_index=tdt_index)
+    if matched_block is None:
+      raise ValueError(f"No TDT block matches session {session_id}")
+    block_info = matched_block
+  else:
+    # This must be done manually because we have to find the proper TDT file
+    console.log(f"Choose any Matching Photometry file for session {session_id}")
+    photometry_file = ui_find_file(title=f"Choose any Matching Photometry file for session {session_id}", initialdir=os.path.dirname(os.path.dirname(output_folder)))
+    # block info and pulse-sync onsets come from the block index (parsed once and cached next to the block)
+    block_info = read_tdt_block_info(os.path.dirname(photometry_file), config['pulse_sync'])
+  tdt_folder = block_info['block_folder']
   console.info(f"Selected TDT folder is {tdt_folder}")
   
-  # we read a very very small portion only to get the info
-  block = tdt.read_block(tdt_folder, t1=0, t2=1)
   # get the duration of the photometry recording
-  max_t = phototdt.get_total_duration(block)
-  # we also read the events, these might lead to errors when changing the name of the store
-  pulse_sync_name = config['pulse_sync']
-  tdt_pulse_onset = tdt.read_block(tdt_folder, store = fix_tdt_names(pulse_sync_name, '/')).epocs[fix_tdt_names(pulse_sync_name, '_')].onset
+  max_t = block_info['max_t']
+  # these might lead to errors when changing the name of the store
+  tdt_pulse_onset = block_info['pulse_onset']
   # We cannot use the last offset here because it's inf, but the difference is < pulse's width here
   tdt_epoc_duration = tdt_pulse_onset[-1] - tdt_pulse_onset[0]
   
-  photo_ttl_idx = np.where("photometry" in config["ttl_names"])[0]
-  photo_events = ttl_array[photo_ttl_idx, :].flatten()
-  pulse_onset = np.where(np.diff(photo_events, prepend=0) > 0)[0]
-  pulse_offset = np.where(np.diff(photo_events, prepend=0) < 0)[0]
   # These things should give the same duration
   tdt_recording_duration_sec = (pulse_offset[-1] - pulse_onset[0]) / 1000
   # this difference should be close to zero!
-  tdt_bonsai_diff = tdt_recording_duration_sec - block.info.duration.total_seconds()
+  tdt_bonsai_diff = tdt_recording_duration_sec - block_info['duration_sec']
   # Print some info
   console.info(f"Duration difference: block info - bonsai pulses = {tdt_bonsai_diff} seconds")
-  console.info(f"Duration difference: block info - tdt sent epocs = {block.info.duration.total_seconds() - tdt_epoc_duration} seconds")
+  console.info(f"Duration difference: block info - tdt sent epocs = {block_info['duration_sec'] - tdt_epoc_duration} seconds")
   # There's something weird with a difference of pulses between counting methods
   console.info(f"TDT sent: {len(tdt_pulse_onset)} pulses")
   console.info(f"Bonsai received: {len(pulse_onset)} pulses")
@@ -277,8 +285,6 @@ def align_single_chunk(ttl_chunk, config, output_folder):
   # in continuous mode, the first TTL file will always have less elements than the first eeg file
   # the last TTL file will also have less elements than the last eeg file
   # we have to account for that by adding the difference in samples to the pulse_onset
-  session_eeg_file = list_files(output_folder, pattern=session_id, full_names = True)[0]
-  eeg_samples = nsamples_dict[session_eeg_file]
   alignment_dir  = align_ttl_to_eeg(eeg_samples, ttl_samples)
   if alignment_dir['continuous_chunks'] == 1:
     console.warn('Cannot align chunks of length 1. No way to assume co-startt/co-termination')
@@ -290,15 +296,18 @@ def align_single_chunk(ttl_chunk, config, output_folder):
   pulse_onset = pulse_onset + samples_to_add
   # now that we accounted for the difference, we can convert to seconds
   eeg_t0_sec = pulse_onset[alignment_idx] / config['aq_freq_hz']
+  # eeg_t0_sec assumes a constant offset, the time map uses all the pulses to follow the drift between clocks
+  time_map = TimeMap.fit(pulse_onset / config['aq_freq_hz'], tdt_pulse_onset)
+  console.info(f"Fitted {time_map} on {time_map.n_pairs} pulses, max residual {1000 * time_map.residual_sec:.2f} ms")
   
   # OUTPUTS
   # Create params dict for the current session
-  current_params = create_params_dict(eeg_t0_sec, max_t, alignment_idx, tdt_pulse_onset, pulse_onset)
+  current_params = create_params_dict(eeg_t0_sec, max_t, alignment_idx, tdt_pulse_onset, pulse_onset, time_map, tdt_folder)
   console.success(f"Finished Alignment for session {session_id}")
   return session_eeg_file, current_params
 
 
-def run_alignment(ephys_folder, config_folder):
+def run_alignment(ephys_folder, config_folder, tdt_index=None):
   # Now you can use ephys_folder and config_folder in your script
   console.info(f"Finding configs in {config_folder}")
   config = read_config(config_folder)
@@ -309,7 +318,7 @@ def run_alignment(ephys_folder, config_folder):
   subject_id = config["subject_id"]
   console.info(f"Finding TTLs in {ephys_folder}")
   # list the ttl files
-  ttl_files = list_files(os.path.join(ephys_folder, "ttl"), pattern = ".bin", full_names = True)
+  ttl_files = bin_sources(list_files(os.path.join(ephys_folder, "ttl"), pattern = ".bin", full_names = True))
   bonsai_timer_period = datetime.datetime.strptime(config["bonsai_timer_period"], "%H:%M:%S")
   expected_delta_sec = datetime.timedelta(hours = bonsai_timer_period.hour, minutes= bonsai_timer_period.minute, seconds = bonsai_timer_period.second).total_seconds()
   expected_delta_min = expected_delta_sec / 60
@@ -331,7 +340,8 @@ def run_alignment(ephys_folder, config_folder):
     session_eeg_file, current_params = align_single_chunk(
        ttl_chunk=ttl_chunk, 
        config=config,
-       output_folder=output_folder)
+       output_folder=output_folder,
+       tdt_index=tdt_index)
     # Store align params in output dictionary
     all_sessions_params[session_eeg_file] = current_params
     
@@ -345,6 +355,7 @@ if __name__ == "__main__":
   # Add arguments for ephys_folder and config_folder
   parser.add_argument('--session_folder', help='Path to the session folder (ending in yyyy-mm-dd)')
   parser.add_argument('--config_folder', help='Path to the config folder')
+  parser.add_argument('--tdt_folder', help='Root folder with the TDT blocks. If provided, blocks are matched automatically instead of selected by hand', default=None)
   # Parse the command-line arguments
   args = parser.parse_args()
   # Check if ephys_folder argument is provided, otherwise prompt the user
@@ -360,4 +371,7 @@ if __name__ == "__main__":
   else:
     config_folder = ephys_folder
   
-  run_alignment(ephys_folder=ephys_folder, config_folder=config_folder)
\ No newline at end of file
+  tdt_index = None
+  if args.tdt_folder:
+    tdt_index = index_tdt_blocks(args.tdt_folder, read_config(config_folder)['pulse_sync'])
+  run_alignment(ephys_folder=ephys_folder, config_folder=config_folder, tdt_index=tdt_index)
\ No newline at end of file
@@ -11,15 +11,19 @@ from pathlib import Path
 import mne
 from mne.io import RawArray
 from utils import *
-
-def line_count(filename):
-    return int(subprocess.check_output(['wc', '-l', filename]).split()[0])
+import argparse
+from accel_features import staging_chunks, session_accel_features
 
 def read_yaml(filename):
   with open(filename, "r") as ymlfile:
     cfg = yaml.safe_load(ymlfile)
   return cfg
 
+parser = argparse.ArgumentParser(description='Accelerometer activity features per staging epoch of every session in a folder')
+parser.add_argument('--epoch_sec', type=float, default=2.5, help='Epoch length of the staging (predict.py and log_rms_classifier.py use 2.5 sec)')
+parser.add_argument('--save_npy', action='store_true', help='Also write the full-rate _acceldata.npy of each session (same pass)')
+args = parser.parse_args()
+
 console.log("Choose acceleration file")
 root = tk.Tk()
 root.withdraw()
@@ -38,62 +42,12 @@ else:
 
 config = read_yaml(config_file)
 
-# get sampling frequency
-f_aq = config['aq_freq_hz'] // 4 # accelerometer will always be 1/4 of eeg aq freq
-total_lines = line_count(acc_file)
-console.info(f"{acc_file} has {total_lines} total lines")
-
-# TODO: better split the reading so that we don't attempt to read 100 Gb of data
 # TODO: it's not clear how the data would work if we have more than one animal here
-min_rec = 720
-timepoints = f_aq * 60 * min_rec
-num_channels = 3
-
-
-# data is stored as np.float32
-acc_array = np.fromfile(acc_file, dtype=np.float32,count=num_channels*timepoints)
-# if reading all data, this will 
-if acc_array.shape[0] < num_channels*timepoints:
-  # first integer division, then blowup.
-  n_samples_all_channels = acc_array.shape[0] // num_channels
-  samples_to_subset = n_samples_all_channels * num_channels
-  console.info(f"Reading all dataset. Reshaping and transposing into {n_samples_all_channels, num_channels}")
-  # subset and reshape
-  acc_array = acc_array[:samples_to_subset].reshape(n_samples_all_channels, num_channels)
-else:
-  console.info(f"Reading {num_channels*timepoints} timepoints. Reshaping to (timepoints, num_channels)")
-  acc_array = acc_array.reshape(timepoints, num_channels)
-
-
-# Filtering
-#channel_map = create_channel_map(acc_array, config)
-# create filtered and raw array
-#bandpass_freqs = config['bandpass']
-#
-#if has_camera:
-#  cam_index = np.where(['cam' in value for value in list(channel_map.values())])
-#  cam_array = acc_array[cam_index[0], :]
-#  acc_array = np.delete(acc_array, cam_index, axis=0)
-#  # save camera
-#  suffix = f"_camframes.npy"
-#  outfile = os.path.join(ephys_folder, f"{Path(acc_file).stem}{suffix}")
-#  console.success(f"Saving camera frames as {outfile}")
-#  np.save(outfile, cam_array)
-#
-#filtered_data = mne.filter.filter_data(acc_array.astype('float64'), 
-#                                  f_aq, 
-#                                  min(bandpass_freqs), 
-#                                  max(bandpass_freqs), 
-#                                  verbose=0, n_jobs=2)
-
-
-#suffix = f"_desc-filt-{min(bandpass_freqs)}-{max(bandpass_freqs)}_eeg.npy"
-#outfile = os.path.join(ephys_folder, f"{Path(acc_file).stem}{suffix}")
-#console.success(f"Saving eegdata as {outfile}")
-#np.save(outfile, filtered_data.astype('float32'))
-
-
-suffix = f"_acceldata.npy"
-outfile = os.path.join(ephys_folder, f"{Path(acc_file).stem}{suffix}")
-console.success(f"Saving acceleration data as {outfile}")
-np.save(outfile, acc_array.astype('float32'))
+# one staging session per continuous chunk of _eeg.bin files (same as the desc-down files),
+# the accel files are memory mapped and read once, the features land next to the eeg
+for session_id, chunk in staging_chunks(config, ephys_folder).items():
+  console.info(f"Session {session_id}: {len(chunk)} files")
+  npy_file = None
+  if args.save_npy:
+    npy_file = os.path.join(ephys_folder, f"{Path(chunk[0]).stem.replace('_eeg', '')}_acceldata.npy")
+  session_accel_features(config, ephys_folder, session_id, args.epoch_sec, npy_file=npy_file)
@@ -1,14 +1,20 @@
 import os
+import argparse
 import numpy as np
-import scipy.io
 from py_console import console
 import mne
 from utils import *
+from mat_export import export_accusleep_mats
 
 # TODO: Accusleep wants double precision so we have to use
 # .astype(np.float64)
 # At some point we should get rid of this if no longer using Accusleep
 
+parser = argparse.ArgumentParser(description='Export each channel of a filtered .npy to its own .mat file')
+parser.add_argument('--format', choices=['mat', 'h5'], default='mat', help="'mat' (v5, a whole channel in memory per worker) or 'h5' (chunked MAT v7.3, bounded memory, needs h5py)")
+parser.add_argument('--n_workers', type=int, default=None, help="Number of parallel workers (default: all cores, capped by the available memory for 'mat')")
+args = parser.parse_args()
+
 # Load data to work with
 console.info("Choose filtered EEG file")
 eeg_file = ui_find_file(title="Choose filtered eeg file", initialdir=os.path.expanduser("~"), file_type = "npy")
@@ -28,22 +34,5 @@ if emg_channels is None:
 else:
   console.success(f"Found EMG channels at idx {emg_channels}.")
 
-# load eeg and save it
-eeg = np.load(eeg_file)
-for channel in range(eeg.shape[0]):
-    fn = os.path.join(folder_name, f"eeg_channel{channel:02d}.mat")
-    if channel in emg_channels:
-        EMG = eeg[channel, :].astype(np.float64)
-        scipy.io.savemat(fn, {"EMG": EMG})
-        console.success(f"saved {fn}")
-    else:
-        EEG = eeg[channel, :].astype(np.float64)
-        scipy.io.savemat(fn, {"EEG": EEG})
-        console.success(f"saved {fn}")
-
-# create difference emg
-emg_diff = np.subtract(eeg[emg_channels[0]], eeg[emg_channels[1]])
-
-fn = os.path.join(folder_name, "emg_diff.mat")
-scipy.io.savemat(fn, {"EMG": emg_diff.astype(np.float64)})
-console.success(f"saved {fn}")
\ No newline at end of file
+# channels are read from the memory mapped .npy and written by parallel workers (including emg_diff)
+export_accusleep_mats(eeg_file, folder_name, emg_channels, fmt=args.format, n_workers=args.n_workers)
@@ -0,0 +1,200 @@
+import os
+import re
+import datetime
+import numpy as np
+import pandas as pd
+from py_console import console
+from utils import bin_nsamples, chunk_file_list, bids_naming, parse_bids_subject, list_files, bin_sources
+from camera_frames import count_camera_channels
+
+# Accelerometer stream (_accel.bin, float32 interleaved x, y, z) at aq_freq_hz // 4
+# Everything works on a memory map in blocks of whole epochs, the stream is never fully loaded
+# Features are computed per staging session: the chunk of continuous _eeg.bin files that
+# filter_down_bonsai_eeg() turns into one desc-down file, with epochs from its first sample.
+# Each _accel.bin is placed at the offset of its _eeg.bin in the chunk (from the file sizes).
+
+ACCEL_CHANNELS = 3
+# the accelerometer is sampled at 1/4 of the eeg aq freq
+ACCEL_DECIMATION = 4
+# 4096 epochs of 2.5 sec at 250 Hz are ~60 Mb of float64 per block
+DEFAULT_BLOCK_EPOCHS = 4096
+
+
+def open_accel_memmap(acc_file, num_channels=ACCEL_CHANNELS):
+    """
+    Memory-map a bonsai accelerometer file without reading it.
+
+    Returns:
+    - A read-only float32 array of shape (n_samples, num_channels). Trailing values that do
+      not make a full sample are ignored.
+    """
+    n_samples = os.path.getsize(acc_file) // (np.dtype(np.float32).itemsize * num_channels)
+    if n_samples == 0:
+        return np.empty((0, num_channels), dtype=np.float32)
+    return np.memmap(acc_file, dtype=np.float32, mode='r', shape=(n_samples, num_channels))
+
+def accel_file_path(eeg_file):
+    # sub-X_ses-Y_eeg.bin (or .binz) -> sub-X_ses-Y_accel.bin
+    return re.sub(r"_eeg\.binz?$", "_accel.bin", eeg_file)
+
+
+class ChunkAccel:
+    """
+    The accelerometer files of a chunk as one (n_samples, 3) array that behaves like a memmap
+    for slicing on the sample axis. Samples not covered by a file read as NaN.
+
+    Parameters:
+    - pieces: List of (offset, array) with the sample where each file starts in the chunk.
+    - n_samples: Accelerometer samples of the whole chunk.
+    """
+
+    def __init__(self, pieces, n_samples, num_channels=ACCEL_CHANNELS):
+        self.pieces = pieces
+        self.n_samples = n_samples
+        self.shape = (n_samples, num_channels)
+
+    def __len__(self):
+        return self.n_samples
+
+    def __getitem__(self, key):
+        start, stop, _ = key.indices(self.n_samples)
+        out = np.full((max(stop - start, 0), self.shape[1]), np.nan, dtype=np.float32)
+        for offset, acc in self.pieces:
+            first, last = max(start, offset), min(stop, offset + len(acc))
+            if first < last:
+                out[first - start:last - start] = acc[first - offset:last - offset]
+        return out
+
+
+def chunk_accel(config, chunk):
+    """
+    ChunkAccel over the _accel.bin files next to the _eeg.bin files of `chunk`.
+    Offsets are the samples of the earlier _eeg.bin files of the chunk (same as find_downsampled_slice).
+    """
+    num_channels = len(config['selected_channels'])
+    total_channels = num_channels + count_camera_channels(chunk[0], num_channels)
+    pieces = []
+    offset = 0
+    for eeg_file in chunk:
+        acc_file = accel_file_path(eeg_file)
+        if os.path.isfile(acc_file):
+            pieces.append((offset // ACCEL_DECIMATION, open_accel_memmap(acc_file)))
+        else:
+            console.warn(f"No accelerometer file for {eeg_file}, its epochs will be NaN")
+        offset += bin_nsamples(eeg_file, total_channels)
+    return ChunkAccel(pieces, offset // ACCEL_DECIMATION)
+
+def staging_chunks(config, eeg_folder):
+    """
+    {session_id: chunk} with the same chunking and session ids as filter_down_bonsai_eeg().
+    """
+    bonsai_timer_period = datetime.datetime.strptime(config["bonsai_timer_period"], "%H:%M:%S")
+    expected_delta_sec = datetime.timedelta(hours = bonsai_timer_period.hour, minutes= bonsai_timer_period.minute, seconds = bonsai_timer_period.second).total_seconds()
+    day_files = bin_sources(list_files(eeg_folder, pattern="_eeg.bin", full_names=True))
+    if not day_files:
+        return {}
+    return {re.search(r'\d{8}T\d{6}', chunk[0]).group(): chunk
+            for chunk in chunk_file_list(day_files, expected_delta_sec / 60, 1)}
+
+def accel_features_path(chunk, session_id, epoch_sec):
+    # next to the eeg files, one per staging session and epoch length
+    return bids_naming(os.path.dirname(chunk[0]), parse_bids_subject(chunk[0]), session_id,
+                       f"desc-epoch{epoch_sec:g}s_accelfeatures.csv.gz")
+
+def accel_epoch_features(acc, sf, epoch_sec, block_epochs=DEFAULT_BLOCK_EPOCHS, out=None):
+    """
+    Activity features per epoch, computed in one streaming pass over the accelerometer.
+
+    Epochs start at the first sample, same as yasa.sliding_window on the EEG, so with a
+    ChunkAccel epoch k matches the staging epoch k of the session. The static (gravity)
+    component used for ODBA is the mean of each axis within the epoch.
+
+    Parameters:
+    - acc: Array, memmap or ChunkAccel of shape (n_samples, 3), see open_accel_memmap().
+    - sf: Accelerometer sampling frequency (aq_freq_hz // 4).
+    - epoch_sec: Epoch length in seconds (the one used by the staging).
+    - block_epochs: Number of epochs read at a time.
+    - out: Optional array of acc.shape (e.g. an np.lib.format.open_memmap) that gets a copy of
+      the samples from the same reads.
+
+    Returns:
+    - A pandas DataFrame indexed by epoch with columns
+      'accel_vm' (mean vector magnitude), 'accel_odba' (overall dynamic body acceleration)
+      and 'accel_var' (summed variance of the axes). NaN for epochs without data.
+    """
+    epoch_samples = int(epoch_sec * sf)
+    n_epochs = acc.shape[0] // epoch_samples
+    vm = np.empty(n_epochs)
+    odba = np.empty(n_epochs)
+    var = np.empty(n_epochs)
+    for first in range(0, n_epochs, block_epochs):
+        last = min(first + block_epochs, n_epochs)
+        samples = np.asarray(acc[first * epoch_samples:last * epoch_samples])
+        if out is not None:
+            out[first * epoch_samples:last * epoch_samples] = samples
+        # (n_block_epochs, epoch_samples, n_axes)
+        block = samples.astype(np.float64).reshape(last - first, epoch_samples, acc.shape[1])
+        vm[first:last] = np.sqrt(np.square(block).sum(axis=-1)).mean(axis=1)
+        static = block.mean(axis=1, keepdims=True)
+        odba[first:last] = np.abs(block - static).sum(axis=-1).mean(axis=1)
+        var[first:last] = block.var(axis=1).sum(axis=-1)
+    if out is not None:
+        # samples after the last full epoch
+        out[n_epochs * epoch_samples:] = np.asarray(acc[n_epochs * epoch_samples:acc.shape[0]])
+    console.info(f"Computed accelerometer features for {n_epochs} epochs of {epoch_sec} sec")
+    return pd.DataFrame({'accel_vm': vm, 'accel_odba': odba, 'accel_var': var},
+                        index=pd.RangeIndex(n_epochs, name='epoch'))
+
+def session_accel_features(config, eeg_folder, session_id, epoch_sec, npy_file=None):
+    """
+    Activity features of the staging epochs of one session, read from its
+    desc-epoch<epoch_sec>s_accelfeatures.csv.gz when it exists, computed and saved otherwise.
+
+    Parameters:
+    - session_id: Session of the desc-down file (timestamp of the first _eeg.bin of the chunk).
+    - epoch_sec: Epoch length of the staging.
+    - npy_file: Also write the session accelerometer as a (n_samples, 3) .npy in the same pass
+      (forces the computation).
+
+    Returns:
+    - DataFrame indexed by epoch (see accel_epoch_features), None when the session has no
+      accelerometer files.
+    """
+    chunk = staging_chunks(config, eeg_folder).get(session_id)
+    if chunk is None:
+        console.warn(f"No _eeg.bin files of session {session_id} in {eeg_folder}")
+        return None
+    outfile = accel_features_path(chunk, session_id, epoch_sec)
+    if os.path.isfile(outfile) and npy_file is None:
+        return pd.read_csv(outfile, index_col='epoch')
+    acc = chunk_accel(config, chunk)
+    if not acc.pieces:
+        return None
+    out = None
+    if npy_file is not None:
+        out = np.lib.format.open_memmap(npy_file, mode='w+', dtype=np.float32, shape=acc.shape)
+    features = accel_epoch_features(acc, config['aq_freq_hz'] // ACCEL_DECIMATION, epoch_sec, out=out)
+    if out is not None:
+        out.flush()
+        del out
+        console.success(f"Saved acceleration data as {npy_file}")
+    features.to_csv(outfile)
+    console.success(f"Saved acceleration features as {outfile}")
+    return features
+
+def apply_accel_features(classified, accel_features, odba_threshold=None):
+    """
+    Add the accelerometer columns to the classification of each epoch and, with an
+    `odba_threshold`, score the active epochs (accel_odba above it) as wake.
+
+    Returns:
+    - classified (with the override), {column: values} of the accelerometer features.
+    """
+    accel_features = accel_features.reindex(pd.RangeIndex(len(classified)))
+    odba = accel_features['accel_odba'].to_numpy()
+    if odba_threshold is not None:
+        # epochs without accelerometer data (NaN) keep the emg call
+        active = odba > odba_threshold
+        console.info(f"{active.sum()} epochs scored as wake from accelerometer activity")
+        classified = np.where(active, 0, classified)
+    return classified, {'accel_vm': accel_features['accel_vm'].to_numpy(), 'accel_odba': odba}
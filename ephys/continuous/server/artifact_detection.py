@@ -16,6 +16,7 @@ from lspopt import spectrogram_lspopt
 import datetime
 import matplotlib.pyplot as plt
 import seaborn as sns
+from intervals import IntervalSet
 
 def window_rms(signal, window_size = 250):
     # window_size here is win_sec (2.5) * sampling frequency (100)
@@ -214,7 +215,7 @@ def continuous_sample(df, n):
 
 def find_mismatches(data, clipped, selected_electrode):
     """
-    Finds indices where original and clipped values differ.
+    Finds samples where original and clipped values differ.
     
     Parameters:
     - data: DataFrame with original data.
@@ -222,14 +223,14 @@ def find_mismatches(data, clipped, selected_electrode):
     - selected_electrode: The column name of the electrode to analyze.
     
     Returns:
-    - A numpy array of mismatch indices.
+    - An IntervalSet with the runs of mismatched samples.
     """
-    mismatches = (data[selected_electrode] != clipped[selected_electrode]).to_numpy().nonzero()[0]
-    return mismatches
+    mismatch_mask = (data[selected_electrode] != clipped[selected_electrode]).to_numpy()
+    return IntervalSet.from_mask(mismatch_mask)
 
 def find_continuous_mismatches(data, clipped, selected_electrode, n = 3):
     """
-    Finds start indices of significant continuous mismatches between original and clipped values,
+    Finds significant continuous mismatches between original and clipped values,
     disregarding blocks of mismatches shorter than `n`.
     
     Parameters:
@@ -239,35 +240,11 @@ def find_continuous_mismatches(data, clipped, selected_electrode, n = 3):
     - n: Minimum length of continuous mismatches of interest.
     
     Returns:
-    - A list of start indices for continuous mismatches of interest.
+    - An IntervalSet with the continuous mismatches of interest.
     - A dictionary summarizing the distribution of all found mismatch lengths.
     """
-    # Find mismatch indices
-    mismatches = (data[selected_electrode] != clipped[selected_electrode]).to_numpy().nonzero()[0]
-    
-    if len(mismatches) == 0:
-        return [], {}
-    
-    # Find consecutive sequences using np.diff
-    diff = np.diff(mismatches)
-    breaks = np.where(diff > 1)[0]  # Identify where the sequence breaks (non-consecutive)
-    
-    # Start indices of continuous blocks
-    start_indices = np.insert(mismatches[breaks + 1], 0, mismatches[0])
-    # End indices of continuous blocks
-    end_indices = np.append(mismatches[breaks], mismatches[-1])
-    
-    # Lengths of continuous blocks
-    lengths = end_indices - start_indices + 1
-    
-    # Filter blocks based on the length
-    significant_starts = start_indices[lengths >= n]
-    
-    # Analyzing the distribution of mismatch lengths
-    unique_lengths, counts = np.unique(lengths, return_counts=True)
-    distribution = dict(zip(unique_lengths, counts))
-    
-    return significant_starts.tolist(), distribution
+    mismatches = find_mismatches(data, clipped, selected_electrode)
+    return mismatches.filter_min_length(n), mismatches.length_distribution()
 
 def plot_mismatch_windows(data, clipped, mismatches, sf=100, win_sec=10, selected_electrode="EEG9", samples=20):
     """
@@ -276,12 +253,14 @@ def plot_mismatch_windows(data, clipped, mismatches, sf=100, win_sec=10, selecte
     Parameters:
     - data: DataFrame with original data.
     - clipped: DataFrame with clipped data.
-    - mismatches: Array of mismatch indices.
+    - mismatches: IntervalSet (or array of indices) with the mismatches. Intervals are plotted around their start.
     - sf: Sampling frequency in Hz.
     - win_sec: Window size in seconds for plotting.
     - selected_electrode: The column name of the electrode to analyze.
     - samples: Number of mismatch samples to plot.
     """
+    if isinstance(mismatches, IntervalSet):
+        mismatches = mismatches.starts
     if len(mismatches) == 0:
         print("No mismatches found.")
         return
@@ -340,6 +319,7 @@ def plot_mismatch_windows(data, clipped, mismatches, sf=100, win_sec=10, selecte
 def find_artifacts_by_power(envelopes, threshold_factor=3, min_length = 3):
     """
     Identifies continuous regions where the amplitude envelope is considered too high, likely indicating artifacts.
+    Thresholds for all bands are computed at once and a sample is flagged if any band exceeds its own threshold.
     
     Parameters:
     - envelopes: DataFrame containing the amplitude envelopes of different frequency bands.
@@ -347,41 +327,13 @@ def find_artifacts_by_power(envelopes, threshold_factor=3, min_length = 3):
     - min_length: The minimum length of consecutive points above the threshold to consider as an artifact.
     
     Returns:
-    - A list of start indices for continuous stretches above the threshold of interest.
+    - An IntervalSet with the continuous stretches above the threshold of interest.
     - A dictionary summarizing the distribution of continuous stretch lengths.
     """
-    artifact_starts = {}
-    artifact_distribution = {}
-    for band in envelopes.columns:
-        # Find where the amplitude envelope exceeds the threshold
-        mismatches = envelopes.with_columns(
-            (pl.col(band).mean() + threshold_factor * pl.col(band).std()).alias('threshold')
-            ).with_columns(
-                (pl.col('total') > pl.col('threshold')).alias('flag')
-            ).select(pl.col('flag')).to_series().to_numpy().nonzero()
-        # unlist it
-        mismatches = mismatches[0]        
-        if len(mismatches) == 0:
-            artifact_starts[band] = []
-            artifact_distribution[band] = {}
-            continue
-        # Find consecutive sequences
-        diff = np.diff(mismatches)
-        breaks = np.where(diff > 1)[0]
-        # Start indices of continuous blocks
-        start_indices = np.insert(mismatches[breaks + 1], 0, mismatches[0])
-        # End indices of continuous blocks
-        end_indices = np.append(mismatches[breaks], mismatches[-1])
-        # Lengths of continuous blocks
-        lengths = end_indices - start_indices + 1
-        # Filter blocks based on the length
-        significant_starts = start_indices[lengths >= min_length]
-        # Analyzing the distribution of mismatch lengths
-        unique_lengths, counts = np.unique(lengths, return_counts=True)
-        distribution = dict(zip(unique_lengths, counts))
-        artifact_starts[band] = significant_starts.tolist()
-        artifact_distribution[band] = distribution
-    return artifact_starts, artifact_distribution
+    power = envelopes.to_numpy()
+    threshold = power.mean(axis=0) + threshold_factor * power.std(axis=0, ddof=1)
+    flagged = IntervalSet.from_mask((power > threshold).any(axis=1))
+    return flagged.filter_min_length(min_length), flagged.length_distribution()
 
 #################################################################
 #           Run Script Stuff Below Here                         #
@@ -409,22 +361,22 @@ plt.show()
 clipped = clip_quantiles_startswith(data,
                                     lower_quantile=0.01,
                                     upper_quantile=0.99)
-start_idx, distribution = find_continuous_mismatches(data,clipped, "EEG9", n = 3)
+mismatch_intervals, distribution = find_continuous_mismatches(data,clipped, "EEG9", n = 3)
 
 sub = construct_electrode_df(data, clipped, "EEG9")
 sub = continuous_sample(sub, n=100000)
 sns.scatterplot(sub, x="original", y="clipped", alpha=0.5)
 plt.show()
-plot_mismatch_windows(data, clipped, mismatches=start_idx)
+plot_mismatch_windows(data, clipped, mismatches=mismatch_intervals)
 
 
 # Let's see this in power
 
-artifact_starts, artifact_distribution = find_artifacts_by_power(
+power_artifacts, artifact_distribution = find_artifacts_by_power(
     envelopes[['total']], threshold_factor=4)
 
 # artifacts based on power
-plot_mismatch_windows(data, clipped, mismatches = artifact_starts['total'])
+plot_mismatch_windows(data, clipped, mismatches = power_artifacts)
 
 
 
@@ -455,12 +407,12 @@ def local_std_artifacts(data, sf, win_sec, threshold=3, visualize = False):
         plt.axvline(-threshold, coloscalerr='r')
         plt.legend(frameon=False)
         plt.show(block=False)
-    if sum(art_std) > 0:
-        artifact_idx = np.where(art_std)[0]
-        return artifact_idx * sf * win_sec
-    else:
+    # return the flagged epochs as sample intervals so they compose with the other detectors
+    epoch_samples = int(sf * win_sec)
+    artifact_idx = np.flatnonzero(art_std)
+    if len(artifact_idx) == 0:
         print("No Artifacts found!!")
-        return None
+    return IntervalSet(artifact_idx * epoch_samples, (artifact_idx + 1) * epoch_samples)
 
 
 
@@ -532,4 +484,4 @@ def normalize_eegs(data, method="robust", keep_dims = True):
 scaled_clipped = normalize_eegs(clipped)
 scaled_raw = normalize_eegs(data)
 
-plot_mismatch_windows(scaled_raw, scaled_clipped, start_idx)
\ No newline at end of file
+plot_mismatch_windows(scaled_raw, scaled_clipped, mismatch_intervals)
\ No newline at end of file
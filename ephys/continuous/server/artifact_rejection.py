@@ -0,0 +1,89 @@
+import numpy as np
+from scipy.signal import hilbert, butter, sosfiltfilt
+from py_console import console
+from intervals import IntervalSet
+
+# Importable versions of the detectors explored in artifact_detection.py
+# They work on (n_channels, n_samples) arrays and return an IntervalSet in samples
+
+def epoch_view(data, epoch_samples):
+    """
+    Reshape (n_channels, n_samples) into (n_channels, n_epochs, epoch_samples) without copying.
+    Trailing samples that do not fill a full epoch are dropped, same as yasa.sliding_window.
+    """
+    epoch_samples = int(epoch_samples)
+    n_epochs = data.shape[-1] // epoch_samples
+    return data[..., :n_epochs * epoch_samples].reshape(*data.shape[:-1], n_epochs, epoch_samples)
+
+def rolling_std_artifacts(data, sf, epoch_sec, threshold=3, n_chan_reject=1):
+    """
+    Flags epochs whose log standard deviation is an outlier, same idea as yasa.art_detect(method='std').
+
+    Parameters:
+    - data: Array of shape (n_channels, n_samples).
+    - sf: Sampling frequency in Hz.
+    - epoch_sec: Epoch length in seconds (should match the staging epochs).
+    - threshold: Absolute z-score above which a channel is considered artifacted in an epoch.
+    - n_chan_reject: Minimum number of artifacted channels needed to reject an epoch.
+
+    Returns:
+    - An IntervalSet (in samples) covering the rejected epochs.
+    """
+    data = np.atleast_2d(data)
+    epoch_samples = int(epoch_sec * sf)
+    # We add 1 to avoid log warning if std is zero (e.g. flat line)
+    # (n_channels, n_epochs)
+    std_epochs = np.log(np.nanstd(epoch_view(data, epoch_samples), axis=-1) + 1)
+    c_mean = np.nanmean(std_epochs, axis=1, keepdims=True)
+    c_std = np.nanstd(std_epochs, axis=1, keepdims=True)
+    zscores = (std_epochs - c_mean) / np.where(c_std == 0, 1, c_std)
+    n_chan_supra = (np.abs(zscores) > threshold).sum(axis=0)
+    epoch_is_art = n_chan_supra >= min(n_chan_reject, data.shape[0])
+    epochs = IntervalSet.from_mask(epoch_is_art)
+    return IntervalSet(epochs.starts * epoch_samples, epochs.ends * epoch_samples)
+
+def power_envelope_artifacts(data, sf, threshold_factor=4, min_length=3):
+    """
+    Flags stretches where the broadband amplitude envelope of any channel is too high.
+
+    Parameters:
+    - data: Array of shape (n_channels, n_samples).
+    - sf: Sampling frequency in Hz.
+    - threshold_factor: The factor to multiply by the standard deviation to set the threshold.
+    - min_length: The minimum length of consecutive samples above the threshold.
+
+    Returns:
+    - An IntervalSet (in samples) with the artifacted stretches.
+    """
+    data = np.atleast_2d(data)
+    # same 'total' band as compute_hilbert() in artifact_detection.py, all channels at once
+    sos = butter(10, [0.5, sf/2 - 0.00001], btype='band', fs=sf, output='sos')
+    envelope = np.abs(hilbert(sosfiltfilt(sos, data, axis=-1), axis=-1))
+    threshold = envelope.mean(axis=1, keepdims=True) + threshold_factor * envelope.std(axis=1, ddof=1, keepdims=True)
+    flagged = IntervalSet.from_mask((envelope > threshold).any(axis=0))
+    return flagged.filter_min_length(min_length)
+
+def detect_artifacts(eeg_df, sf, epoch_sec, method="std", prefix="EEG", **kwargs):
+    """
+    Runs one of the artifact detectors on the channels of `eeg_df` starting with `prefix`.
+
+    Parameters:
+    - eeg_df: polars DataFrame with one column per channel.
+    - sf: Sampling frequency in Hz.
+    - epoch_sec: Epoch length in seconds.
+    - method: 'std' (rolling std z-score per epoch) or 'power' (amplitude envelope).
+    - kwargs: passed to the detector.
+
+    Returns:
+    - An IntervalSet (in samples) with the detected artifacts.
+    """
+    assert method in ['std', 'power'], f"Error: Artifact method must be either 'std' or 'power', received {method}"
+    columns = [col for col in eeg_df.columns if col.startswith(prefix)]
+    data = eeg_df.select(columns).to_numpy().T
+    if method == "std":
+        artifacts = rolling_std_artifacts(data, sf, epoch_sec, **kwargs)
+    else:
+        artifacts = power_envelope_artifacts(data, sf, **kwargs)
+    n_samples = data.shape[1]
+    console.info(f"Artifact detection ({method}) flagged {len(artifacts)} stretches, {100 * artifacts.total_length / n_samples:.2f}% of samples")
+    return artifacts
@@ -0,0 +1,326 @@
+import os
+import re
+import json
+import zlib
+import lzma
+import struct
+import hashlib
+import argparse
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import yaml
+from py_console import console
+
+# Lossless archive of the raw bonsai .bin files (_eeg.bin float32, _ttl_in.bin int8)
+# sub-X_ses-Y_eeg.bin -> sub-X_ses-Y_eeg.binz
+# The samples are cut in blocks of `block_samples` frames, each block is
+#   delta along time on the raw bits (unsigned integer view, wraps around so it is exact for floats)
+#   byte-shuffled (all first bytes, then all second bytes...)
+#   compressed on its own (zlib by default, lzma, or zstd when zstandard is installed)
+# and the index with the block offsets goes at the end, so any window is read
+# by decompressing only the blocks it touches.
+# Layout: MAGIC | block 0 | block 1 | ... | json index | uint64 index length | MAGIC
+
+MAGIC = b"PHDBINZ1"
+ARCHIVE_SUFFIX = ".binz"
+# 64k frames is 2.8 Mb of 11 float32 channels, ~1 min at 1 kHz
+DEFAULT_BLOCK_SAMPLES = 2**16
+# blocks kept decompressed for reads that walk through a file
+CACHED_BLOCKS = 4
+
+
+def is_archive(path):
+    return str(path).endswith(ARCHIVE_SUFFIX)
+
+def archive_path(bin_file):
+    """sub-X_ses-Y_eeg.bin -> sub-X_ses-Y_eeg.binz"""
+    return re.sub(r"\.bin$", "", bin_file) + ARCHIVE_SUFFIX
+
+def bin_sources(file_list):
+    """
+    One file per recording: listing for "_eeg.bin" also finds the .binz archives, when both
+    the .bin and its archive are there the .bin is kept (no decompression needed). Order is kept.
+    """
+    files = set(file_list)
+    return [file for file in file_list if not (is_archive(file) and re.sub(rf"{re.escape(ARCHIVE_SUFFIX)}$", ".bin", file) in files)]
+
+def _codec(codec, level=None):
+    # (compress, decompress), optional codecs are only imported when asked for
+    if codec == "zlib":
+        level = 6 if level is None else level
+        return (lambda data: zlib.compress(data, level)), zlib.decompress
+    if codec == "lzma":
+        preset = 6 if level is None else level
+        return (lambda data: lzma.compress(data, preset=preset)), lzma.decompress
+    if codec == "zstd":
+        import zstandard
+        level = 3 if level is None else level
+        return (lambda data: zstandard.ZstdCompressor(level=level).compress(data)), (lambda data: zstandard.ZstdDecompressor().decompress(data))
+    raise ValueError(f"Unknown codec `{codec}`, use zlib, lzma or zstd")
+
+def _unsigned(dtype):
+    return np.dtype(f"<u{np.dtype(dtype).itemsize}")
+
+def encode_block(block, delta=True, shuffle=True):
+    """
+    Bytes of a (n_samples, n_channels) block before compression, see decode_block().
+    """
+    bits = np.ascontiguousarray(block).view(_unsigned(block.dtype))
+    if delta and len(bits):
+        bits = np.diff(bits, axis=0, prepend=np.zeros((1, bits.shape[1]), dtype=bits.dtype))
+    data = bits.tobytes()
+    if shuffle and bits.dtype.itemsize > 1:
+        data = np.frombuffer(data, dtype=np.uint8).reshape(-1, bits.dtype.itemsize).T.tobytes()
+    return data
+
+def decode_block(data, dtype, num_channels, delta=True, shuffle=True):
+    unsigned = _unsigned(dtype)
+    if shuffle and unsigned.itemsize > 1:
+        data = np.frombuffer(data, dtype=np.uint8).reshape(unsigned.itemsize, -1).T.tobytes()
+    bits = np.frombuffer(data, dtype=unsigned).reshape(-1, num_channels)
+    if delta:
+        bits = np.cumsum(bits, axis=0, dtype=unsigned)
+    return bits.view(np.dtype(dtype).newbyteorder("<"))
+
+
+class BinArchive:
+    """
+    Read-only view of a .binz file that behaves like the (n_samples, num_channels) memmap of
+    the original .bin: len(), shape, dtype and slicing on the sample axis (archive[a:b]).
+    Only the blocks a read touches are decompressed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a bin archive")
+            f.seek(-(8 + len(MAGIC)), os.SEEK_END)
+            index_size = struct.unpack("<Q", f.read(8))[0]
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is truncated (no index at the end)")
+            f.seek(-(8 + len(MAGIC) + index_size), os.SEEK_END)
+            self.index = json.loads(f.read(index_size))
+        self.dtype = np.dtype(self.index["dtype"])
+        self.num_channels = self.index["num_channels"]
+        self.n_samples = self.index["n_samples"]
+        self.block_samples = self.index["block_samples"]
+        self.offsets = self.index["offsets"]
+        _, self._decompress = _codec(self.index["codec"])
+        self._cache = OrderedDict()
+
+    @property
+    def shape(self):
+        return (self.n_samples, self.num_channels)
+
+    def __len__(self):
+        return self.n_samples
+
+    def _block(self, block_idx):
+        if block_idx in self._cache:
+            self._cache.move_to_end(block_idx)
+            return self._cache[block_idx]
+        start, stop = self.offsets[block_idx], self.offsets[block_idx + 1]
+        with open(self.path, "rb") as f:
+            f.seek(start)
+            data = self._decompress(f.read(stop - start))
+        block = decode_block(data, self.dtype, self.num_channels, self.index["delta"], self.index["shuffle"])
+        self._cache[block_idx] = block
+        if len(self._cache) > CACHED_BLOCKS:
+            self._cache.popitem(last=False)
+        return block
+
+    def read(self, start=0, stop=None):
+        """
+        Samples [start, stop) as a (n, num_channels) array.
+        """
+        start, stop, _ = slice(start, stop).indices(self.n_samples)
+        out = np.empty((max(stop - start, 0), self.num_channels), dtype=self.dtype)
+        pos = start
+        while pos < stop:
+            block_idx = pos // self.block_samples
+            block_start = block_idx * self.block_samples
+            block = self._block(block_idx)
+            n = min(stop, block_start + len(block)) - pos
+            out[pos - start:pos - start + n] = block[pos - block_start:pos - block_start + n]
+            pos += n
+        return out
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            rows, cols = key[0], key[1:]
+            return self[rows][(slice(None),) + cols]
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.n_samples)
+            return self.read(start, stop)[::step] if step != 1 else self.read(start, stop)
+        if isinstance(key, (int, np.integer)):
+            key = key + self.n_samples if key < 0 else key
+            if not 0 <= key < self.n_samples:
+                raise IndexError(f"sample {key} out of range for {self.n_samples} samples")
+            return self.read(key, key + 1)[0]
+        raise TypeError(f"BinArchive indices must be ints or slices, not {type(key).__name__}")
+
+    def __array__(self, dtype=None, copy=None):
+        data = self.read()
+        return data.astype(dtype) if dtype is not None else data
+
+    def raw_bytes(self):
+        """
+        The original .bin, byte for byte (trailing bytes of an incomplete frame included).
+        """
+        return self.read().tobytes() + bytes.fromhex(self.index["tail"])
+
+
+def open_bin(path, num_channels, dtype=np.float32):
+    """
+    A (n_samples, num_channels) array over a demultiplexed bonsai .bin (memmap) or its .binz
+    archive (BinArchive), nothing is read until it is sliced.
+    Trailing bytes that do not make a full sample are ignored, same as read_stack_chunks().
+    """
+    if is_archive(path):
+        archive = BinArchive(path)
+        if archive.num_channels != num_channels or archive.dtype != np.dtype(dtype):
+            raise ValueError(f"{path} has {archive.num_channels} channels of {archive.dtype}, "
+                             f"expected {num_channels} of {np.dtype(dtype)}")
+        return archive
+    n_samples = os.path.getsize(path) // (np.dtype(dtype).itemsize * num_channels)
+    if n_samples == 0:
+        return np.empty((0, num_channels), dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', shape=(n_samples, num_channels))
+
+def archive_nsamples(path):
+    return BinArchive(path).n_samples
+
+def compress_bin(bin_file, num_channels, dtype=np.float32, out_file=None, block_samples=DEFAULT_BLOCK_SAMPLES,
+                 codec="zlib", level=None, delta=True, shuffle=True, n_workers=4, verify=True):
+    """
+    Write the .binz archive of a raw .bin file.
+
+    Parameters:
+    - bin_file: Demultiplexed bonsai file, (n_samples, num_channels) frames of `dtype`.
+    - out_file: Defaults to archive_path(bin_file).
+    - block_samples: Frames per compressed block (the unit of random access).
+    - codec, level: zlib (default), lzma or zstd and their compression level.
+    - n_workers: Blocks compressed at the same time (zlib, lzma and zstd release the GIL).
+    - verify: Decompress the archive and compare it with the original before returning.
+
+    Returns:
+    - The path to the archive.
+    """
+    dtype = np.dtype(dtype).newbyteorder("<")
+    out_file = out_file or archive_path(bin_file)
+    compress, _ = _codec(codec, level)
+    frame_bytes = dtype.itemsize * num_channels
+    raw_size = os.path.getsize(bin_file)
+    n_samples = raw_size // frame_bytes
+    digest = hashlib.blake2b()
+    offsets = [len(MAGIC)]
+
+    def blocks():
+        with open(bin_file, "rb") as f:
+            for start in range(0, n_samples, block_samples):
+                data = f.read(min(block_samples, n_samples - start) * frame_bytes)
+                digest.update(data)
+                yield np.frombuffer(data, dtype=dtype).reshape(-1, num_channels)
+
+    def write(future):
+        compressed = future.result()
+        out.write(compressed)
+        offsets.append(offsets[-1] + len(compressed))
+
+    part_file = out_file + ".part"
+    with open(part_file, "wb") as out, ThreadPoolExecutor(n_workers) as pool:
+        out.write(MAGIC)
+        # at most 2 blocks per worker in memory, written in order
+        pending = deque()
+        for block in blocks():
+            pending.append(pool.submit(lambda block: compress(encode_block(block, delta, shuffle)), block))
+            if len(pending) >= 2 * n_workers:
+                write(pending.popleft())
+        while pending:
+            write(pending.popleft())
+        # bytes of an incomplete last frame (bonsai stopped mid write) are kept as they are
+        with open(bin_file, "rb") as f:
+            f.seek(n_samples * frame_bytes)
+            tail = f.read()
+        digest.update(tail)
+        index = json.dumps({
+            "version": 1,
+            "dtype": dtype.str,
+            "num_channels": num_channels,
+            "n_samples": n_samples,
+            "block_samples": block_samples,
+            "codec": codec,
+            "delta": delta,
+            "shuffle": shuffle,
+            "offsets": offsets,
+            "tail": tail.hex(),
+            "raw_size": raw_size,
+            "blake2b": digest.hexdigest(),
+        }).encode()
+        out.write(index)
+        out.write(struct.pack("<Q", len(index)))
+        out.write(MAGIC)
+    if verify:
+        archive = BinArchive(part_file)
+        check = hashlib.blake2b()
+        for start in range(0, n_samples, block_samples):
+            check.update(archive.read(start, start + block_samples).tobytes())
+        check.update(tail)
+        if check.hexdigest() != archive.index["blake2b"]:
+            os.remove(part_file)
+            raise ValueError(f"Archive of {bin_file} does not match the original")
+    os.replace(part_file, out_file)
+    return out_file
+
+def decompress_bin(archive_file, out_file=None):
+    """
+    Write back the original .bin of an archive (bit-exact).
+    """
+    archive = BinArchive(archive_file)
+    out_file = out_file or re.sub(rf"{re.escape(ARCHIVE_SUFFIX)}$", ".bin", archive_file)
+    digest = hashlib.blake2b()
+    with open(out_file, "wb") as out:
+        for start in range(0, archive.n_samples, archive.block_samples):
+            data = archive.read(start, start + archive.block_samples).tobytes()
+            digest.update(data)
+            out.write(data)
+        tail = bytes.fromhex(archive.index["tail"])
+        digest.update(tail)
+        out.write(tail)
+    if digest.hexdigest() != archive.index["blake2b"]:
+        raise ValueError(f"{out_file} does not match the checksum stored in {archive_file}")
+    return out_file
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compress the raw _eeg.bin and _ttl_in.bin files of a folder (recursively) into .binz archives')
+    parser.add_argument('--folder', required=True, help='Folder with the raw files (an animal or a session folder)')
+    parser.add_argument('--config', required=True, help='config.yaml of the animal (selected_channels and ttl_names)')
+    parser.add_argument('--codec', default='zlib', choices=['zlib', 'lzma', 'zstd'])
+    parser.add_argument('--level', type=int, default=None)
+    parser.add_argument('--remove', action='store_true', help='Remove each .bin once its archive is verified')
+    args = parser.parse_args()
+    from camera_frames import count_camera_channels
+    with open(args.config) as f:
+        config = yaml.safe_load(f)
+    for root, _, files in os.walk(args.folder):
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            if name.endswith("_eeg.bin"):
+                num_channels = len(config["selected_channels"])
+                # the camera frame counters are kept as extra channels
+                num_channels += count_camera_channels(path, num_channels)
+                dtype = np.float32
+            elif name.endswith("_ttl_in.bin"):
+                num_channels, dtype = len(config["ttl_names"]), np.int8
+            else:
+                continue
+            out_file = compress_bin(path, num_channels, dtype, codec=args.codec, level=args.level)
+            console.success(f"{path} -> {out_file} ({os.path.getsize(path) / max(os.path.getsize(out_file), 1):.1f}x)")
+            if args.remove:
+                os.remove(path)
+
+if __name__ == '__main__':
+    main()
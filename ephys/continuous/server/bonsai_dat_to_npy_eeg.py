@@ -16,6 +16,7 @@ import argparse
 import datetime
 import re
 from scipy.signal import decimate
+from camera_frames import count_camera_channels
 
 def process_eeg_chunk(combined_data, config, outfilename):
     # Center data
@@ -42,6 +43,77 @@ def process_eeg_chunk(combined_data, config, outfilename):
 
 
 
+def downsampled_eeg_path(config, output_folder, session_id):
+    downsample_factor = int(config["aq_freq_hz"]/config["down_freq_hz"])
+    fn = f"desc-down{downsample_factor}_eeg.csv.gz"
+    return bids_naming(output_folder,  subject_id=config['subject_id'], session_date=session_id, filename=fn)
+
+def find_downsampled_slice(config, file_list, eeg_folder):
+    """
+    Locate the rows of an existing downsampled output (written by filter_down_bonsai_eeg on the whole eeg_folder)
+    that correspond to `file_list`, a continuous subset of the _eeg.bin files in eeg_folder.
+    Sample counts come from file sizes, nothing is read here.
+
+    Returns:
+    - (downsampled_file, start_row, n_rows, nsamples) or None if there's no output covering file_list.
+    """
+    num_channels = len(config['selected_channels'])
+    bonsai_timer_period = datetime.datetime.strptime(config["bonsai_timer_period"], "%H:%M:%S")
+    expected_delta_sec = datetime.timedelta(hours = bonsai_timer_period.hour, minutes= bonsai_timer_period.minute, seconds = bonsai_timer_period.second).total_seconds()
+    day_files = bin_sources(list_files(eeg_folder, pattern="_eeg.bin", full_names=True))
+    # same chunking as filter_down_bonsai_eeg so that we find the same outputs
+    for chunk in chunk_file_list(day_files, expected_delta_sec / 60, 1):
+        names = [os.path.basename(file) for file in chunk]
+        wanted = [os.path.basename(file) for file in file_list]
+        if wanted[0] not in names:
+            continue
+        first = names.index(wanted[0])
+        if names[first:first + len(wanted)] != wanted:
+            console.warn(f"Files do not form a continuous piece of the chunk starting at {names[0]}")
+            return None
+        session_id = re.search(r'\d{8}T\d{6}', chunk[0]).group()
+        downsampled_file = downsampled_eeg_path(config, eeg_folder, session_id)
+        if not os.path.isfile(downsampled_file):
+            return None
+        total_channels = num_channels + count_camera_channels(chunk[0], num_channels)
+        chunk_nsamples = [bin_nsamples(file, total_channels) for file in chunk]
+        nsamples = chunk_nsamples[first:first + len(wanted)]
+        offset = sum(chunk_nsamples[:first])
+        # decimate keeps samples 0, q, 2q, ... of the whole chunk
+        downsample_factor = int(config["aq_freq_hz"]/config["down_freq_hz"])
+        start_row = -(-offset // downsample_factor)
+        end_row = -(-(offset + sum(nsamples)) // downsample_factor)
+        return downsampled_file, start_row, end_row - start_row, nsamples
+    return None
+
+def slice_downsampled_eeg(config, file_list, output_folder, eeg_folder=None):
+    """
+    Write the downsampled eeg of `file_list` into output_folder by slicing the existing
+    desc-down output of the whole day instead of reading, filtering and decimating again.
+    Falls back to filter_down_bonsai_eeg() if no existing output covers the files.
+
+    Returns:
+    - outfilename and the nsamples of each file in file_list.
+    """
+    if eeg_folder is None:
+        eeg_folder = os.path.dirname(file_list[0])
+    found = find_downsampled_slice(config, file_list, eeg_folder)
+    if found is None:
+        console.warn(f"No downsampled output in {eeg_folder} covers these files. Filtering and downsampling them")
+        _, nsamples_dict = filter_down_bonsai_eeg(config, file_list, output_folder)
+        return next(iter(nsamples_dict.items()))
+    downsampled_file, start_row, n_rows, nsamples = found
+    session_id = re.search(r'\d{8}T\d{6}', file_list[0]).group()
+    outfilename = downsampled_eeg_path(config, output_folder, session_id)
+    console.info(f"Slicing rows {start_row}:{start_row + n_rows} of {downsampled_file}")
+    eeg_df = pl.scan_csv(downsampled_file).slice(start_row, n_rows).collect()
+    if eeg_df.height != n_rows:
+        console.warn(f"Expected {n_rows} rows but {downsampled_file} only had {eeg_df.height}")
+    console.warn("Using pandas due to polars #13227")
+    eeg_df.to_pandas().to_csv(outfilename, index=False)
+    console.success(f"Downsampled data written to {outfilename}")
+    return outfilename, nsamples
+
 def filter_down_bonsai_eeg(config, file_list, output_folder):
     # Parse config for params
     subject_id = config["subject_id"]
@@ -50,17 +122,11 @@ def filter_down_bonsai_eeg(config, file_list, output_folder):
     #total_lines = line_count(eeg_file)
     #console.info(f"{eeg_file} has {total_lines} total lines")
     num_channels = len(config['selected_channels'])
-    ## look for camera saved as an integer at the start or end of the sequence
-    ## because the sampling rate is so high, the frames will be repeated so we can use this fact
-    ## we read 2 samples from each channel and the frames that correspond to those
-    #head = np.fromfile(eeg_file, dtype=np.float32,count=(num_channels + 1) * 2)
-    ## we reshape to 2 columns for easier subtraction
-    #two_col = head.reshape(2, (num_channels + 1)).T
-    #has_camera = any(np.subtract(two_col[:, 0], two_col[:, 1]) == 0)
-    #
-    #if has_camera:
-    #  num_channels = num_channels + 1
-    #  console.info(f"camera frame present in dataset, new channel_num is {num_channels}", severe=True)
+    # look for camera frame counters saved at the end of the sequence
+    # these are split from the eeg while reading (see camera_frames.py)
+    camera_channels = count_camera_channels(file_list[0], num_channels)
+    if camera_channels:
+        console.info("camera frame present in dataset, frames will be indexed in _camframes.csv.gz", severe=True)
 
     num_files = len(file_list)
     ## Chunk the file list
@@ -76,12 +142,10 @@ def filter_down_bonsai_eeg(config, file_list, output_folder):
     for chunk_idx, chunk in enumerate(chunks):
         console.log(f"Working on chunk {chunk_idx + 1}/{len(chunks)}")
         # Iterate over the files and combine data
-        combined_data, nsamples = read_stack_chunks(chunk, num_channels, return_nsamples=True)
+        combined_data, nsamples = read_stack_chunks(chunk, num_channels, return_nsamples=True, camera_channels=camera_channels)
         # use the first timestamp of the session for each chunk
         session_id = re.search(r'\d{8}T\d{6}', chunk[0]).group()
-        downsample_factor = int(config["aq_freq_hz"]/config["down_freq_hz"])
-        fn = f"desc-down{downsample_factor}_eeg.csv.gz"
-        outfilename = bids_naming(output_folder,  subject_id=config['subject_id'], session_date=session_id, filename=fn)
+        outfilename = downsampled_eeg_path(config, output_folder, session_id)
         # actually filter and downsample each chunk
         eeg_downsampled, outfilename = process_eeg_chunk(combined_data, config, outfilename)  
         # Store the output filename as key, the data as value
@@ -113,7 +177,7 @@ if __name__ == '__main__':
         config_folder = ephys_folder
     # Now you can use ephys_folder and config_folder in your script
     console.info(f"Working on {ephys_folder}")
-    file_list = list_files(ephys_folder, pattern="_eeg.bin", full_names=True)
+    file_list = bin_sources(list_files(ephys_folder, pattern="_eeg.bin", full_names=True))
     config = read_config(config_folder)
     assert config['down_freq_hz'] is not None, "No down_freq_hz in config. Exiting function"
     assert config["aq_freq_hz"] > config["down_freq_hz"], f"{config['aq_freq_hz']} must be greater than {config['down_freq_hz']}"
@@ -0,0 +1,136 @@
+import os
+import re
+import numpy as np
+import pandas as pd
+from py_console import console
+from bin_archive import open_bin, is_archive, BinArchive
+
+# Bonsai can append camera frame counters as extra float32 channels at the end of _eeg.bin
+# Instead of a full-rate _camframes.npy, we keep a run-length index: one row per frame
+# with the sample where it starts, so frame <-> sample lookups are a np.searchsorted
+
+DEFAULT_BLOCK_SAMPLES = 2**22
+
+
+def count_camera_channels(eeg_file, num_channels, dtype=np.float32, n_check=4096):
+    """
+    Detect a camera frame counter after the `num_channels` EEG channels.
+
+    The sampling rate is much higher than the frame rate, so the frame number repeats on
+    consecutive samples while EEG values practically never do. We read `n_check` samples
+    assuming one extra channel and look for a last column that repeats, only goes up
+    and does change (a flat channel is not a counter).
+
+    A .binz archive knows its number of channels, the extra ones are the camera counters.
+
+    Returns:
+    - 1 if a camera channel is present, 0 otherwise (the number of extra channels for an archive).
+    """
+    if is_archive(eeg_file):
+        return max(BinArchive(eeg_file).num_channels - num_channels, 0)
+    head = np.fromfile(eeg_file, dtype=dtype, count=(num_channels + 1) * n_check)
+    n_samples = len(head) // (num_channels + 1)
+    if n_samples < 2:
+        return 0
+    candidate = head[:n_samples * (num_channels + 1)].reshape(n_samples, num_channels + 1)[:, -1]
+    steps = np.diff(candidate)
+    is_counter = np.all(candidate == np.round(candidate)) and np.all(steps >= 0) and np.any(steps > 0)
+    return int(is_counter and np.mean(steps == 0) > 0.5)
+
+def frame_runs(frames, offset=0, prev_frame=None):
+    """
+    Run-length encode a frame counter.
+
+    Parameters:
+    - frames: 1D array of frame numbers, one per sample.
+    - offset: Sample index of frames[0] (e.g. samples in previous blocks).
+    - prev_frame: Frame number right before frames[0], a run that continues is not split.
+
+    Returns:
+    - frame, start_sample: Arrays with one value per new run.
+    """
+    frames = np.asarray(frames)
+    if len(frames) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    new_run = np.empty(len(frames), dtype=bool)
+    new_run[0] = prev_frame is None or frames[0] != prev_frame
+    new_run[1:] = frames[1:] != frames[:-1]
+    starts = np.flatnonzero(new_run)
+    return frames[starts].astype(np.int64), starts + offset
+
+def read_demux(eeg_file, num_channels, n_cam=1, dtype=np.float32, block_samples=DEFAULT_BLOCK_SAMPLES):
+    """
+    Read a _eeg.bin splitting the EEG channels from the camera frame counters in one pass.
+
+    The file is memory mapped and processed in blocks, the EEG goes straight into its
+    (num_channels, n_samples) output (no np.delete copy) and the counters only into the index.
+
+    Returns:
+    - eeg: float32 array of shape (num_channels, n_samples), same as read_stack_chunks().
+    - frame_index: DataFrame with columns camera, frame, start_sample, n_samples.
+    """
+    total_channels = num_channels + n_cam
+    data = open_bin(eeg_file, total_channels, dtype)
+    n_samples = len(data)
+    eeg = np.empty((num_channels, n_samples), dtype=dtype)
+    runs = [[] for _ in range(n_cam)]
+    prev_frames = [None] * n_cam
+    for start in range(0, n_samples, block_samples):
+        block = np.asarray(data[start:start + block_samples])
+        eeg[:, start:start + len(block)] = block[:, :num_channels].T
+        for cam in range(n_cam):
+            frames = block[:, num_channels + cam]
+            runs[cam].append(frame_runs(frames, offset=start, prev_frame=prev_frames[cam]))
+            prev_frames[cam] = frames[-1]
+    tables = []
+    for cam in range(n_cam):
+        frame = np.concatenate([r[0] for r in runs[cam]]) if runs[cam] else np.empty(0, dtype=np.int64)
+        start_sample = np.concatenate([r[1] for r in runs[cam]]) if runs[cam] else np.empty(0, dtype=np.int64)
+        tables.append(pd.DataFrame({
+            'camera': np.full(len(frame), cam + 1, dtype=np.int8),
+            'frame': frame,
+            'start_sample': start_sample,
+            'n_samples': np.diff(start_sample, append=n_samples),
+        }))
+    frame_index = pd.concat(tables, ignore_index=True) if tables else pd.DataFrame(columns=['camera', 'frame', 'start_sample', 'n_samples'])
+    return eeg, frame_index
+
+def camera_index_path(eeg_file):
+    # sub-X_ses-Y_eeg.bin (or .binz) -> sub-X_ses-Y_camframes.csv.gz
+    return re.sub(r"_eeg\.binz?$", "_camframes.csv.gz", eeg_file)
+
+def write_camera_index(eeg_file, frame_index):
+    outfile = camera_index_path(eeg_file)
+    frame_index.to_csv(outfile, index=False)
+    console.success(f"Saved camera frame index ({len(frame_index)} frames) as {outfile}")
+    return outfile
+
+def read_camera_index(eeg_file):
+    return pd.read_csv(camera_index_path(eeg_file), dtype={'camera': np.int8})
+
+def _camera_runs(frame_index, camera):
+    runs = frame_index[frame_index['camera'] == camera]
+    return runs['frame'].to_numpy(), runs['start_sample'].to_numpy(), runs['n_samples'].to_numpy()
+
+def frame_to_sample(frame_index, frames, camera=1):
+    """
+    First EEG sample of each frame (-1 if the frame was never seen). Vectorized, O(log n) per frame.
+    """
+    frame, start_sample, _ = _camera_runs(frame_index, camera)
+    frames = np.asarray(frames, dtype=np.int64)
+    if len(frame) == 0:
+        return np.full(frames.shape, -1, dtype=np.int64)
+    # counters only go up, but a frame could repeat after a camera restart, use its first run
+    order = np.argsort(frame, kind='stable')
+    idx = np.clip(np.searchsorted(frame[order], frames), 0, len(frame) - 1)
+    found = frame[order][idx] == frames
+    return np.where(found, start_sample[order][idx], -1)
+
+def sample_to_frame(frame_index, samples, camera=1):
+    """
+    Frame on screen at each EEG sample (-1 before the first frame). Vectorized, O(log n) per sample.
+    """
+    frame, start_sample, _ = _camera_runs(frame_index, camera)
+    samples = np.asarray(samples, dtype=np.int64)
+    idx = np.searchsorted(start_sample, samples, side='right') - 1
+    return np.where(idx >= 0, frame[np.clip(idx, 0, None)] if len(frame) else -1, -1)
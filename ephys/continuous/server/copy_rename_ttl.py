@@ -1,6 +1,7 @@
 import argparse
 import shutil
 from utils import list_files
+from session_catalog import find_files
 from py_console import console
 import os
 from pathlib import Path
@@ -19,7 +20,13 @@ def rename_ttl_files(copy_from, copy_to, force_copy):
             console.info(f"Copying {file} into {new_file}")
             shutil.copy(file, new_file)
 
-def copy_rename_ttl(nas_path, from_id, to_id, force_copy):
+def copy_rename_ttl(nas_path, from_id, to_id, force_copy, catalog=None):
+    if catalog is not None:
+        # ttl files of from_id straight from the session catalog
+        files = [file for file in find_files(catalog, animal=from_id, pattern="ttl")
+                 if os.path.basename(os.path.dirname(file)) == "ttl" and file.startswith(os.path.join(nas_path, from_id))]
+        rename_ttl_files(files, [file.replace(from_id, to_id) for file in files], force_copy)
+        return
     # use pathlib to list the directories inside joining nas_path and from_id
     source_dir = Path(nas_path) / from_id
     # these are the recorded sessions for each date
@@ -41,9 +48,10 @@ if __name__ == "__main__":
     parser.add_argument("--from_id", help="Id of animal that contains the original copy of ttls")
     parser.add_argument("--to_id", help="Id of animal ran with `from_id`")
     parser.add_argument("--force_copy", help="If files already exist, we will not copy unless forced", default=False)
+    parser.add_argument("--catalog", help="Session catalog (see session_catalog.py) to query instead of listing the NAS folders", default=None)
     args = parser.parse_args()
     # print information about the call using console.info
     console.info(f"Nas path is {nas_path}")
     console.info(f"Copying and renaming TTL files from {args.from_id} to {args.to_id}")
     # Call the copy_rename_ttl function with the provided directory paths
-    copy_rename_ttl(nas_path = nas_path, from_id = args.from_id, to_id = args.to_id, force_copy = args.force_copy)
+    copy_rename_ttl(nas_path = nas_path, from_id = args.from_id, to_id = args.to_id, force_copy = args.force_copy, catalog = args.catalog)
@@ -1,46 +1,44 @@
+from ttl_events import load_chunk_events, select_edges, RISING, FALLING
 file = ["/synology-nas/MLA/beelink1/MLA148/2023-12-03/ttl/sub-MLA148_ses-20231203T144807_ttl_in.bin"]
-ttl2, ttl2_samples = read_stack_chunks(file, 8, np.int8, True)
-ttl2_array = normalize_ttl(ttl2, method="max")
+# read the edge table instead of the int8 samples (extracted once if missing)
+ttl_names = [f"ttl{i}" for i in range(8)]
+ttl2_events, ttl2_samples = load_chunk_events(file, ttl_names)
 
-pulse_onset = np.where(np.diff(ttl2_array[0,:], prepend=0) > 0)[0]
+pulse_onset = select_edges(ttl2_events, 0, RISING)
+pulse_offset = select_edges(ttl2_events, 0, FALLING)
 
 import matplotlib.pyplot as plt
 
 plt.figure()
-plt.plot(ttl2_array[0,:])
+plt.vlines(pulse_onset, 0, 1, color='k')
 plt.show(block = False)
 
 
 block1_dir = ["/synology-nas/MLA/TDT/PhotoOptoRandTrialsTTL2Box-230412-115924/MLA147148-231203-110016/"]
 block2_dir = ["/synology-nas/MLA/TDT/PhotoOptoRandTrialsTTL2Box-230412-115924/MLA147148-231203-150659/"]
 
-import tdt
+from tdt_matching import read_tdt_block_info
 
-block1 = tdt.read_block(block1_dir[0], t1=0, t2=1)
-block2 = tdt.read_block(block2_dir[0], t1=0, t2=1)
+# start date and pulse-sync onsets from the block index (the blocks are only parsed the first time)
+block1 = read_tdt_block_info(block1_dir[0], pulse_sync_name)
+block2 = read_tdt_block_info(block2_dir[0], pulse_sync_name)
 
-block1_onset = tdt.read_block(block1_dir[0], store = fix_tdt_names(pulse_sync_name, '/')).epocs[fix_tdt_names(pulse_sync_name, '_')].onset
-block2_onset = tdt.read_block(block2_dir[0], store = fix_tdt_names(pulse_sync_name, '/')).epocs[fix_tdt_names(pulse_sync_name, '_')].onset
+block1_onset = block1["pulse_onset"]
+block2_onset = block2["pulse_onset"]
 
-block1_timestamps = block1.info.start_date
+block1_timestamps = block1["start_date"]
 
 import polars as pl
 block1_df = pl.DataFrame({"onset_sec": block1_onset})
-
+# vectorized start_date + onset (no python function per row)
 block1_df = block1_df.with_columns(
-    pl.col("onset_sec").apply(
-        lambda x: 
-        datetime.timedelta(seconds = x) + 
-        block1.info.start_date).alias("datetime")
-        )
+    (pl.lit(block1["start_date"]) + pl.duration(microseconds=(pl.col("onset_sec") * 1e6).cast(pl.Int64))).alias("datetime")
+    )
 
 block2_df = pl.DataFrame({"onset_sec": block2_onset})
-block2_df = block1_df.with_columns(
-    pl.col("onset_sec").apply(
-        lambda x: 
-        datetime.timedelta(seconds = x) + 
-        block2.info.start_date).alias("datetime")
-        )
+block2_df = block2_df.with_columns(
+    (pl.lit(block2["start_date"]) + pl.duration(microseconds=(pl.col("onset_sec") * 1e6).cast(pl.Int64))).alias("datetime")
+    )
 
 df = pl.concat([block1_df, block2_df])
 
@@ -0,0 +1,326 @@
+import os
+import re
+import json
+import time
+import argparse
+import datetime
+import numpy as np
+import pandas as pd
+import mne
+from scipy.signal import firwin, oaconvolve
+from py_console import console
+from utils import read_config, read_stack_chunks, find_channels, create_channel_map
+from camera_frames import count_camera_channels
+from bonsai_dat_to_npy_eeg import downsampled_eeg_path
+
+# Ingest daemon: follows the mover's finalized.jsonl (bonsai/bonsai_sketches/file_mover.py)
+# and runs read -> filter -> decimate on each _eeg.bin as soon as it lands on the NAS.
+# Filter state is carried from file to file so the appended desc-down output is the same
+# as filter_down_bonsai_eeg() on the whole chunk (except for the first and last samples,
+# where the batch version pads and we do not).
+
+
+def decimation_taps(q):
+    # same FIR as scipy.signal.decimate(x, q, ftype='fir')
+    return firwin(20 * q + 1, 1. / q, window='hamming')
+
+def bandpass_taps(sf, l_freq, h_freq):
+    # same FIR as mne.filter.filter_data() with its defaults (zero phase, firwin)
+    return mne.filter.create_filter(None, sf, l_freq, h_freq, verbose=0)
+
+def _pad_taps(taps, length):
+    pad = (length - len(taps)) // 2
+    return np.pad(taps, (pad, pad))
+
+def pipeline_taps(config):
+    """
+    Combined bandpass + anti-aliasing taps for each channel, the same filters process_eeg_chunk() applies.
+    EEG and EMG taps are zero padded to the same (odd) length so every channel has the same delay.
+
+    Returns:
+    - taps: (n_channels, n_taps) float64 array.
+    - q: Decimation factor.
+    """
+    sf = config["aq_freq_hz"]
+    q = int(config["aq_freq_hz"] / config["down_freq_hz"])
+    num_channels = len(config["selected_channels"])
+    emg_channels = find_channels(config, "EMG")
+    emg_channels = [] if emg_channels is None else list(emg_channels)
+    eeg_band, emg_band = config["bandpass"]["eeg"], config["bandpass"]["emg"]
+    decim = decimation_taps(q)
+    eeg = np.convolve(bandpass_taps(sf, min(eeg_band), max(eeg_band)), decim)
+    emg = np.convolve(bandpass_taps(sf, min(emg_band), max(emg_band)), decim)
+    length = max(len(eeg), len(emg))
+    taps = np.stack([_pad_taps(emg if ch in emg_channels else eeg, length) for ch in range(num_channels)])
+    return taps, q
+
+
+class StreamingDecimator:
+    """
+    Zero-phase FIR filter + decimation by q over consecutive blocks of samples.
+
+    Output m is sum_k taps[k] * x[m * q + c - k] with c = (n_taps - 1) // 2, x = 0 before the
+    first sample. The last n_taps - 1 input samples are kept between push() calls, so blocks
+    can have any length and the output does not depend on where the files were cut.
+
+    Parameters:
+    - taps: (n_channels, n_taps) array, see pipeline_taps().
+    - q: Decimation factor.
+    """
+
+    def __init__(self, taps, q):
+        self.taps = np.asarray(taps, dtype=np.float64)
+        self.q = q
+        self.n_taps = self.taps.shape[1]
+        self.delay = (self.n_taps - 1) // 2
+        # buf holds x[b0:b0 + buf.shape[1]]
+        self.buf = np.zeros((self.taps.shape[0], self.n_taps - 1))
+        self.b0 = -(self.n_taps - 1)
+        self.n_in = 0
+        self.n_out = 0
+        self.offset = None
+
+    def push(self, block):
+        """
+        Add (n_channels, n_samples) samples, returns the (n_channels, n_new) outputs that are complete.
+        """
+        block = np.asarray(block, dtype=np.float64)
+        if block.shape[1] == 0:
+            return np.empty((self.buf.shape[0], 0))
+        if self.offset is None:
+            # the batch version centers the data, the bandpass removes the rest
+            self.offset = block.mean(axis=1, keepdims=True)
+        self.n_in += block.shape[1]
+        return self._run(block - self.offset)
+
+    def flush(self):
+        """
+        Outputs for the last samples (as if the input were followed by zeros), up to ceil(n_in / q) in total.
+        """
+        n_total = -(-self.n_in // self.q)
+        n_out = self.n_out
+        out = self._run(np.zeros((self.buf.shape[0], self.delay + self.q)))
+        self.n_out = max(n_total, n_out)
+        return out[:, :max(n_total - n_out, 0)]
+
+    def _run(self, block):
+        buf = np.concatenate([self.buf, block], axis=1)
+        # causal output z[n] is at n = b0 + n_taps - 1 + j of the 'valid' convolution,
+        # output m needs z[m * q + delay]
+        first_n = self.b0 + self.n_taps - 1
+        last_n = self.b0 + buf.shape[1] - 1
+        m_end = (last_n - self.delay) // self.q + 1 if last_n >= self.delay else 0
+        if m_end > self.n_out:
+            j0 = self.n_out * self.q + self.delay - first_n
+            j1 = (m_end - 1) * self.q + self.delay - first_n
+            # only the part of buf the needed outputs depend on
+            z = oaconvolve(buf[:, j0:j1 + self.n_taps], self.taps, mode='valid', axes=1)
+            out = z[:, ::self.q]
+            self.n_out = m_end
+        else:
+            out = np.empty((buf.shape[0], 0))
+        keep = self.n_taps - 1
+        self.buf = buf[:, -keep:]
+        self.b0 = self.b0 + buf.shape[1] - keep
+        return out
+
+    def state(self):
+        return {"buf": self.buf, "b0": self.b0, "n_in": self.n_in, "n_out": self.n_out,
+                "offset": self.offset if self.offset is not None else np.empty((0, 1))}
+
+    def load_state(self, state):
+        self.buf = np.asarray(state["buf"])
+        self.b0, self.n_in, self.n_out = int(state["b0"]), int(state["n_in"]), int(state["n_out"])
+        self.offset = np.asarray(state["offset"]) if np.size(state["offset"]) else None
+
+
+def timer_period_sec(config):
+    period = datetime.datetime.strptime(config["bonsai_timer_period"], "%H:%M:%S")
+    return datetime.timedelta(hours=period.hour, minutes=period.minute, seconds=period.second).total_seconds()
+
+def file_session_time(eeg_file):
+    return datetime.datetime.strptime(re.search(r"\d{8}T\d{6}", os.path.basename(eeg_file)).group(), "%Y%m%dT%H%M%S")
+
+
+class IngestSession:
+    """
+    One continuous piece of recording of an animal (same rule as chunk_file_list, same output
+    name as filter_down_bonsai_eeg). Files are appended to its desc-down output as they arrive,
+    the decimator state is saved next to the output so the daemon can be restarted.
+    """
+
+    def __init__(self, config, first_file):
+        self.config = config
+        self.eeg_folder = os.path.dirname(first_file)
+        self.session_id = re.search(r"\d{8}T\d{6}", os.path.basename(first_file)).group()
+        self.outfile = downsampled_eeg_path(config, self.eeg_folder, self.session_id)
+        self.num_channels = len(config["selected_channels"])
+        self.camera_channels = count_camera_channels(first_file, self.num_channels)
+        taps, q = pipeline_taps(config)
+        self.decimator = StreamingDecimator(taps, q)
+        self.files = []
+        self.last_time = None
+        # wall clock time of the last append, the rig clock can be off
+        self.last_append = None
+
+    @property
+    def state_file(self):
+        return self.outfile + ".ingest.npz"
+
+    def continues(self, eeg_file, tolerance_sec=60):
+        if os.path.dirname(eeg_file) != self.eeg_folder:
+            return False
+        delta = (file_session_time(eeg_file) - self.last_time).total_seconds()
+        return abs(delta - timer_period_sec(self.config)) <= tolerance_sec
+
+    def append(self, eeg_file):
+        data, nsamples = read_stack_chunks([eeg_file], self.num_channels, return_nsamples=True, camera_channels=self.camera_channels)
+        self._write(self.decimator.push(data))
+        self.files.append(os.path.basename(eeg_file))
+        self.last_time = file_session_time(eeg_file)
+        self.last_append = time.time()
+        self.save_state()
+        console.success(f"Appended {os.path.basename(eeg_file)} ({nsamples[0]} samples) to {self.outfile}")
+
+    def close(self):
+        self._write(self.decimator.flush())
+        if os.path.exists(self.state_file):
+            os.remove(self.state_file)
+        console.success(f"Closed {self.outfile} ({self.decimator.n_out} rows from {len(self.files)} files)")
+
+    def _write(self, data_down):
+        if data_down.shape[1] == 0:
+            return
+        header = not os.path.exists(self.outfile)
+        eeg_df = pd.DataFrame(data_down.T, columns=create_channel_map(data_down, self.config))
+        # gzip members can be concatenated, appending does not rewrite what is there
+        eeg_df.to_csv(self.outfile, index=False, mode='w' if header else 'a', header=header)
+
+    def save_state(self):
+        tmp = self.state_file + ".tmp.npz"
+        np.savez(tmp, files=np.array(self.files), last_time=self.last_time.isoformat(), last_append=self.last_append,
+                 camera_channels=self.camera_channels, **self.decimator.state())
+        os.replace(tmp, self.state_file)
+
+    @classmethod
+    def restore(cls, config, state_file):
+        state = np.load(state_file)
+        files = list(state["files"])
+        eeg_folder = os.path.dirname(state_file)
+        session = cls(config, os.path.join(eeg_folder, files[0]))
+        session.decimator.load_state(state)
+        session.files = files
+        session.camera_channels = int(state["camera_channels"])
+        session.last_time = datetime.datetime.fromisoformat(str(state["last_time"]))
+        session.last_append = float(state["last_append"])
+        return session
+
+
+def read_journal(journal_file, offset=0):
+    """
+    New entries of the mover's finalized.jsonl from byte `offset` on.
+    A half written last line is left for the next call.
+
+    Returns:
+    - entries (list of dicts) and the offset to use next time.
+    """
+    if not os.path.exists(journal_file):
+        return [], offset
+    if os.path.getsize(journal_file) < offset:
+        console.warn(f"{journal_file} got shorter, reading it from the start")
+        offset = 0
+    with open(journal_file, "rb") as f:
+        f.seek(offset)
+        data = f.read()
+    end = data.rfind(b"\n") + 1
+    entries = [json.loads(line) for line in data[:end].splitlines() if line.strip()]
+    return entries, offset + end
+
+
+class IngestDaemon:
+    """
+    Parameters:
+    - root: Folder with one subfolder per animal (with its config.yaml), the database_path of the mover.
+    - journal_file: The mover's finalized.jsonl (default <root>/finalized.jsonl).
+    - state_file: Where the journal offset and the open sessions are kept (default <root>/.ingest_state.json).
+    """
+
+    def __init__(self, root, journal_file=None, state_file=None):
+        self.root = root
+        self.journal_file = journal_file or os.path.join(root, "finalized.jsonl")
+        self.state_file = state_file or os.path.join(root, ".ingest_state.json")
+        self.offset = 0
+        self.sessions = {}
+        self.configs = {}
+        if os.path.exists(self.state_file):
+            with open(self.state_file) as f:
+                state = json.load(f)
+            self.offset = state["offset"]
+            for animal, session_state in state["sessions"].items():
+                if os.path.exists(session_state):
+                    self.sessions[animal] = IngestSession.restore(self.config(animal), session_state)
+
+    def config(self, animal):
+        if animal not in self.configs:
+            config = read_config(os.path.join(self.root, animal))
+            config.setdefault("subject_id", animal)
+            self.configs[animal] = config
+        return self.configs[animal]
+
+    def handle(self, eeg_file):
+        animal = os.path.relpath(eeg_file, self.root).split(os.sep)[0]
+        session = self.sessions.get(animal)
+        if session is not None and eeg_file.endswith(tuple(session.files)):
+            console.warn(f"{os.path.basename(eeg_file)} was already ingested, skipping")
+            return
+        if session is not None and not session.continues(eeg_file):
+            session.close()
+            session = None
+        if session is None:
+            session = IngestSession(self.config(animal), eeg_file)
+            self.sessions[animal] = session
+        session.append(eeg_file)
+
+    def close_idle(self, now=None):
+        # the next file is closed one timer period after the last one started and needs some time
+        # to be copied, if nothing came after three periods the recording stopped
+        now = now or time.time()
+        for animal, session in list(self.sessions.items()):
+            if now - session.last_append > 3 * timer_period_sec(session.config):
+                session.close()
+                del self.sessions[animal]
+
+    def poll(self):
+        entries, self.offset = read_journal(self.journal_file, self.offset)
+        for entry in entries:
+            if entry["path"].endswith("_eeg.bin"):
+                eeg_file = os.path.join(self.root, *entry["path"].split("/"))
+                try:
+                    self.handle(eeg_file)
+                except Exception as e:
+                    console.error(f"Failed to ingest {eeg_file}: {e}")
+        self.close_idle()
+        self.save_state()
+        return len(entries)
+
+    def save_state(self):
+        state = {"offset": self.offset, "sessions": {animal: session.state_file for animal, session in self.sessions.items()}}
+        tmp = self.state_file + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp, self.state_file)
+
+    def run(self, poll_sec=10):
+        console.info(f"Following {self.journal_file}")
+        while True:
+            self.poll()
+            time.sleep(poll_sec)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Filter and downsample _eeg.bin files as soon as the mover finalizes them")
+    parser.add_argument("--root", default="/synology-nas/MLA/beelink1", help="Folder with one subfolder per animal (the mover's database_path)")
+    parser.add_argument("--journal", default=None, help="finalized.jsonl written by file_mover.py (default <root>/finalized.jsonl)")
+    parser.add_argument("--poll_sec", type=float, default=10, help="Seconds between journal checks")
+    args = parser.parse_args()
+    IngestDaemon(args.root, args.journal).run(args.poll_sec)
@@ -0,0 +1,192 @@
+import numpy as np
+
+
+class IntervalSet:
+    """
+    A set of half-open sample intervals [start, end) backed by two int64 numpy arrays.
+
+    Intervals are always kept sorted, non-overlapping and non-adjacent
+    (touching intervals are merged), which lets every query use np.searchsorted
+    instead of looping over individual intervals.
+
+    Parameters:
+    - starts: Array-like of interval start indices (inclusive).
+    - ends: Array-like of interval end indices (exclusive).
+    """
+
+    def __init__(self, starts=(), ends=()):
+        starts = np.asarray(starts, dtype=np.int64).ravel()
+        ends = np.asarray(ends, dtype=np.int64).ravel()
+        assert starts.shape == ends.shape, "starts and ends must have the same length"
+        assert np.all(ends >= starts), "Every interval must have end >= start"
+        self.starts, self.ends = self._normalize(starts, ends)
+
+    @staticmethod
+    def _normalize(starts, ends):
+        # drop empty intervals, sort, and merge overlapping/touching ones
+        keep = ends > starts
+        starts, ends = starts[keep], ends[keep]
+        if len(starts) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        order = np.argsort(starts, kind="stable")
+        starts, ends = starts[order], ends[order]
+        # running max of the ends tells us if the next interval starts inside the previous block
+        running_end = np.maximum.accumulate(ends)
+        new_block = np.empty(len(starts), dtype=bool)
+        new_block[0] = True
+        new_block[1:] = starts[1:] > running_end[:-1]
+        block_idx = np.flatnonzero(new_block)
+        merged_starts = starts[block_idx]
+        # the end of each block is the running max right before the next block starts
+        merged_ends = running_end[np.append(block_idx[1:] - 1, len(starts) - 1)]
+        return merged_starts, merged_ends
+
+    @classmethod
+    def from_mask(cls, mask):
+        """
+        Run-length encode a boolean mask into intervals of consecutive True values.
+
+        Parameters:
+        - mask: 1D boolean array (e.g. samples flagged as artifact).
+
+        Returns:
+        - An IntervalSet with one interval per run of True values.
+        """
+        mask = np.asarray(mask, dtype=bool).ravel()
+        edges = np.diff(mask.astype(np.int8), prepend=0, append=0)
+        return cls(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1))
+
+    @classmethod
+    def from_indices(cls, indices):
+        """
+        Build intervals from a sorted or unsorted array of flagged sample indices.
+        Consecutive indices collapse into a single interval.
+        """
+        indices = np.unique(np.asarray(indices, dtype=np.int64))
+        if len(indices) == 0:
+            return cls()
+        breaks = np.flatnonzero(np.diff(indices) > 1)
+        starts = np.insert(indices[breaks + 1], 0, indices[0])
+        ends = np.append(indices[breaks], indices[-1]) + 1
+        return cls(starts, ends)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        return zip(self.starts.tolist(), self.ends.tolist())
+
+    def __eq__(self, other):
+        if not isinstance(other, IntervalSet):
+            return NotImplemented
+        return np.array_equal(self.starts, other.starts) and np.array_equal(self.ends, other.ends)
+
+    def __repr__(self):
+        return f"IntervalSet(n={len(self)}, total_length={self.total_length})"
+
+    def __or__(self, other):
+        return self.union(other)
+
+    def __and__(self, other):
+        return self.intersection(other)
+
+    @property
+    def lengths(self):
+        return self.ends - self.starts
+
+    @property
+    def total_length(self):
+        return int(self.lengths.sum())
+
+    def length_distribution(self):
+        """
+        Summarize the lengths of the intervals.
+
+        Returns:
+        - A dictionary of {length: count}, same format the old mismatch scans produced.
+        """
+        unique_lengths, counts = np.unique(self.lengths, return_counts=True)
+        return dict(zip(unique_lengths.tolist(), counts.tolist()))
+
+    def union(self, other):
+        return IntervalSet(np.concatenate([self.starts, other.starts]),
+                           np.concatenate([self.ends, other.ends]))
+
+    def intersection(self, other):
+        # sweep over all boundaries: +1 at starts, -1 at ends
+        # both sets are normalized, so a coverage of 2 means both sets overlap
+        positions = np.concatenate([self.starts, other.starts, self.ends, other.ends])
+        deltas = np.concatenate([np.ones(len(self) + len(other), dtype=np.int8),
+                                 -np.ones(len(self) + len(other), dtype=np.int8)])
+        # at ties, ends (-1) go before starts (+1) because intervals are half-open
+        order = np.lexsort((deltas, positions))
+        positions = positions[order]
+        coverage = np.cumsum(deltas[order])
+        both = np.flatnonzero(coverage == 2)
+        return IntervalSet(positions[both], positions[both + 1])
+
+    def filter_min_length(self, min_length):
+        """Keep only intervals with at least `min_length` samples."""
+        keep = self.lengths >= min_length
+        return IntervalSet(self.starts[keep], self.ends[keep])
+
+    def dilate(self, before, after=None, limit=None):
+        """
+        Grow every interval by `before` samples on the left and `after` samples on the right.
+        Intervals that end up overlapping are merged.
+
+        Parameters:
+        - before: Number of samples to extend each start.
+        - after: Number of samples to extend each end. Defaults to `before`.
+        - limit: Optional upper bound (e.g. number of samples in the recording).
+        """
+        if after is None:
+            after = before
+        starts = np.maximum(self.starts - before, 0)
+        ends = self.ends + after
+        if limit is not None:
+            ends = np.minimum(ends, limit)
+        return IntervalSet(starts, np.maximum(ends, starts))
+
+    def contains(self, points):
+        """
+        Vectorized membership query.
+
+        Parameters:
+        - points: Scalar or array of sample indices.
+
+        Returns:
+        - Boolean array (or bool for scalars) with True where the point falls inside an interval.
+        """
+        points = np.asarray(points, dtype=np.int64)
+        if len(self) == 0:
+            inside = np.zeros(points.shape, dtype=bool)
+        else:
+            idx = np.searchsorted(self.starts, points, side="right") - 1
+            inside = (idx >= 0) & (points < self.ends[np.clip(idx, 0, None)])
+        return inside if points.ndim else bool(inside)
+
+    def to_mask(self, n_samples):
+        """Expand back into a boolean mask of length `n_samples`."""
+        edges = np.zeros(n_samples + 1, dtype=np.int64)
+        starts = np.clip(self.starts, 0, n_samples)
+        ends = np.clip(self.ends, 0, n_samples)
+        np.add.at(edges, starts, 1)
+        np.add.at(edges, ends, -1)
+        return np.cumsum(edges[:-1]) > 0
+
+    def epoch_mask(self, n_epochs, epoch_samples):
+        """
+        Flag epochs that overlap at least one interval.
+
+        Parameters:
+        - n_epochs: Number of epochs in the recording.
+        - epoch_samples: Number of samples per epoch (e.g. epoch_sec * sf).
+
+        Returns:
+        - Boolean array of shape (n_epochs,) with True for artifacted epochs.
+        """
+        epoch_samples = int(epoch_samples)
+        first_epoch = self.starts // epoch_samples
+        last_epoch = (self.ends - 1) // epoch_samples
+        return IntervalSet(first_epoch, last_epoch + 1).to_mask(n_epochs)
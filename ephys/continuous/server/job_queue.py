@@ -0,0 +1,324 @@
+import os
+import time
+import uuid
+import socket
+import sqlite3
+import argparse
+import threading
+import traceback
+from py_console import console
+
+# Shared job queue so several machines that mount the NAS split the backlog
+# One job per (animal, date, step), claimed with a lease that the worker renews (heartbeat)
+# while it runs. A worker that dies stops renewing and its job goes back to the queue when the
+# lease expires, failed jobs are retried up to max_attempts times.
+# The queue is an SQLite file on the shared storage, claims are BEGIN IMMEDIATE transactions
+# (one writer at a time through the file lock). The default rollback journal is kept on purpose:
+# WAL needs shared memory between the processes, which does not work across machines.
+# Leases use the wall clock, the machines should be synced (NTP).
+
+DEFAULT_QUEUE = "/synology-nas/MLA/job_queue.sqlite"
+DEFAULT_LEASE_SEC = 600
+DEFAULT_MAX_ATTEMPTS = 3
+# step -> step that has to be done first (same animal and date)
+STEP_REQUIRES = {
+    "filter": None,
+    "predict": "filter",
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    animal TEXT NOT NULL,
+    date TEXT NOT NULL,
+    step TEXT NOT NULL,
+    base_folder TEXT,
+    requires TEXT,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    not_before REAL NOT NULL DEFAULT 0,
+    token TEXT,
+    worker TEXT,
+    lease_until REAL,
+    error TEXT,
+    updated REAL,
+    UNIQUE (animal, date, step)
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, not_before);
+"""
+
+
+class LeaseLost(Exception):
+    pass
+
+
+def connect(queue=DEFAULT_QUEUE, timeout=60):
+    if os.path.dirname(queue):
+        os.makedirs(os.path.dirname(queue), exist_ok=True)
+    # autocommit, transactions are explicit
+    con = sqlite3.connect(queue, timeout=timeout, isolation_level=None)
+    con.row_factory = sqlite3.Row
+    con.executescript(SCHEMA)
+    return con
+
+def enqueue(queue, animal, dates, steps, base_folder=None, max_attempts=DEFAULT_MAX_ATTEMPTS):
+    """
+    Add a job per (animal, date, step), jobs that already exist are left as they are.
+
+    Returns:
+    - Number of new jobs.
+    """
+    con = connect(queue)
+    con.execute("BEGIN IMMEDIATE")
+    existing = {tuple(row) for row in con.execute("SELECT date, step FROM jobs WHERE animal = ?", (animal,))}
+    rows = []
+    for date in dates:
+        for step in steps:
+            # a step only waits for a required job that is queued, days filtered before the
+            # queue (e.g. `--steps predict` on the backlog) have no filter job to wait for
+            requires = STEP_REQUIRES.get(step)
+            if requires not in steps and (str(date), requires) not in existing:
+                requires = None
+            rows.append((animal, str(date), step, base_folder, requires, max_attempts, time.time()))
+    before = con.total_changes
+    con.executemany("""INSERT OR IGNORE INTO jobs (animal, date, step, base_folder, requires, max_attempts, updated)
+                       VALUES (?, ?, ?, ?, ?, ?, ?)""", rows)
+    added = con.total_changes - before
+    con.execute("COMMIT")
+    con.close()
+    return added
+
+def claim(queue, worker, lease_sec=DEFAULT_LEASE_SEC, steps=None, now=None):
+    """
+    Take the oldest job that is ready: pending and past its retry delay, or running with an
+    expired lease (its worker is gone). Jobs whose required step is not done yet wait.
+
+    Returns:
+    - The job as a dict (with the lease `token` needed by heartbeat/complete/fail) or None.
+    """
+    con = connect(queue)
+    now = time.time() if now is None else now
+    try:
+        con.execute("BEGIN IMMEDIATE")
+        # expired leases count as an attempt, out of attempts they are failed
+        con.execute("""UPDATE jobs SET status = 'failed', token = NULL, error = 'lease expired', updated = ?
+                       WHERE status = 'running' AND lease_until < ? AND attempts >= max_attempts""", (now, now))
+        query = """SELECT * FROM jobs j
+                   WHERE ((status = 'pending' AND not_before <= ?) OR (status = 'running' AND lease_until < ?))
+                   AND (requires IS NULL OR EXISTS (SELECT 1 FROM jobs r WHERE r.animal = j.animal
+                        AND r.date = j.date AND r.step = j.requires AND r.status = 'done'))"""
+        args = [now, now]
+        if steps:
+            query += f" AND step IN ({', '.join('?' * len(steps))})"
+            args += list(steps)
+        row = con.execute(query + " ORDER BY date, id LIMIT 1", args).fetchone()
+        if row is None:
+            con.execute("COMMIT")
+            return None
+        token = uuid.uuid4().hex
+        con.execute("""UPDATE jobs SET status = 'running', attempts = attempts + 1, token = ?, worker = ?,
+                       lease_until = ?, updated = ? WHERE id = ?""", (token, worker, now + lease_sec, now, row["id"]))
+        con.execute("COMMIT")
+    except BaseException:
+        if con.in_transaction:
+            con.execute("ROLLBACK")
+        raise
+    finally:
+        con.close()
+    job = dict(row)
+    job.update(token=token, worker=worker, attempts=row["attempts"] + 1, status="running")
+    return job
+
+def _update_leased(queue, job, sql, args):
+    # only the holder of the lease can touch a running job
+    con = connect(queue)
+    try:
+        cursor = con.execute(sql + " WHERE id = ? AND token = ? AND status = 'running'", (*args, job["id"], job["token"]))
+        if cursor.rowcount == 0:
+            raise LeaseLost(f"Lease of job {job['id']} ({job['animal']} {job['date']} {job['step']}) was lost")
+    finally:
+        con.close()
+
+def heartbeat(queue, job, lease_sec=DEFAULT_LEASE_SEC):
+    now = time.time()
+    _update_leased(queue, job, "UPDATE jobs SET lease_until = ?, updated = ?", (now + lease_sec, now))
+
+def complete(queue, job):
+    _update_leased(queue, job, "UPDATE jobs SET status = 'done', token = NULL, lease_until = NULL, error = NULL, updated = ?", (time.time(),))
+
+def fail(queue, job, error, retry_delay_sec=60):
+    """
+    Give the job back for a retry after `retry_delay_sec` (doubling with every attempt),
+    or mark it failed when it is out of attempts.
+    """
+    now = time.time()
+    status = "failed" if job["attempts"] >= job["max_attempts"] else "pending"
+    delay = retry_delay_sec * 2 ** (job["attempts"] - 1)
+    _update_leased(queue, job, "UPDATE jobs SET status = ?, token = NULL, lease_until = NULL, error = ?, not_before = ?, updated = ?",
+                   (status, str(error), now + delay, now))
+
+def reset_failed(queue, animal=None):
+    con = connect(queue)
+    query, args = "UPDATE jobs SET status = 'pending', attempts = 0, not_before = 0 WHERE status = 'failed'", []
+    if animal is not None:
+        query += " AND animal = ?"
+        args.append(animal)
+    n = con.execute(query, args).rowcount
+    con.close()
+    return n
+
+def summary(queue):
+    con = connect(queue)
+    counts = {status: n for status, n in con.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status")}
+    con.close()
+    return counts
+
+
+class Heartbeat:
+    """
+    Renew the lease of a job every `interval` seconds in a background thread while it runs.
+    `lost` is set if the lease was taken over (the job expired and someone else claimed it).
+    """
+
+    def __init__(self, queue, job, lease_sec=DEFAULT_LEASE_SEC, interval=None):
+        self.queue = queue
+        self.job = job
+        self.lease_sec = lease_sec
+        self.interval = interval or lease_sec / 3
+        self.lost = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                heartbeat(self.queue, self.job, self.lease_sec)
+            except LeaseLost:
+                self.lost.set()
+                return
+            except sqlite3.OperationalError as e:
+                # busy NAS, the lease has room for a few missed beats
+                console.warn(f"Heartbeat of job {self.job['id']} failed: {e}")
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def run_worker(queue, handlers, worker=None, lease_sec=DEFAULT_LEASE_SEC, heartbeat_sec=None,
+               retry_delay_sec=60, idle_sec=30, max_jobs=None, exit_when_idle=False):
+    """
+    Claim and run jobs until interrupted.
+
+    Parameters:
+    - handlers: {step: function(job)}, only these steps are claimed.
+    - worker: Name stored with the claims, defaults to <host>:<pid>.
+    - idle_sec: Wait between polls when there is nothing to do.
+    - max_jobs: Stop after this many jobs.
+    - exit_when_idle: Stop when there is nothing to claim (instead of polling).
+
+    Returns:
+    - Number of jobs done.
+    """
+    worker = worker or f"{socket.gethostname()}:{os.getpid()}"
+    n_done = 0
+    while max_jobs is None or n_done < max_jobs:
+        job = claim(queue, worker, lease_sec, steps=list(handlers))
+        if job is None:
+            if exit_when_idle:
+                break
+            time.sleep(idle_sec)
+            continue
+        console.info(f"[{worker}] {job['step']} {job['animal']} {job['date']} (attempt {job['attempts']}/{job['max_attempts']})")
+        with Heartbeat(queue, job, lease_sec, heartbeat_sec) as beat:
+            try:
+                handlers[job["step"]](job)
+                error = None
+            except Exception:
+                error = traceback.format_exc()
+        try:
+            if beat.lost.is_set():
+                raise LeaseLost(f"Lease of job {job['id']} was lost while running")
+            if error is None:
+                complete(queue, job)
+                n_done += 1
+            else:
+                console.error(f"[{worker}] {job['step']} {job['animal']} {job['date']} failed:\n{error}")
+                fail(queue, job, error, retry_delay_sec)
+        except LeaseLost as e:
+            # someone else has the job now, their result wins
+            console.warn(f"[{worker}] {e}")
+    return n_done
+
+
+#################################################################
+#           Pipeline steps                                       #
+#################################################################
+
+def _written_since(folder, pattern, since):
+    # files matching `pattern` in `folder` modified after `since` (a job that wrote nothing did not run)
+    if not os.path.isdir(folder):
+        return []
+    return [name for name in os.listdir(folder)
+            if pattern in name and os.path.getmtime(os.path.join(folder, name)) >= since]
+
+def filter_step(job):
+    # same as one day of run_pipeline()
+    from run_pipeline import day_eeg_files, filter_down_bonsai_eeg, read_config
+    ephys_folder = os.path.join(job["base_folder"], job["date"], "eeg")
+    file_list = day_eeg_files(ephys_folder) if os.path.isdir(ephys_folder) else []
+    if not file_list:
+        raise FileNotFoundError(f"No _eeg.bin files in {ephys_folder}")
+    config = read_config(job["base_folder"])
+    downsampled_eegs, _ = filter_down_bonsai_eeg(config, file_list, output_folder=ephys_folder)
+    if not downsampled_eegs:
+        raise RuntimeError(f"Nothing was filtered in {ephys_folder}")
+
+def predict_step(job, epoch_sec=2.5):
+    from predict import run_and_save_predictions, read_config
+    started = time.time()
+    config = read_config(job["base_folder"])
+    # run_and_save_predictions() logs and returns when the folders or the downsampled files are missing
+    run_and_save_predictions(job["animal"], job["date"], epoch_sec, config=config, base_folder=job["base_folder"])
+    sleep_folder = os.path.join(job["base_folder"], job["date"], "sleep")
+    if not _written_since(sleep_folder, "consensus_df", started - 1):
+        raise RuntimeError(f"No predictions were written to {sleep_folder}")
+
+STEP_HANDLERS = {"filter": filter_step, "predict": predict_step}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Shared queue of (animal, date, step) jobs on the NAS")
+    parser.add_argument("--queue", default=DEFAULT_QUEUE, help="SQLite file on the shared storage")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    add = subparsers.add_parser("enqueue", help="Add the sessions of an animal")
+    add.add_argument("--animal_id", required=True)
+    add.add_argument("--base_folder", required=True, help="Folder of the animal, as mounted on every worker (e.g. /synology-nas/MLA/beelink1/MLA1)")
+    add.add_argument("--start_date", default=None, help="First date (YYYY-MM-DD), all sessions by default")
+    add.add_argument("--steps", nargs="+", default=["filter", "predict"], choices=list(STEP_HANDLERS))
+    add.add_argument("--max_attempts", type=int, default=DEFAULT_MAX_ATTEMPTS)
+    work = subparsers.add_parser("work", help="Run jobs")
+    work.add_argument("--steps", nargs="+", default=list(STEP_HANDLERS), choices=list(STEP_HANDLERS))
+    work.add_argument("--lease_sec", type=float, default=DEFAULT_LEASE_SEC)
+    work.add_argument("--exit_when_idle", action="store_true")
+    subparsers.add_parser("status", help="Jobs per status")
+    retry = subparsers.add_parser("retry", help="Put failed jobs back in the queue")
+    retry.add_argument("--animal_id", default=None)
+    args = parser.parse_args()
+
+    if args.command == "enqueue":
+        import datetime
+        from predict import list_session_dates
+        start_date = datetime.datetime.strptime(args.start_date, "%Y-%m-%d").date() if args.start_date else None
+        dates = list_session_dates(args.base_folder, start_date)
+        console.success(f"Added {enqueue(args.queue, args.animal_id, dates, args.steps, args.base_folder, args.max_attempts)} jobs")
+    elif args.command == "work":
+        run_worker(args.queue, {step: STEP_HANDLERS[step] for step in args.steps}, lease_sec=args.lease_sec,
+                   exit_when_idle=args.exit_when_idle)
+    elif args.command == "retry":
+        console.success(f"{reset_failed(args.queue, args.animal_id)} failed jobs back in the queue")
+    console.info(f"Queue: {summary(args.queue)}")
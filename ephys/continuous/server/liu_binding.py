@@ -5,63 +5,83 @@ import argparse
 from rlist_files import list_files
 import datetime
 import polars as pl
-import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 def parse_bids_session(string: str):
     return os.path.basename(string).split("_")[1].replace("ses-", "")
 
-def merge_sessions(base_folder, animal_id, cutoff_time):
-    files = list_files(path=base_folder, pattern='desc-down*_eeg.csv.gz', recursive=True, full_names=True)
-    console.info(f"Found these .csv.gz files in all subdirectories from {base_folder}")
-    print("\n".join(files))
-    cutoff_time = datetime.datetime.strptime(cutoff_time, '%H:%M:%S').time()
+def group_sessions(files, cutoff_time):
+    """
+    Group files into experimental days. Files starting before `cutoff_time` (datetime.time)
+    belong to the previous day's session.
 
-    # Group files by day and session
+    Returns:
+    - A dict of {session_date: [files]}.
+    """
     sessions = {}
     for file_idx, file in enumerate(files):
-        console.log(f"File {file_idx}: {file}")
-        session_datetime_str = parse_bids_session(file)
-        session_datetime = datetime.datetime.strptime(session_datetime_str, '%Y%m%dT%H%M%S')
-        console.info(f"File {file_idx}: Session datetime extracted: {session_datetime}")
-
+        session_datetime = datetime.datetime.strptime(parse_bids_session(file), '%Y%m%dT%H%M%S')
         # Determine if this file belongs to the current day session or the next day's session
         session_date = session_datetime.date()
-        console.info(f"File {file_idx}: started recording at {session_datetime.time()}.")
-        console.info(f"If {session_datetime.time()}<{cutoff_time} file will be merged with File {max(0, file_idx -1)}")
-        time.sleep(0.5)
+        console.info(f"File {file_idx}: {file} started recording at {session_datetime.time()}")
         if session_datetime.time() < cutoff_time:
             session_date -= datetime.timedelta(days=1)
             console.info(f"File {file_idx} {file} assigned to previous day's session", severe=True)
+        sessions.setdefault(session_date, []).append(file)
+    return sessions
+
+def merge_session_files(files, output_file):
+    """
+    Concatenate the files of one session without holding them in memory
+    (lazy scans sunk straight into `output_file`, .csv.gz or .parquet).
+    The rows are counted in the same pass that writes the output, the inputs are read once.
 
-        if session_date not in sessions:
-            console.success(f"Creating session for file on date {session_date}")
-            sessions[session_date] = []
-        sessions[session_date].append(file)
+    Returns:
+    - The number of rows written.
+    """
+    files = sorted(files)
+    for file in files:
+        console.log(f"File {file}")
+    merged = pl.concat([pl.scan_csv(file) for file in files])
+    if output_file.endswith(".parquet"):
+        sink = merged.sink_parquet(output_file, lazy=True)
+    else:
+        sink = merged.sink_csv(output_file, compression="gzip", lazy=True)
+    # both queries share the scans (one CACHE node in the plan)
+    _, n_rows = pl.collect_all([sink, merged.select(pl.len())])
+    n_rows = n_rows.item()
+    if output_file.endswith(".parquet"):
+        # parquet has the number of rows in its metadata, no need to scan it
+        written = pl.scan_parquet(output_file).select(pl.len()).collect().item()
+        assert written == n_rows, f"Concat resulted in loss of data ({n_rows} rows in, {written} rows out), aborting!!!"
+    console.success(f"Saved concatenated session ({n_rows} rows) to {output_file}", severe=True)
+    return n_rows
+
+def merge_sessions(base_folder, animal_id, cutoff_time, output_format="csv", n_workers=4):
+    files = list_files(path=base_folder, pattern='desc-down*_eeg.csv.gz', recursive=True, full_names=True)
+    console.info(f"Found these .csv.gz files in all subdirectories from {base_folder}")
+    print("\n".join(files))
+    cutoff_time = datetime.datetime.strptime(cutoff_time, '%H:%M:%S').time()
+    sessions = group_sessions(files, cutoff_time)
+    extension = "parquet" if output_format == "parquet" else "csv.gz"
 
-    # Process each session
-    for idx, (session_date, files) in enumerate(sorted(sessions.items()), 1):
-        console.success("Ready to merge individual files into sessions!")
-        console.log(f"Merging {len(files)} files into session_date {session_date} (see details below)")
-        print('\n'.join(files))
-        print("=" * os.get_terminal_size().columns)
-        time.sleep(0.5)
-        console.info(f"The result should appear as one session in {f'/day0{idx}'}")
-        console.warn("It might take a while to read these files!")
-        dfs = [pl.read_csv(file) for file in files]
-        row_nums = list(map(lambda x: x.height, dfs))
-        for item in zip(files, row_nums):
-            print(f"(File, n_rows) {item}")
-        console.success(f"Concat in progress")
-        df_concat = pl.concat(dfs)
-        assert sum(row_nums) == df_concat.height, "Concat resulted in loss of data, aborting!!!"
-        # Determine session datetime for naming from the first file in the sorted list
-        first_session_datetime = parse_bids_session(sorted(files)[0])
-        output_dir = os.path.join(base_folder, f'day0{idx}')
-        os.makedirs(output_dir, exist_ok=True)
-        output_file = os.path.join(output_dir, f'sub-{animal_id}_ses-{first_session_datetime}.csv.gz')
-        df_concat.to_pandas().to_csv(output_file, index=False)
-        console.success(f"Saved concatenated session to {output_file}", severe=True)
-        print("=" * os.get_terminal_size().columns)
+    # Each experimental day is merged by a different worker
+    # polars releases the GIL while scanning/sinking, so threads are enough
+    console.success("Ready to merge individual files into sessions!")
+    outputs = {}
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = {}
+        for idx, (session_date, session_files) in enumerate(sorted(sessions.items()), 1):
+            console.log(f"Merging {len(session_files)} files into session_date {session_date} (day{idx:02d})")
+            # Determine session datetime for naming from the first file in the sorted list
+            first_session_datetime = parse_bids_session(sorted(session_files)[0])
+            output_dir = os.path.join(base_folder, f'day{idx:02d}')
+            os.makedirs(output_dir, exist_ok=True)
+            output_file = os.path.join(output_dir, f'sub-{animal_id}_ses-{first_session_datetime}.{extension}')
+            futures[executor.submit(merge_session_files, session_files, output_file)] = output_file
+        for future in as_completed(futures):
+            outputs[futures[future]] = future.result()
+    return outputs
 
 
 if __name__ == "__main__":
@@ -69,8 +89,10 @@ if __name__ == "__main__":
     parser.add_argument("--animal_id", required=True, help="Animal ID for constructing the base path")
     parser.add_argument("--base_folder", required=False, help="Full path of base folder if not using default hard-coded one", default=None)
     parser.add_argument("--cutoff_time", required=True, help="HH:MM:SS to use as cutoff for grouping sessions into experimental days instead of calendar dates")
+    parser.add_argument("--output_format", choices=["csv", "parquet"], default="csv", help="csv.gz (default) or parquet output")
+    parser.add_argument("--n_workers", type=int, default=4, help="Number of experimental days merged in parallel")
     args = parser.parse_args()
     base_folder = args.base_folder if args.base_folder else os.path.join("/synology-nas/MLA/LY", args.animal_id)
     console.info(f"Searching csv.gz in path: {base_folder}")
 
-    merge_sessions(base_folder, args.animal_id, args.cutoff_time)
\ No newline at end of file
+    merge_sessions(base_folder, args.animal_id, args.cutoff_time, output_format=args.output_format, n_workers=args.n_workers)
\ No newline at end of file
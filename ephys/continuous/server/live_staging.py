@@ -0,0 +1,354 @@
+import os
+import json
+import time
+import argparse
+import datetime
+from collections import deque
+import joblib
+import numpy as np
+import pandas as pd
+import yasa
+from scipy.signal.windows import triang
+from py_console import console
+from utils import read_config
+from staging import epoch_features
+from predict import consensus_prediction
+from camera_frames import count_camera_channels
+from ingest import StreamingDecimator, pipeline_taps, bandpass_taps
+
+# Online sleep staging of the recording bonsai is writing right now
+# bonsai .bin -> StreamingDecimator (same filters as the ingest) -> running robust scaling ->
+# 0.4-30 Hz filter -> one feature row per epoch -> the smoothing windows of SleepStaging.fit
+# (15 epochs centered triangular, 4 epochs past) -> running robust z-score -> cached classifier.
+# Each epoch is scored as soon as it is complete (+ `lag_epochs` of the centered window),
+# the two zero-phase filters add ~(n_taps / 2) / sf of latency, a few seconds.
+
+CENTERED_EPOCHS = 15
+PAST_EPOCHS = 4
+FREQ_BROAD = (0.4, 30)
+
+
+class BinTailer:
+    """
+    Follow the .bin files bonsai is writing in `folder` (e.g. box1_eegdata2024-03-01T10_00_00.bin).
+
+    Starts at the beginning of the newest file. Only whole frames are returned, a file is left
+    for the next one once a newer file exists and nothing was added to it in a whole read() call.
+    The file stays open while we read it, on Windows that also keeps the mover away from it.
+
+    Parameters:
+    - folder: Folder where bonsai writes.
+    - prefix: Start of the file names (e.g. 'box1_eegdata').
+    - num_channels: Number of channels (camera counters at the end are dropped).
+    - dtype: dtype of the samples.
+    """
+
+    def __init__(self, folder, prefix, num_channels, dtype=np.float32):
+        self.folder = folder
+        self.prefix = prefix
+        self.num_channels = num_channels
+        self.dtype = np.dtype(dtype)
+        self.file = None
+        self.f = None
+        self.total_channels = None
+
+    def _files(self):
+        return sorted(entry.path for entry in os.scandir(self.folder)
+                      if entry.name.startswith(self.prefix) and entry.name.endswith(".bin"))
+
+    def _open(self, path):
+        if self.f is not None:
+            self.f.close()
+        self.file = path
+        self.f = open(path, "rb")
+        self.remainder = b""
+        self.saw_newer = False
+
+    def read(self):
+        """
+        New samples as a (num_channels, n) float array, n can be 0.
+        """
+        blocks = []
+        while True:
+            if self.f is None:
+                files = self._files()
+                if not files:
+                    break
+                self._open(files[-1])
+            if self.total_channels is None:
+                # needs a few thousand samples to tell a camera counter apart
+                if os.path.getsize(self.file) < 4096 * (self.num_channels + 1) * self.dtype.itemsize:
+                    break
+                self.total_channels = self.num_channels + count_camera_channels(self.file, self.num_channels, self.dtype)
+            data = self.remainder + self.f.read()
+            frame_bytes = self.total_channels * self.dtype.itemsize
+            whole = len(data) // frame_bytes * frame_bytes
+            self.remainder = data[whole:]
+            if whole:
+                frames = np.frombuffer(data[:whole], dtype=self.dtype).reshape(-1, self.total_channels)
+                blocks.append(frames[:, :self.num_channels].T)
+                continue
+            newer = [path for path in self._files() if path > self.file]
+            if not newer:
+                break
+            if not self.saw_newer:
+                # bonsai might still be flushing this one, give it until the next call
+                self.saw_newer = True
+                break
+            if self.remainder:
+                console.warn(f"{os.path.basename(self.file)} ended with {len(self.remainder)} bytes of an incomplete frame")
+            console.info(f"{os.path.basename(self.file)} finished, following {os.path.basename(newer[0])}")
+            self._open(newer[0])
+        if not blocks:
+            return np.empty((self.num_channels, 0), dtype=self.dtype)
+        return np.concatenate(blocks, axis=1)
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+
+class RingBuffer:
+    # last `capacity` rows of a (n, n_columns) stream
+    def __init__(self, capacity, n_columns):
+        self.data = np.full((capacity, n_columns), np.nan)
+        self.n = 0
+
+    def add(self, rows):
+        rows = np.atleast_2d(rows)[-len(self.data):]
+        idx = (self.n + np.arange(len(rows))) % len(self.data)
+        self.data[idx] = rows
+        self.n += len(rows)
+
+    def values(self):
+        return self.data[:min(self.n, len(self.data))]
+
+    def __len__(self):
+        return min(self.n, len(self.data))
+
+
+def robust_params(values, quantile_range):
+    # center and scale of sklearn.preprocessing.robust_scale
+    low, median, high = np.nanpercentile(values, [quantile_range[0], 50, quantile_range[1]], axis=0)
+    scale = high - low
+    return median, np.where(scale == 0, 1, scale)
+
+def smooth_centered(history, lag):
+    """
+    Triangular-weighted mean of SleepStaging's 15 epochs centered window around epoch
+    len(history) - 1 - lag, using the epochs we already have (same weights as pandas
+    rolling(win_type='triang', min_periods=1)).
+    """
+    half = CENTERED_EPOCHS // 2
+    weights = triang(CENTERED_EPOCHS)
+    rows = np.asarray(history)
+    center = len(rows) - 1 - lag
+    first = max(center - half, 0)
+    w = weights[first - center + half:len(rows) - center + half]
+    return (w[:, None] * rows[first:]).sum(axis=0) / w.sum()
+
+
+class LiveStaging:
+    """
+    Incremental version of predict.process_eeg() for a stream of downsampled samples.
+
+    The global statistics of the batch version are replaced by running ones:
+    quantile clipping (EEG) and robust scaling of the signals use the last `raw_history_sec`,
+    the robust z-score of the smoothed features uses the last `history_epochs`.
+    Nothing is scored before `min_epochs` epochs went through (SleepStaging needs 5 min too).
+
+    Parameters:
+    - config: The animal config (down_freq_hz, channel_names).
+    - path_to_model: Trained LGBMClassifier (joblib), loaded once.
+    - epoch_sec: Epoch length, same as the classifier.
+    - lag_epochs: Future epochs of the centered window (up to 7) to wait for before scoring an epoch.
+    - on_epoch: Functions called with the result dict of every scored epoch.
+    """
+
+    def __init__(self, config, path_to_model="clf_eeg+emg_lgb_gbdt_custom.joblib", epoch_sec=2.5, lag_epochs=0,
+                 history_epochs=34_560, min_epochs=120, raw_history_sec=3600, robust_scale=True, on_epoch=()):
+        assert 0 <= lag_epochs <= CENTERED_EPOCHS // 2, f"lag_epochs must be between 0 and {CENTERED_EPOCHS // 2}"
+        self.sf = config["down_freq_hz"]
+        if self.sf != 100:
+            console.warn(f"SleepStaging resamples to 100 Hz, live features are computed at {self.sf} Hz")
+        self.epoch_sec = epoch_sec
+        self.epoch_samples = int(epoch_sec * self.sf)
+        self.lag_epochs = lag_epochs
+        self.min_epochs = min_epochs
+        self.robust_scale = robust_scale
+        self.on_epoch = list(on_epoch)
+        names = list(config["channel_names"])
+        self.eeg_names = [name for name in names if name.startswith("EEG")]
+        # same channels as predict.process_eeg()
+        self.channels = [names.index(name) for name in self.eeg_names] + [names.index("EMG1")]
+        self.clf = joblib.load(path_to_model)
+        n = len(self.channels)
+        # one sample out of 10 is plenty for the quantiles
+        self.raw_stride = 10
+        self.raw_history = RingBuffer(int(raw_history_sec * self.sf) // self.raw_stride, n)
+        taps = bandpass_taps(self.sf, *FREQ_BROAD)
+        self.filter = StreamingDecimator(np.tile(taps, (n, 1)), 1)
+        self.pending = np.empty((n, 0))
+        # raw features of the last epochs (centered + past windows) and smoothed features history
+        self.recent = [deque(maxlen=CENTERED_EPOCHS) for _ in self.eeg_names]
+        self.smoothed = [None] * len(self.eeg_names)
+        self.latest = [None] * len(self.eeg_names)
+        self.n_epochs = 0
+        self.history_epochs = history_epochs
+        self.feature_names = None
+
+    def push(self, data_down):
+        """
+        Add (n_channels, n) downsampled samples (all config channels), score the epochs that are complete.
+
+        Returns:
+        - List of result dicts (see score()).
+        """
+        data = np.asarray(data_down, dtype=np.float64)[self.channels]
+        if data.shape[1] == 0:
+            return []
+        data = self._scale(data)
+        self.pending = np.concatenate([self.pending, self.filter.push(data)], axis=1)
+        results = []
+        while self.pending.shape[1] >= self.epoch_samples:
+            epoch = self.pending[:, :self.epoch_samples]
+            self.pending = self.pending[:, self.epoch_samples:]
+            result = self._add_epoch(epoch)
+            if result is not None:
+                results.append(result)
+                for callback in self.on_epoch:
+                    callback(result)
+        return results
+
+    def _scale(self, data):
+        self.raw_history.add(data[:, ::self.raw_stride].T)
+        history = self.raw_history.values()
+        n_eeg = len(self.eeg_names)
+        # quantile clipping of the EEGs (predict.clip_quantiles_startswith)
+        low, high = np.nanpercentile(history[:, :n_eeg], [1, 99], axis=0)
+        data[:n_eeg] = np.clip(data[:n_eeg], low[:, None], high[:, None])
+        if self.robust_scale:
+            clipped = history.copy()
+            clipped[:, :n_eeg] = np.clip(clipped[:, :n_eeg], low, high)
+            center, scale = robust_params(clipped, (25, 75))
+            data = (data - center[:, None]) / scale[:, None]
+        return data
+
+    def _add_epoch(self, epoch):
+        emg = epoch_features(epoch[-1:], self.sf, "emg", freq_broad=FREQ_BROAD, win_sec=min(5, self.epoch_sec))
+        emg = {f"emg_{key}": value[0] for key, value in emg.items()}
+        for i in range(len(self.eeg_names)):
+            eeg = epoch_features(epoch[i:i + 1], self.sf, "eeg", freq_broad=FREQ_BROAD, win_sec=min(5, self.epoch_sec))
+            row = {f"eeg_{key}": value[0] for key, value in eeg.items()} | emg
+            if self.feature_names is None:
+                self.feature_names = sorted(row)
+            self.recent[i].append([row[name] for name in self.feature_names])
+            recent = np.asarray(self.recent[i])
+            lag = min(self.lag_epochs, len(recent) - 1)
+            # centered window around the epoch we score, past window up to it
+            rollc = smooth_centered(recent, lag)
+            rollp = recent[max(len(recent) - 1 - lag - PAST_EPOCHS + 1, 0):len(recent) - lag].mean(axis=0)
+            if self.smoothed[i] is None:
+                self.smoothed[i] = RingBuffer(self.history_epochs, 2 * len(self.feature_names))
+            self.latest[i] = np.concatenate([rollc, rollp])
+            self.smoothed[i].add(self.latest[i])
+        self.n_epochs += 1
+        scored = self.n_epochs - 1 - self.lag_epochs
+        if scored < 0 or self.n_epochs < self.min_epochs:
+            return None
+        return self.score(scored)
+
+    def score(self, epoch_idx):
+        """
+        Classify `epoch_idx` (the newest epoch with its full lag) with every EEG channel + consensus.
+
+        Returns:
+        - dict with epoch, time_sec, stage (yasa string), label, confidence and the label of each EEG channel.
+        """
+        rows = []
+        for i in range(len(self.eeg_names)):
+            recent = np.asarray(self.recent[i])
+            raw = recent[len(recent) - 1 - min(self.lag_epochs, len(recent) - 1)]
+            center, scale = robust_params(self.smoothed[i].values(), (5, 95))
+            normalized = (self.latest[i] - center) / scale
+            n = len(self.feature_names)
+            row = dict(zip(self.feature_names, raw))
+            row |= dict(zip([f"{name}_c7min_norm" for name in self.feature_names], normalized[:n]))
+            row |= dict(zip([f"{name}_p2min_norm" for name in self.feature_names], normalized[n:]))
+            rows.append(row)
+        X = pd.DataFrame(rows).astype(np.float32)[self.clf.feature_name_]
+        proba = self.clf.predict_proba(X)
+        labels = self.clf.classes_[proba.argmax(axis=1)]
+        predictions = pd.DataFrame([labels], columns=self.eeg_names)
+        max_proba = pd.DataFrame([proba.max(axis=1)], columns=self.eeg_names)
+        label = int(consensus_prediction(predictions, max_proba).iloc[0])
+        confidence = float(max_proba.to_numpy()[0][labels == label].max())
+        result = {
+            "epoch": epoch_idx,
+            "time_sec": epoch_idx * self.epoch_sec,
+            "stage": yasa.hypno_int_to_str([label])[0],
+            "label": label,
+            "confidence": confidence,
+        }
+        result |= {name: int(value) for name, value in zip(self.eeg_names, labels)}
+        return result
+
+
+class HypnoWriter:
+    """
+    Write each scored epoch as a csv row and the latest one to a small json that other
+    programs (e.g. the synapse closed-loop scripts) can poll. The json is replaced atomically.
+    """
+
+    def __init__(self, csv_file, state_file, start_time=None):
+        self.csv_file = csv_file
+        self.state_file = state_file
+        self.start_time = start_time or datetime.datetime.now()
+
+    def __call__(self, result):
+        header = not os.path.exists(self.csv_file)
+        pd.DataFrame([result]).to_csv(self.csv_file, mode="a", header=header, index=False)
+        state = result | {"updated": datetime.datetime.now().isoformat(timespec="seconds"),
+                          "start_time": self.start_time.isoformat(timespec="seconds")}
+        tmp = self.state_file + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp, self.state_file)
+
+
+def run_live_staging(watch_folder, box, config, output_folder, path_to_model, epoch_sec=2.5, lag_epochs=0, poll_sec=0.5):
+    tailer = BinTailer(watch_folder, f"{box}_eegdata", len(config["selected_channels"]))
+    taps, q = pipeline_taps(config)
+    decimator = StreamingDecimator(taps, q)
+    os.makedirs(output_folder, exist_ok=True)
+    stamp = datetime.datetime.now().strftime("%Y%m%dT%H%M%S")
+    writer = HypnoWriter(os.path.join(output_folder, f"sub-{config['subject_id']}_ses-{stamp}_live_hypno.csv"),
+                         os.path.join(output_folder, f"{box}_live_state.json"))
+    staging = LiveStaging(config, path_to_model, epoch_sec, lag_epochs, on_epoch=[writer])
+    console.info(f"Live staging of {box} in {watch_folder}")
+    try:
+        while True:
+            results = staging.push(decimator.push(tailer.read()))
+            if results:
+                last = results[-1]
+                console.log(f"epoch {last['epoch']}: {last['stage']} ({last['confidence']:.2f})")
+            time.sleep(poll_sec)
+    except KeyboardInterrupt:
+        console.warn("Stopping live staging")
+    finally:
+        tailer.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score sleep stages on the recording bonsai is writing")
+    parser.add_argument("--watch_folder", required=True, help="Folder where bonsai writes the .bin files")
+    parser.add_argument("--box", default="box1", help="Box prefix of the files (e.g. box1)")
+    parser.add_argument("--config_folder", required=True, help="Folder with the animal config.yaml")
+    parser.add_argument("--output_folder", required=True, help="Where the live hypnogram and the latest state are written")
+    parser.add_argument("--model", default="clf_eeg+emg_lgb_gbdt_custom.joblib", help="Trained LGBMClassifier (joblib)")
+    parser.add_argument("--epoch_sec", type=float, default=2.5, help="Epoch for sleep predictions in seconds, should match the classifier")
+    parser.add_argument("--lag_epochs", type=int, default=0, help="Future epochs (0-7) of the centered smoothing window to wait for")
+    args = parser.parse_args()
+    config = read_config(args.config_folder)
+    run_live_staging(args.watch_folder, args.box, config, args.output_folder, args.model, args.epoch_sec, args.lag_epochs)
@@ -13,6 +13,9 @@ from sklearn.preprocessing import robust_scale, minmax_scale
 from scipy.signal import hilbert, butter, filtfilt, sosfiltfilt
 from yasa import sliding_window
 import argparse
+import yaml
+from session_catalog import find_files
+from accel_features import session_accel_features, apply_accel_features
 
 # GENERAL PARAMS
 # might be changed via argparse
@@ -120,10 +123,33 @@ def classify_log_emg(log_emg, threshold):
     classified = np.where(log_emg > threshold, 0, 2)
     return classified
 
-def process_files_in_eeg_directory(eeg_directory, overwrite, scale=True):
+def find_eeg_config(eeg_directory):
+    # config.yaml next to the eeg files or in the animal folder (<animal>/<date>/eeg)
+    for folder in [eeg_directory, os.path.dirname(os.path.dirname(eeg_directory))]:
+        config_file = os.path.join(folder, "config.yaml")
+        if os.path.isfile(config_file):
+            with open(config_file, "r") as f:
+                return yaml.safe_load(f)
+    return None
+
+def load_accel_features(eeg_directory, file, epoch_sec):
+    """
+    Accelerometer features of the staging epochs of a desc-down file (see accel_features.py),
+    None when there is no config or no accelerometer data for the session.
+    """
+    config = find_eeg_config(eeg_directory)
+    if config is None:
+        console.warn(f"No config.yaml for {eeg_directory}, not using the accelerometer")
+        return None
+    session_id = os.path.basename(file).split("_")[1].replace("ses-", "")
+    return session_accel_features(config, eeg_directory, session_id, epoch_sec)
+
+def process_files_in_eeg_directory(eeg_directory, overwrite, scale=True, files=None, accel_odba_threshold=None):
     results_dict = {}
     console.info(f"Processing files in {eeg_directory}")
-    for file in glob.glob(os.path.join(eeg_directory, '*desc-down10_eeg.csv.gz')):
+    if files is None:
+        files = glob.glob(os.path.join(eeg_directory, '*desc-down10_eeg.csv.gz'))
+    for file in files:
         console.success(f"Found {file}")
         # Construct the path for the plot
         session_path = os.path.dirname(eeg_directory)  # Assuming 'eeg' is directly under 'session'
@@ -148,24 +174,41 @@ def process_files_in_eeg_directory(eeg_directory, overwrite, scale=True):
             threshold, peak_x_values = find_valley_threshold(log_rms_emg)
             display_peak_dist(log_rms_emg, peak_x_values, threshold, plot_path)
             classified_data = classify_log_emg(log_rms_emg, threshold)
-            np.savetxt(classified_data_path, classified_data.astype(int), fmt='%i', header="EMG1", comments="")
+            # accelerometer activity of the same epochs (win_sec from the start of the session)
+            accel_features = load_accel_features(eeg_directory, file, win_sec)
+            columns, fmt = {}, ['%i']
+            if accel_features is not None:
+                classified_data, columns = apply_accel_features(classified_data, accel_features, accel_odba_threshold)
+                fmt += ['%.6g'] * len(columns)
+            np.savetxt(classified_data_path, np.column_stack([classified_data.astype(int), *columns.values()]),
+                       fmt=fmt, delimiter=",", header=",".join(["EMG1", *columns]), comments="")
             console.success(f"Processed and saved data for {file}")
             # Append results for this file to the dictionary
             results_dict[file] = {
                 'threshold': threshold,
                 'peak_x_values': peak_x_values.tolist(),
+                'accel_odba_threshold': accel_odba_threshold if accel_features is not None else None,
             }
         except Exception as e:
             console.error(f"Failed processing {file} due to {e}")
     return results_dict
 
-def main(root_dir, overwrite=True, scale=True):
+def main(root_dir, overwrite=True, scale=True, catalog=None, accel_odba_threshold=None):
     results_dict = {}
-    # Finding all eeg directories using glob
-    eeg_directories = glob.glob(os.path.join(root_dir, '*', '*', 'eeg'))
-    for eeg_directory in sorted(eeg_directories):
-        results = process_files_in_eeg_directory(eeg_directory, overwrite=overwrite, scale=scale)
-        results_dict.update(results)
+    if catalog is not None:
+        # the catalog already knows every downsampled file, group them by eeg directory
+        files = [file for file in find_files(catalog, kind="eeg_down", pattern="desc-down10_eeg.csv.gz")
+                 if file.startswith(os.path.abspath(root_dir) + os.sep) and os.path.basename(os.path.dirname(file)) == "eeg"]
+        for eeg_directory in sorted(set(map(os.path.dirname, files))):
+            eeg_files = [file for file in files if os.path.dirname(file) == eeg_directory]
+            results_dict.update(process_files_in_eeg_directory(eeg_directory, overwrite=overwrite, scale=scale, files=eeg_files,
+                                                               accel_odba_threshold=accel_odba_threshold))
+    else:
+        # Finding all eeg directories using glob
+        eeg_directories = glob.glob(os.path.join(root_dir, '*', '*', 'eeg'))
+        for eeg_directory in sorted(eeg_directories):
+            results = process_files_in_eeg_directory(eeg_directory, overwrite=overwrite, scale=scale, accel_odba_threshold=accel_odba_threshold)
+            results_dict.update(results)
     # save results to a JSON file
     results_file = os.path.join(root_dir, 'log_rms_emg_thresholds_and_peaks.json')
     with open(results_file, 'w') as fp:
@@ -181,6 +224,10 @@ if __name__ == "__main__":
                         help="Sampling frequency in Hz")
     parser.add_argument('--win_sec', type=float, default=2.5,
                         help="Window size in seconds for analysis")
+    parser.add_argument('--catalog', type=str, default=None,
+                        help="Session catalog (see session_catalog.py) to query instead of globbing root_dir")
+    parser.add_argument('--accel_odba_threshold', type=float, default=None,
+                        help="Score epochs with accelerometer ODBA (g) above this as wake, the accelerometer columns are added either way")
 
     args = parser.parse_args()
 
@@ -195,4 +242,4 @@ if __name__ == "__main__":
     console.info(f"Window Size: {win_sec} seconds")
     print("- -" * os.get_terminal_size().columns)
     # Call main function with the root directory
-    main(args.root_dir)
\ No newline at end of file
+    main(args.root_dir, catalog=args.catalog, accel_odba_threshold=args.accel_odba_threshold)
\ No newline at end of file
@@ -0,0 +1,122 @@
+import os
+import time
+import numpy as np
+import scipy.io
+from concurrent.futures import ProcessPoolExecutor
+from py_console import console
+
+# Per-channel .mat export (e.g. for AccuSleep) from a filtered (n_channels, n_samples) .npy
+# The source is memory mapped, every output is written by a different worker
+# fmt='mat' writes MAT v5 with scipy, every worker holds its whole channel as float64 (plus the
+#           copy savemat makes), so the number of workers is capped by `memory_budget`
+# fmt='h5' writes MAT v7.3 (HDF5) files in chunks, memory does not grow with the recording (needs h5py)
+
+DEFAULT_CHUNK_SAMPLES = 2**20
+# float64 channel + savemat copy
+MAT_BYTES_PER_SAMPLE = 2 * 8
+
+def available_memory():
+    """
+    Bytes of physical memory currently available (None where the OS does not tell).
+    """
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def mat_workers(n_samples, n_workers=None, memory_budget=None):
+    """
+    Workers that fit in `memory_budget` bytes (default: half the available memory) when
+    each one holds a full channel for fmt='mat'. At least 1.
+    """
+    n_workers = n_workers or os.cpu_count() or 1
+    if memory_budget is None:
+        available = available_memory()
+        if available is None:
+            return n_workers
+        memory_budget = available // 2
+    per_worker = max(n_samples * MAT_BYTES_PER_SAMPLE, 1)
+    return max(1, min(n_workers, int(memory_budget // per_worker)))
+
+def _matlab_v73_header():
+    # MATLAB recognizes an HDF5 file as v7.3 .mat by this 128 byte text header in the userblock
+    text = f"MATLAB 7.3 MAT-file, Platform: GLNXA64, Created on: {time.strftime('%a %b %d %H:%M:%S %Y')} HDF5 schema 1.00 ."
+    return text.ljust(116).encode("ascii") + b"\x00" * 8 + np.uint16(0x0200).tobytes() + b"IM"
+
+def _channel_chunks(eeg_file, channels, chunk_samples):
+    # yields float64 chunks of eeg[channels[0]] (or eeg[channels[0]] - eeg[channels[1]])
+    eeg = np.load(eeg_file, mmap_mode="r")
+    n_samples = eeg.shape[1]
+    for start in range(0, n_samples, chunk_samples):
+        stop = min(start + chunk_samples, n_samples)
+        chunk = eeg[channels[0], start:stop].astype(np.float64)
+        if len(channels) == 2:
+            chunk -= eeg[channels[1], start:stop]
+        yield start, stop, chunk
+
+def export_channel(eeg_file, channels, var_name, output_file, fmt="mat", chunk_samples=DEFAULT_CHUNK_SAMPLES):
+    """
+    Write one channel (or the difference of two channels) of a memory mapped .npy as double precision.
+
+    Parameters:
+    - eeg_file: .npy file of shape (n_channels, n_samples).
+    - channels: [idx] for a single channel or [idx_a, idx_b] for eeg[idx_a] - eeg[idx_b].
+    - var_name: Name of the variable in the .mat file ('EEG' or 'EMG').
+    - output_file: Output path.
+    - fmt: 'mat' (v5, scipy.io.savemat, the whole channel in memory) or 'h5' (v7.3, chunked and
+      gzip compressed, bounded memory, needs h5py).
+    - chunk_samples: Samples converted at a time (and HDF5 chunk size).
+
+    Returns:
+    - output_file
+    """
+    n_samples = np.load(eeg_file, mmap_mode="r").shape[1]
+    if fmt == "mat":
+        values = np.empty(n_samples, dtype=np.float64)
+        for start, stop, chunk in _channel_chunks(eeg_file, channels, chunk_samples):
+            values[start:stop] = chunk
+        scipy.io.savemat(output_file, {var_name: values})
+    else:
+        import h5py
+        with h5py.File(output_file, "w", userblock_size=512) as f:
+            # MATLAB is column major, a (n_samples, 1) dataset reads as a 1 x n_samples row vector like savemat
+            dataset = f.create_dataset(var_name, shape=(n_samples, 1), dtype=np.float64,
+                                       chunks=(min(chunk_samples, n_samples), 1), compression="gzip", compression_opts=4)
+            dataset.attrs["MATLAB_class"] = np.bytes_("double")
+            for start, stop, chunk in _channel_chunks(eeg_file, channels, chunk_samples):
+                dataset[start:stop, 0] = chunk
+        with open(output_file, "r+b") as f:
+            f.write(_matlab_v73_header())
+    return output_file
+
+def export_accusleep_mats(eeg_file, output_folder, emg_channels, fmt="mat", n_workers=None, chunk_samples=DEFAULT_CHUNK_SAMPLES, memory_budget=None):
+    """
+    Export every channel to {output_folder}/eeg_channelXX.mat ('EMG' for emg_channels, 'EEG' otherwise)
+    and emg_channels[0] - emg_channels[1] to emg_diff.mat, in parallel.
+    With fmt='mat' the workers are capped so that their full channels fit in `memory_budget` bytes
+    (see mat_workers()), with fmt='h5' every worker only holds `chunk_samples`.
+
+    Returns:
+    - The list of written files.
+    """
+    n_channels, n_samples = np.load(eeg_file, mmap_mode="r").shape
+    if fmt == "mat":
+        capped = mat_workers(n_samples, n_workers, memory_budget)
+        if n_workers is not None and capped < n_workers:
+            console.warn(f"Using {capped} workers instead of {n_workers} so that the full channels fit in memory, use fmt='h5' for bounded memory")
+        n_workers = capped
+    jobs = []
+    for channel in range(n_channels):
+        var_name = "EMG" if channel in emg_channels else "EEG"
+        jobs.append(([channel], var_name, os.path.join(output_folder, f"eeg_channel{channel:02d}.mat")))
+    # create difference emg
+    jobs.append(([emg_channels[0], emg_channels[1]], "EMG", os.path.join(output_folder, "emg_diff.mat")))
+    written = []
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = [executor.submit(export_channel, eeg_file, channels, var_name, fn, fmt, chunk_samples)
+                   for channels, var_name, fn in jobs]
+        for future in futures:
+            fn = future.result()
+            console.success(f"saved {fn}")
+            written.append(fn)
+    return written
@@ -0,0 +1,145 @@
+import os
+import glob
+import argparse
+from fractions import Fraction
+import numpy as np
+import pandas as pd
+import polars as pl
+import yaml
+from scipy.signal import resample_poly
+from py_console import console
+from time_map import TimeMap
+from tdt_matching import read_tdt_block_info
+
+# Puts the TDT photometry streams on the timeline of the downsampled EEG (down_freq_hz grid)
+# using the time map stored by 02-bonsai_ttl_alignment.py
+# The output is a folder of parquet parts (one per chunk), read it with pl.scan_parquet(f"{folder}/*.parquet")
+
+def joint_output_path(session_eeg_file):
+    # sub-X_ses-Y_desc-down10_eeg.csv.gz -> sub-X_ses-Y_desc-down10_eeg+photometry
+    return session_eeg_file.replace("_eeg.csv.gz", "_eeg+photometry")
+
+def rational_ratio(fs_in, fs_out, max_denominator=1000):
+    """
+    Approximate fs_out / fs_in as up / down for resample_poly (e.g. 1017.25 Hz -> 100 Hz).
+
+    Returns:
+    - up, down: Integers, the resampled rate is fs_in * up / down.
+    """
+    ratio = Fraction(fs_out / fs_in).limit_denominator(max_denominator)
+    return ratio.numerator, ratio.denominator
+
+def read_stream_window(block_folder, store, t1, t2):
+    """
+    Read [t1, t2) seconds of a TDT stream without loading the rest of the block.
+
+    Returns:
+    - data: Array of shape (n_channels, n_samples).
+    - start_time: TDT time of the first sample in seconds.
+    - fs: Sampling frequency of the stream.
+    """
+    import tdt
+    stream = tdt.read_block(block_folder, t1=t1, t2=t2, store=store).streams[store]
+    return np.atleast_2d(stream.data), float(stream.start_time), float(stream.fs)
+
+def resample_window(data, start_time, fs, tdt_times, target_fs):
+    """
+    Anti-alias and decimate a stream window with polyphase filtering and evaluate it at `tdt_times`.
+
+    resample_poly does the rate change, the remaining sub-sample shift and clock drift
+    are applied with a linear interpolation on the resampled grid.
+
+    Parameters:
+    - data: Array of shape (n_channels, n_samples) starting at `start_time` (TDT seconds).
+    - fs: Sampling frequency of `data`.
+    - tdt_times: TDT times (seconds) of the EEG samples.
+    - target_fs: EEG sampling frequency (down_freq_hz).
+
+    Returns:
+    - Array of shape (n_channels, len(tdt_times)), NaN outside of the window.
+    """
+    up, down = rational_ratio(fs, target_fs)
+    resampled = resample_poly(data.astype(np.float64), up, down, axis=-1)
+    resampled_times = start_time + np.arange(resampled.shape[-1]) * down / (fs * up)
+    return np.vstack([np.interp(tdt_times, resampled_times, channel, left=np.nan, right=np.nan) for channel in resampled])
+
+def resample_photometry(session_eeg_file, block_folder, time_map, down_freq_hz, stores, chunk_sec=600, pad_sec=5):
+    """
+    Join the downsampled EEG of a session with the photometry streams of its TDT block.
+
+    The EEG csv is streamed in chunks of `chunk_sec` seconds, and only the matching window of each
+    store (plus `pad_sec` on both sides, to keep the filter edges out) is read from the block,
+    so memory does not grow with the duration of the recording.
+
+    Parameters:
+    - session_eeg_file: Downsampled EEG of the session (desc-down{factor}_eeg.csv.gz).
+    - block_folder: TDT block recorded with the session.
+    - time_map: TimeMap of the session (eeg seconds <-> tdt seconds).
+    - down_freq_hz: Sampling frequency of the downsampled EEG.
+    - stores: TDT stream names to add (e.g. ['_465A', '_405A']).
+
+    Returns:
+    - The output folder with one parquet part per chunk.
+    """
+    output_folder = joint_output_path(session_eeg_file)
+    os.makedirs(output_folder, exist_ok=True)
+    # parts from a previous run could have a different number of chunks
+    for old_part in glob.glob(os.path.join(output_folder, "part-*.parquet")):
+        os.remove(old_part)
+    chunk_rows = int(chunk_sec * down_freq_hz)
+    first_row = 0
+    for part_idx, eeg_chunk in enumerate(pd.read_csv(session_eeg_file, chunksize=chunk_rows)):
+        samples = np.arange(first_row, first_row + len(eeg_chunk))
+        tdt_times = time_map.samples_to_tdt(samples, down_freq_hz)
+        joint = {
+            "sample": samples,
+            "time_sec": samples / down_freq_hz,
+            "tdt_sec": tdt_times,
+        }
+        joint.update({column: eeg_chunk[column].to_numpy() for column in eeg_chunk.columns})
+        t1 = max(tdt_times[0] - pad_sec, 0)
+        t2 = tdt_times[-1] + pad_sec
+        for store in stores:
+            data, start_time, fs = read_stream_window(block_folder, store, t1, t2)
+            if data.shape[-1] == 0:
+                # chunk is outside of the photometry recording
+                resampled = np.full((data.shape[0], len(samples)), np.nan)
+            else:
+                resampled = resample_window(data, start_time, fs, tdt_times, down_freq_hz)
+            if resampled.shape[0] == 1:
+                joint[store] = resampled[0]
+            else:
+                joint.update({f"{store}_ch{ch + 1}": values for ch, values in enumerate(resampled)})
+        pl.DataFrame(joint).write_parquet(os.path.join(output_folder, f"part-{part_idx:05d}.parquet"))
+        first_row += len(eeg_chunk)
+    console.success(f"Wrote {first_row} samples of EEG + photometry to {output_folder}")
+    return output_folder
+
+def run_photometry_resample(session_folder, config, stores=None, chunk_sec=600):
+    """
+    Run resample_photometry() for every session in {session_folder}/aligned/alignment_params.yaml
+    that has a time map and a TDT block. Stores default to config['photometry_stores'] or all block streams.
+    """
+    params_file = os.path.join(session_folder, "aligned", "alignment_params.yaml")
+    with open(params_file) as f:
+        all_params = yaml.safe_load(f)
+    outputs = []
+    for session_eeg_file, params in all_params.items():
+        if "time_map" not in params or "tdt_block_folder" not in params:
+            console.warn(f"No time map or TDT block for {session_eeg_file}, run the alignment again")
+            continue
+        block_folder = params["tdt_block_folder"]["value"]
+        time_map = TimeMap.from_dict(params["time_map"]["value"])
+        session_stores = stores or config.get("photometry_stores") or list(read_tdt_block_info(block_folder, config["pulse_sync"])["streams"])
+        outputs.append(resample_photometry(session_eeg_file, block_folder, time_map, config["down_freq_hz"], session_stores, chunk_sec=chunk_sec))
+    return outputs
+
+if __name__ == '__main__':
+    from utils import read_config
+    parser = argparse.ArgumentParser(description='Resample TDT photometry onto the downsampled EEG of aligned sessions')
+    parser.add_argument('--session_folder', required=True, help='Path to the session folder (ending in yyyy-mm-dd), must be aligned')
+    parser.add_argument('--config_folder', required=True, help='Path to the config folder')
+    parser.add_argument('--stores', nargs='+', default=None, help='TDT streams to resample (default: config photometry_stores or all)')
+    parser.add_argument('--chunk_sec', type=float, default=600, help='Seconds of EEG processed at a time')
+    args = parser.parse_args()
+    run_photometry_resample(args.session_folder, read_config(args.config_folder), stores=args.stores, chunk_sec=args.chunk_sec)
@@ -10,11 +10,17 @@ import polars as pl
 from rlist_files import list_files
 from py_console import console
 from utils import *
+from artifact_rejection import detect_artifacts
+from session_catalog import session_dates
+from prefetch import Prefetcher
 import argparse
 from sklearn.preprocessing import RobustScaler, robust_scale, minmax_scale
 
-def list_session_dates(base_folder, start_date=None):
+def list_session_dates(base_folder, start_date=None, catalog=None):
     # helper to list session dates
+    if catalog is not None:
+        # base_folder ends in the animal id
+        return session_dates(os.path.basename(os.path.normpath(base_folder)), catalog, start_date)
     if not os.path.exists(base_folder) or not os.path.isdir(base_folder):
         console.error(f"Error: The base folder '{base_folder}' does not exist or is not a directory.")
         return []
@@ -26,7 +32,7 @@ def list_session_dates(base_folder, start_date=None):
 
     return folders
 
-def predict_electrode(eeg, emg, sf, epoch_sec = 2.5):
+def predict_electrode(eeg, emg, sf, epoch_sec = 2.5, artifact_epochs = None):
   info =  mne.create_info(["eeg","emg"], 
                           sf, 
                           ch_types='misc', 
@@ -38,7 +44,8 @@ def predict_electrode(eeg, emg, sf, epoch_sec = 2.5):
                      eeg_name="eeg", 
                      emg_name="emg")
   # this will use the new fit function
-  sls.fit(epoch_sec=epoch_sec)
+  # artifact_epochs (if any) are skipped during feature extraction
+  sls.fit(epoch_sec=epoch_sec, artifact_epochs=artifact_epochs)
   # the auto will use these features
   # "/home/matias/anaconda3/lib/python3.7/site-packages/yasa/classifiers/clf_eeg+emg_lgb_0.5.0.joblib"
   predicted_labels = sls.predict(path_to_model="clf_eeg+emg_lgb_gbdt_custom.joblib")
@@ -100,6 +107,13 @@ def consensus_prediction(predictions_df, max_probabilities_df):
     consensus_predictions = weighted_votes_df.idxmax(axis=1)
     return consensus_predictions
 
+def mask_artifact_epochs(hypno, artifacts, epoch_samples, label=-1):
+  # artifacts is an IntervalSet in samples, hypno has one value per epoch
+  # yasa uses -1 for 'Art' and -2 for 'Uns' when converting to strings
+  epoch_is_art = artifacts.epoch_mask(len(hypno), epoch_samples)
+  console.info(f"Masking {epoch_is_art.sum()}/{len(hypno)} epochs overlapping artifacts")
+  return np.where(epoch_is_art, label, hypno)
+
 def check_path_exists(base_folder, date):
   # Check if base folder exists
   if not os.path.exists(base_folder) or not os.path.isdir(base_folder):
@@ -194,8 +208,18 @@ def normalize_data(data, method="robust"):
         scaled = data.select(pl.all().map_batches(lambda x: pl.Series(minmax_scale(x))))
     return scaled
 
-def process_eeg(eeg_df, sf, epoch_sec, robust_scale=True, display=False):
-  # Artifact detection
+def process_eeg(eeg_df, sf, epoch_sec, robust_scale=True, display=False, artifacts=None, artifact_method=None):
+  epoch_samples = int(epoch_sec * sf)
+  # Artifact detection on the raw data, before clipping and scaling
+  if artifact_method is not None:
+    console.info(f"Detecting artifacts using method `{artifact_method}`")
+    detected = detect_artifacts(eeg_df, sf, epoch_sec, method=artifact_method)
+    artifacts = detected if artifacts is None else artifacts | detected
+  artifact_epochs = None
+  if artifacts is not None:
+    artifact_epochs = artifacts.epoch_mask(eeg_df.height // epoch_samples, epoch_samples)
+    console.warn(f"Skipping {artifact_epochs.sum()} artifacted epochs during feature computation")
+  # Artifact clipping
   lower_quant = 0.01
   upper_quant = 0.99
   console.info(f"Performing artifact clipping with lower:{lower_quant} and upper:{upper_quant}")
@@ -228,7 +252,7 @@ def process_eeg(eeg_df, sf, epoch_sec, robust_scale=True, display=False):
         emg_diff = eeg_df["EMG1"]
         #emg_diff = eeg_df['EMG2'] - eeg_df['EMG1']
         # Perform prediction and plot spectrogram for the EEG channel
-        hypno, proba = predict_electrode(eeg=eeg, emg=emg_diff, sf = sf, epoch_sec=epoch_sec)
+        hypno, proba = predict_electrode(eeg=eeg, emg=emg_diff, sf = sf, epoch_sec=epoch_sec, artifact_epochs=artifact_epochs)
         #plot_spectrogram(eeg, hypno)
         # Store hypno and proba in the results dictionary under the column key
         results[column] = {"hypno": hypno, "proba": proba}
@@ -242,6 +266,10 @@ def process_eeg(eeg_df, sf, epoch_sec, robust_scale=True, display=False):
   # TODO: This is likely a waste of time/effort
   mfv = get_most_frequent_value(hypno_predictions_df)
   consensus = consensus_prediction(hypno_predictions_df, max_probabilities_df)
+  if artifacts is not None:
+    # artifacts is an IntervalSet (in samples) from the artifact detectors
+    consensus = mask_artifact_epochs(consensus.to_numpy(), artifacts, epoch_samples)
+    mfv = mask_artifact_epochs(mfv, artifacts, epoch_samples)
   # agregate into an output dataframe
   consensus_df = pd.DataFrame({'consensus': consensus, 'mfv' : mfv}).apply(yasa.hypno_int_to_str)
   return {'hypno_predictions_df': hypno_predictions_df, 'max_probabilities_df': max_probabilities_df, 'consensus_df': consensus_df}
@@ -257,8 +285,14 @@ def save_predictions(data_dict, saving_folder, animal_id, session_id):
 def is_dataframe(df):
   return isinstance(df, pl.dataframe.frame.DataFrame) or isinstance(df, pd.DataFrame)
 
-def run_and_save_predictions(animal_id, date, epoch_sec, eeg_data_dict = None, config=None, robust_scale=True, display=False):
-  base_folder = os.path.join("/synology-nas/MLA/beelink1", animal_id)
+def read_downsampled_eegs(eeg_folder):
+  # {eeg_file: DataFrame} of the downsampled files of a session, what run_and_save_predictions() takes as eeg_data_dict
+  eeg_files = list_files(eeg_folder, pattern = "*desc-down*csv.gz", full_names = True)
+  return {eeg_file: pl.read_csv(eeg_file) for eeg_file in eeg_files}
+
+def run_and_save_predictions(animal_id, date, epoch_sec, eeg_data_dict = None, config=None, robust_scale=True, display=False, artifact_method=None, base_folder=None):
+  if base_folder is None:
+    base_folder = os.path.join("/synology-nas/MLA/beelink1", animal_id)
   # coerce date back to yyyy-mm-dd as character
   date = str(date)
   session_folder, eeg_folder = check_path_exists(base_folder, date)
@@ -278,7 +312,7 @@ def run_and_save_predictions(animal_id, date, epoch_sec, eeg_data_dict = None, c
     for eeg_file, df in eeg_data_dict.items():
       session_id = parse_bids_session(os.path.basename(eeg_file))
       console.log(f"session_id: {session_id}. Predicting electrodes in file {os.path.basename(eeg_file)}.")
-      output_dict = process_eeg(df, sf, epoch_sec, display)
+      output_dict = process_eeg(df, sf, epoch_sec, robust_scale, display, artifact_method=artifact_method)
       save_predictions(output_dict, saving_folder, animal_id, session_id)
   else: 
     # Find downsampled eeg files and trigger prediction for each
@@ -294,7 +328,7 @@ def run_and_save_predictions(animal_id, date, epoch_sec, eeg_data_dict = None, c
       session_id = parse_bids_session(os.path.basename(eeg_file))
       eeg_df = pl.read_csv(eeg_file)
       console.log(f"session_id: {session_id}. Predicting electrodes in file {os.path.basename(eeg_file)}.")
-      output_dict = process_eeg(eeg_df, sf, epoch_sec, robust_scale, display)
+      output_dict = process_eeg(eeg_df, sf, epoch_sec, robust_scale, display, artifact_method=artifact_method)
       # Save the data 
       save_predictions(output_dict, saving_folder, animal_id, session_id)
 
@@ -307,6 +341,9 @@ if __name__ == '__main__':
   parser.add_argument('--config_folder', help='Path to the config folder')
   parser.add_argument("--epoch_sec", type=float, required=True, help="Epoch for sleep predictions in seconds. Ideally, it matches the classifier epoch_sec")
   parser.add_argument("--base_folder", required=False, help="Full path of base folder (everything before `animal_id`) if not using default hard-coded one", default=None)
+  parser.add_argument("--artifact_method", required=False, choices=["std", "power"], default=None, help="Optional artifact detection before staging. Artifacted epochs are not featurized and are labeled 'Art'")
+  parser.add_argument("--catalog", required=False, default=None, help="Session catalog (see session_catalog.py) to query instead of listing the NAS folders")
+  parser.add_argument("--lookahead", type=int, default=1, help="Days of downsampled data read ahead from the NAS while one is predicted (0 to disable)")
 
   args = parser.parse_args()
   config = read_config(args.config_folder)
@@ -324,8 +361,15 @@ if __name__ == '__main__':
   if args.date:
       dates = [args.date]
   else:  # args.start_date is given
-      dates = list_session_dates(base_folder, args.start_date)
+      dates = list_session_dates(base_folder, args.start_date, catalog=args.catalog)
+
+  def prefetch_day(date):
+      eeg_folder = os.path.join(base_folder, str(date), "eeg")
+      return read_downsampled_eegs(eeg_folder) if os.path.isdir(eeg_folder) else {}
 
-  for date in dates:
+  # the csv of the next `lookahead` days are read while one day is predicted
+  for date, eeg_data_dict in Prefetcher(dates, prefetch_day, args.lookahead):
       console.log(f'Processing for date: {date}')
-      run_and_save_predictions(animal_id=args.animal_id, date=date, epoch_sec=args.epoch_sec, config=config)
+      # nothing found: let run_and_save_predictions() look again and report it
+      run_and_save_predictions(animal_id=args.animal_id, date=date, epoch_sec=args.epoch_sec, eeg_data_dict=eeg_data_dict or None,
+                               config=config, artifact_method=args.artifact_method, base_folder=base_folder)
@@ -0,0 +1,110 @@
+import os
+import queue
+import threading
+from py_console import console
+
+# Overlap NAS reads with compute in the multi-day batch runs
+# While day N is filtered/predicted, a background thread loads day N+1 (up to `lookahead` days ahead)
+#   Prefetcher: runs any loader (e.g. pl.read_csv of the downsampled files) into a bounded buffer
+#   warm_cache: asks the kernel to read the raw files ahead (posix_fadvise WILLNEED) so that the
+#               later np.fromfile/memmap comes from the page cache instead of the network
+
+# posix_fadvise is only a hint, reading the file is the fallback where it is not available
+WARM_BLOCK_SIZE = 8 * 2**20
+
+
+class Prefetcher:
+    """
+    Iterate over (item, load(item)) in order, loading up to `lookahead` items ahead in a thread.
+
+    Exceptions raised by load() are raised again when their item is reached.
+    Leaving the loop early (break, exception) stops the thread, use it as a context manager
+    or call close().
+
+    Parameters:
+    - items: Iterable of inputs (e.g. session dates).
+    - load: Function of one item, runs in the background thread.
+    - lookahead: Items loaded ahead of the one being used (0 loads in the caller thread, no prefetch).
+    """
+
+    def __init__(self, items, load, lookahead=1):
+        self.items = items
+        self.load = load
+        self.lookahead = lookahead
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _wait_slot(self):
+        # one slot per item loaded ahead, checks for close() now and then
+        while not self._stop.is_set():
+            if self._slots.acquire(timeout=0.1):
+                return True
+        return False
+
+    def _worker(self, buffer):
+        try:
+            for item in self.items:
+                if not self._wait_slot():
+                    return
+                try:
+                    buffer.put((item, self.load(item), None))
+                except Exception as e:
+                    buffer.put((item, None, e))
+        finally:
+            # end of the items
+            buffer.put(None)
+
+    def __iter__(self):
+        if self.lookahead <= 0:
+            for item in self.items:
+                yield item, self.load(item)
+            return
+        buffer = queue.Queue()
+        self._slots = threading.Semaphore(self.lookahead)
+        self._thread = threading.Thread(target=self._worker, args=(buffer,), daemon=True)
+        self._thread.start()
+        try:
+            while (entry := buffer.get()) is not None:
+                item, result, error = entry
+                # the item in use does not count, the next one can start loading
+                self._slots.release()
+                if error is not None:
+                    raise error
+                yield item, result
+        finally:
+            self.close()
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def warm_cache(files):
+    """
+    Get the files into the page cache ahead of their read.
+
+    Returns:
+    - Bytes requested.
+    """
+    total = 0
+    for file in files:
+        try:
+            with open(file, "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                if hasattr(os, "posix_fadvise"):
+                    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+                else:
+                    while f.read(WARM_BLOCK_SIZE):
+                        pass
+                total += size
+        except OSError as e:
+            # a hint, the real read will report the problem
+            console.warn(f"Could not prefetch {file}: {e}")
+    return total
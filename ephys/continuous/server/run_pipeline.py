@@ -4,8 +4,18 @@ import datetime
 from py_console import console
 from bonsai_dat_to_npy_eeg import *
 from predict import *
+from session_catalog import find_files
+from prefetch import Prefetcher, warm_cache
 
-def run_pipeline(base_folder, start_date=None, animal_id=None):
+def day_eeg_files(ephys_folder_path, catalog=None):
+    if catalog is not None:
+        file_list = find_files(catalog, kind="eeg", folder=ephys_folder_path)
+    else:
+        file_list = list_files(ephys_folder_path, pattern="_eeg.bin", full_names=True)
+    # a .bin and its .binz archive are the same recording
+    return bin_sources(file_list)
+
+def run_pipeline(base_folder, start_date=None, animal_id=None, catalog=None, lookahead=1):
 
     # Check if base folder exists
     if not os.path.exists(base_folder) or not os.path.isdir(base_folder):
@@ -13,29 +23,28 @@ def run_pipeline(base_folder, start_date=None, animal_id=None):
         console.error("Make sure the path is correct and/or the NAS is mounted properly to the '/synology-nas' directory.")
         return
 
-    # Get a sorted list of folders
-    folders = sorted(entry for entry in os.listdir(base_folder) if os.path.isdir(os.path.join(base_folder, entry)))
-    # only keep the ones with date pattern
-    folders = [folder for folder in folders if is_valid_date(folder)]
-
-    # Filter folders based on the start date
+    # Get a sorted list of session folders (with date pattern) from the start date
     if start_date:
-        start_datetime = datetime.datetime.strptime(start_date, "%Y-%m-%d")
-        folders = [folder for folder in folders if datetime.datetime.strptime(folder, "%Y-%m-%d") >= start_datetime]
+        start_date = datetime.datetime.strptime(start_date, "%Y-%m-%d").date()
+    folders = list_session_dates(base_folder, start_date, catalog=catalog)
 
     # TODO: We assume one config per animal at base_folder....this might change soon
-    config = read_config(base_folder)
+    config = read_config(base_folder, catalog=catalog)
     assert config['down_freq_hz'] is not None, "No down_freq_hz in config. Exiting function"
     assert config["aq_freq_hz"] > config["down_freq_hz"], f"{config['aq_freq_hz']} must be greater than {config['down_freq_hz']}"
 
-    # Loop over the folders
-    for folder in folders:
+    def prefetch_day(folder):
+        # runs in the background while the previous days are filtered: list the files
+        # and have the kernel read them from the NAS into the page cache
+        file_list = day_eeg_files(os.path.join(base_folder, folder, "eeg"), catalog)
+        warm_cache(file_list)
+        return file_list
+
+    # Loop over the folders, `lookahead` days are fetched while one is processed
+    for folder, file_list in Prefetcher(folders, prefetch_day, lookahead):
         ephys_folder_path = os.path.join(base_folder, folder, "eeg")
         ttl_folder_path = os.path.join(base_folder, folder, "ttl")
-        # Handle file finding
-        console.info(f"Working on {ephys_folder_path}.")
-        console.info("Finding _eeg.bin files")
-        file_list = list_files(ephys_folder_path, pattern="_eeg.bin", full_names=True)
+        console.info(f"Working on {ephys_folder_path} ({len(file_list)} _eeg.bin files).")
 
         #TODO: ADD the creation and checking of parameter dicts
         # THIS WOULD HELP US SKIP STEPS IF PREVIOUSLY COMPUTED
@@ -63,6 +72,8 @@ if __name__ == "__main__":
     parser.add_argument("--start_date", help="Starting date for batch processing (format: YYYY-MM-DD)")
     parser.add_argument("--animal_id", required=True, help="Animal ID for constructing the base path")
     parser.add_argument("--base_folder", required=False, help="Full path of base folder (everything before `animal_id`) if not using default hard-coded one", default=None)
+    parser.add_argument("--catalog", required=False, default=None, help="Session catalog (see session_catalog.py) to query instead of listing the NAS folders")
+    parser.add_argument("--lookahead", type=int, default=1, help="Days read ahead from the NAS while one is processed (0 to disable)")
     args = parser.parse_args()
     if args.base_folder is not None:
         base_folder = os.path.join(args.base_folder, args.animal_id)
@@ -72,4 +83,4 @@ if __name__ == "__main__":
         base_folder = os.path.join("/synology-nas/MLA/beelink1", args.animal_id)
         console.warn(f"Using Hard-Coded path: {base_folder}")
 
-    run_pipeline(base_folder, args.start_date, args.animal_id)
\ No newline at end of file
+    run_pipeline(base_folder, args.start_date, args.animal_id, catalog=args.catalog, lookahead=args.lookahead)
\ No newline at end of file
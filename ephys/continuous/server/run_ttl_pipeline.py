@@ -1,11 +1,44 @@
 import os
 import argparse
+import importlib
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from py_console import console
 from bonsai_dat_to_npy_eeg import *
 from predict import *
+from tdt_matching import index_tdt_blocks
 
-def run_ttl_pipeline(start_date=None, animal_id=None):
+# the alignment script name starts with a digit, so we import it by name
+alignment = importlib.import_module("02-bonsai_ttl_alignment")
+
+def align_session(session_folder, config_folder, tdt_index):
+    # runs in a worker process, failures are reported back instead of killing the pool
+    try:
+        alignment.run_alignment(ephys_folder=session_folder, config_folder=config_folder, tdt_index=tdt_index)
+        return session_folder, None
+    except (Exception, SystemExit) as e:
+        return session_folder, repr(e)
+
+def align_sessions(session_folders, config_folder, tdt_index, n_workers=2):
+    """
+    Align all sessions in a pool of workers. Alignment is called in-process (no subprocess per folder).
+
+    Returns:
+    - A dict of {session_folder: error}, error is None for the sessions that succeeded.
+    """
+    results = {}
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = [executor.submit(align_session, folder, config_folder, tdt_index) for folder in session_folders]
+        for future in as_completed(futures):
+            session_folder, error = future.result()
+            results[session_folder] = error
+            if error is None:
+                console.success(f"Aligned {session_folder}")
+            else:
+                console.error(f"Alignment failed for {session_folder}: {error}")
+    return results
+
+def run_ttl_pipeline(start_date=None, animal_id=None, tdt_folder="/synology-nas/MLA/TDT", n_workers=2):
     base_folder = f"/synology-nas/MLA/beelink1/{animal_id}"
 
     # Check if base folder exists
@@ -29,29 +62,32 @@ def run_ttl_pipeline(start_date=None, animal_id=None):
     assert config['down_freq_hz'] is not None, "No down_freq_hz in config. Exiting function"
     assert config["aq_freq_hz"] > config["down_freq_hz"], f"{config['aq_freq_hz']} must be greater than {config['down_freq_hz']}"
 
-    # Loop over the folders
-    for folder in folders:
-        ephys_folder_path = os.path.join(base_folder, folder, "eeg")
-        ttl_folder_path = os.path.join(base_folder, folder, "ttl")
-        # Handle file finding
-        console.info(f"Working on {ephys_folder_path}.")
-        # Optionally, you can add any post-processing steps here
-        if os.path.isdir(ttl_folder_path):
-            console.info("Found ttl folder, there's an interactive folder selection in this step!")
-            # do the alignment, this is interactive to select the specific TDT data though
-            command = f"python3 02-bonsai_ttl_alignment.py --session_folder {os.path.dirname(ttl_folder_path)} --config_folder {base_folder}"
-            os.system(command)
-            # do the prediction of the aligned files
-            aligned_folder = os.path.join(folder, "aligned")
-            run_and_save_predictions(animal_id, date=aligned_folder, epoch_sec = 2.5,  config=config, display=False)
-            # Print a newline for separation between iterations
-            console.log(f"Finished folder {folder}")
-        else:
-            console.info(f"No ttl files in {folder}")
+    ttl_folders = [folder for folder in folders if os.path.isdir(os.path.join(base_folder, folder, "ttl"))]
+    for folder in sorted(set(folders) - set(ttl_folders)):
+        console.info(f"No ttl files in {folder}")
+    if not ttl_folders:
+        return
+
+    # Index the TDT blocks once, every session is matched against this index
+    tdt_index = index_tdt_blocks(tdt_folder, config['pulse_sync'])
+    session_folders = [os.path.join(base_folder, folder) for folder in ttl_folders]
+    results = align_sessions(session_folders, base_folder, tdt_index, n_workers=n_workers)
+
+    # Loop over the aligned folders
+    for folder in ttl_folders:
+        if results[os.path.join(base_folder, folder)] is not None:
+            continue
+        # do the prediction of the aligned files
+        aligned_folder = os.path.join(folder, "aligned")
+        run_and_save_predictions(animal_id, date=aligned_folder, epoch_sec = 2.5,  config=config, display=False)
+        # Print a newline for separation between iterations
+        console.log(f"Finished folder {folder}")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--start_date", help="Starting date for batch processing (format: YYYY-MM-DD)")
     parser.add_argument("--animal_id", required=True, help="Animal ID for constructing the base path")
+    parser.add_argument("--tdt_folder", default="/synology-nas/MLA/TDT", help="Root folder with the TDT blocks to match against")
+    parser.add_argument("--n_workers", type=int, default=2, help="Number of sessions aligned in parallel")
     args = parser.parse_args()
-    run_ttl_pipeline(args.start_date, args.animal_id)
\ No newline at end of file
+    run_ttl_pipeline(args.start_date, args.animal_id, tdt_folder=args.tdt_folder, n_workers=args.n_workers)
@@ -0,0 +1,226 @@
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import argparse
+import datetime
+import yaml
+from py_console import console
+from bin_archive import is_archive, archive_nsamples
+
+# Local SQLite catalog of the raw and derived files on the NAS
+# (/synology-nas/MLA/beelink1/<animal>/<YYYY-MM-DD>/<eeg|ttl|...>/sub-<animal>_ses-<YYYYMMDDTHHMMSS>_*)
+# update_catalog() stats the tree and only re-parses files whose size or mtime changed,
+# the entry points query it instead of listing folders and parsing timestamps every run
+
+DEFAULT_CATALOG = os.path.expanduser("~/.phdutils/session_catalog.sqlite")
+
+# (kind, pattern on the file name), first match wins
+FILE_KINDS = [
+    ("eeg_down", re.compile(r"desc-down\d+_eeg\.csv\.gz$")),
+    ("eeg", re.compile(r"_eeg\.binz?$")),
+    ("ttl", re.compile(r"_ttl_in\.binz?$")),
+    ("ttl_events", re.compile(r"_ttl_events\.csv\.gz$")),
+    ("accel", re.compile(r"_accel\.bin$")),
+    ("camframes", re.compile(r"_camframes\.csv\.gz$")),
+    ("video", re.compile(r"\.(avi|mp4|mkv)$")),
+    ("timestamp", re.compile(r"timestamp.*\.(csv|txt)$")),
+    ("alignment", re.compile(r"alignment_params\.yaml$")),
+    ("config", re.compile(r"config\.yaml$")),
+]
+# derived kind -> kind of the files it comes from (same animal and session timestamp)
+DERIVED_FROM = {
+    "eeg_down": "eeg",
+    "ttl_events": "ttl",
+    "camframes": "eeg",
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    animal TEXT,
+    session_date TEXT,
+    session_ts TEXT,
+    kind TEXT,
+    size INTEGER,
+    n_samples INTEGER,
+    mtime REAL,
+    config_hash TEXT
+);
+CREATE INDEX IF NOT EXISTS files_animal_date ON files (animal, session_date, kind);
+CREATE TABLE IF NOT EXISTS links (
+    path TEXT,
+    source TEXT,
+    PRIMARY KEY (path, source)
+);
+"""
+
+def connect(catalog=DEFAULT_CATALOG):
+    if os.path.dirname(catalog):
+        os.makedirs(os.path.dirname(catalog), exist_ok=True)
+    con = sqlite3.connect(catalog)
+    con.executescript(SCHEMA)
+    return con
+
+def file_kind(path):
+    name = os.path.basename(path)
+    return next((kind for kind, pattern in FILE_KINDS if pattern.search(name)), "other")
+
+def parse_path(path, root):
+    """
+    Animal, session date (YYYY-MM-DD folder) and session timestamp (ISO) of a file, None when missing.
+    The animal comes from `sub-<animal>_` or from the first folder under root.
+    """
+    name = os.path.basename(path)
+    parts = os.path.relpath(path, root).split(os.sep)
+    animal = re.match(r"sub-([^_]+)_", name)
+    animal = animal.group(1) if animal else (parts[0] if len(parts) > 1 else None)
+    session_date = next((part for part in parts[:-1] if re.fullmatch(r"\d{4}-\d{2}-\d{2}", part)), None)
+    session_ts = re.search(r"\d{8}T\d{6}", name)
+    if session_ts:
+        session_ts = datetime.datetime.strptime(session_ts.group(), "%Y%m%dT%H%M%S").isoformat()
+    return animal, session_date, session_ts
+
+def config_hash(config_file):
+    with open(config_file, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def sample_count(path, kind, config):
+    # from the file size, nothing is read
+    if config is None:
+        return None
+    if is_archive(path):
+        # compressed (bin_archive.py), the count is in its index
+        return archive_nsamples(path)
+    if kind == "eeg":
+        frame_bytes = 4 * len(config["selected_channels"])
+    elif kind == "ttl":
+        frame_bytes = len(config["ttl_names"])
+    elif kind == "accel":
+        frame_bytes = 4 * 3
+    else:
+        return None
+    return os.path.getsize(path) // frame_bytes
+
+def _walk(root):
+    # os.scandir gives the stat of each entry without an extra call on most file systems
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    stat = entry.stat()
+                    yield entry.path, stat.st_size, stat.st_mtime
+
+def _nearest_config(path, root, configs):
+    # closest config.yaml going up from the file, up to root
+    folder = os.path.dirname(path)
+    while True:
+        if folder in configs:
+            return configs[folder]
+        if os.path.normpath(folder) == os.path.normpath(root) or os.path.dirname(folder) == folder:
+            return None
+        folder = os.path.dirname(folder)
+
+def update_catalog(root, catalog=DEFAULT_CATALOG):
+    """
+    Bring the catalog up to date with the files under `root`.
+    New files and files whose size/mtime changed are (re)parsed, removed files are dropped.
+    A changed config.yaml re-parses the files it applies to.
+
+    Returns:
+    - A dict with the number of added, updated, removed and unchanged files.
+    """
+    start = time.time()
+    con = connect(catalog)
+    root = os.path.abspath(root)
+    known = {path: (size, mtime) for path, size, mtime in con.execute(
+        "SELECT path, size, mtime FROM files WHERE path LIKE ?", (root + os.sep + "%",))}
+    on_disk = {path: (size, mtime) for path, size, mtime in _walk(root)}
+
+    # configs first, they are needed for the sample counts and hashes
+    configs = {}
+    for path in on_disk:
+        if file_kind(path) == "config":
+            with open(path) as f:
+                configs[os.path.dirname(path)] = (yaml.safe_load(f), config_hash(path))
+    old_hashes = dict(con.execute("SELECT path, config_hash FROM files WHERE path LIKE ?", (root + os.sep + "%",)))
+
+    counts = {"added": 0, "updated": 0, "removed": 0, "unchanged": 0}
+    rows = []
+    for path, (size, mtime) in on_disk.items():
+        config, hash_ = _nearest_config(path, root, configs) or (None, None)
+        if known.get(path) == (size, mtime) and old_hashes.get(path) == hash_:
+            counts["unchanged"] += 1
+            continue
+        counts["updated" if path in known else "added"] += 1
+        kind = file_kind(path)
+        animal, session_date, session_ts = parse_path(path, root)
+        rows.append((path, animal, session_date, session_ts, kind, size, sample_count(path, kind, config), mtime, hash_))
+    removed = [(path,) for path in known if path not in on_disk]
+    counts["removed"] = len(removed)
+    with con:
+        con.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        con.executemany("DELETE FROM files WHERE path = ?", removed)
+        con.executemany("DELETE FROM links WHERE path = ? OR source = ?", [(path, path) for (path,) in removed])
+        # derived-from links, matched on animal + session timestamp
+        for derived, source in DERIVED_FROM.items():
+            con.execute("""
+                INSERT OR IGNORE INTO links (path, source)
+                SELECT d.path, s.path FROM files d JOIN files s
+                ON d.animal = s.animal AND d.session_ts = s.session_ts
+                WHERE d.kind = ? AND s.kind = ? AND d.path LIKE ?""", (derived, source, root + os.sep + "%"))
+    con.close()
+    console.info(f"Catalog updated in {time.time() - start:.1f} sec: {counts}")
+    return counts
+
+def find_files(catalog=DEFAULT_CATALOG, animal=None, kind=None, session_date=None, folder=None, pattern=None):
+    """
+    Query the catalog. All filters are optional, `folder` only matches files directly inside it
+    and `pattern` is a substring of the file name (same as list_files(pattern=...)).
+
+    Returns:
+    - Sorted list of paths.
+    """
+    query, args = "SELECT path FROM files WHERE 1 = 1", []
+    for column, value in [("animal", animal), ("kind", kind), ("session_date", session_date)]:
+        if value is not None:
+            query += f" AND {column} = ?"
+            args.append(value)
+    con = connect(catalog)
+    paths = [path for (path,) in con.execute(query, args)]
+    con.close()
+    if folder is not None:
+        folder = os.path.abspath(folder)
+        paths = [path for path in paths if os.path.dirname(path) == folder]
+    if pattern is not None:
+        paths = [path for path in paths if pattern in os.path.basename(path)]
+    return sorted(paths)
+
+def session_dates(animal, catalog=DEFAULT_CATALOG, start_date=None):
+    """
+    Session folders (YYYY-MM-DD) of an animal, optionally from `start_date` (datetime.date) on.
+    """
+    con = connect(catalog)
+    dates = [date for (date,) in con.execute(
+        "SELECT DISTINCT session_date FROM files WHERE animal = ? AND session_date IS NOT NULL ORDER BY session_date", (animal,))]
+    con.close()
+    if start_date:
+        dates = [date for date in dates if datetime.datetime.strptime(date, "%Y-%m-%d").date() >= start_date]
+    return dates
+
+def derived_from(path, catalog=DEFAULT_CATALOG):
+    con = connect(catalog)
+    sources = [source for (source,) in con.execute("SELECT source FROM links WHERE path = ? ORDER BY source", (os.path.abspath(path),))]
+    con.close()
+    return sources
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Update the local catalog of session files")
+    parser.add_argument("--root", default="/synology-nas/MLA/beelink1", help="Folder with one subfolder per animal")
+    parser.add_argument("--catalog", default=DEFAULT_CATALOG, help="Path of the SQLite catalog")
+    args = parser.parse_args()
+    update_catalog(args.root, args.catalog)
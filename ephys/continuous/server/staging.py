@@ -9,6 +9,7 @@ import pandas as pd
 import antropy as ant
 import scipy.signal as sp_sig
 import scipy.stats as sp_stats
+from scipy.integrate import trapezoid
 import matplotlib.pyplot as plt
 from mne.filter import filter_data
 from sklearn.preprocessing import robust_scale
@@ -19,6 +20,75 @@ from yasa.spectral import bandpower_from_psd_ndarray
 logger = logging.getLogger('yasa')
 
 
+def epoch_features(epochs, sf, ch_type, bands=None, freq_broad=(0.4, 30), win_sec=5):
+    """Features of already filtered epochs of one channel (see SleepStaging.fit).
+
+    Parameters
+    ----------
+    epochs : array of shape (n_epochs, n_samples)
+    sf : float
+        Sampling frequency.
+    ch_type : str
+        'eeg', 'eog' or 'emg'. Band powers are only computed for eeg and eog,
+        power ratios only for eeg.
+
+    Returns
+    -------
+    feat : dict
+        One array of n_epochs values per feature (without the channel prefix).
+    """
+    win = int(win_sec * sf)
+    kwargs_welch = dict(window='hamming', nperseg=win, average='median')
+    if bands is None:
+        bands = [
+            (0.4, 1, 'sdelta'), (1, 4, 'fdelta'), (4, 8, 'theta'),
+            (8, 12, 'alpha'), (12, 16, 'sigma'), (16, 30, 'beta')
+        ]
+
+    # Calculate standard descriptive statistics
+    hmob, hcomp = ant.hjorth_params(epochs, axis=1)
+
+    feat = {
+        'std': np.std(epochs, ddof=1, axis=1),
+        'iqr': sp_stats.iqr(epochs, rng=(25, 75), axis=1),
+        'skew': sp_stats.skew(epochs, axis=1),
+        'kurt': sp_stats.kurtosis(epochs, axis=1),
+        'nzc': ant.num_zerocross(epochs, axis=1),
+        'hmob': hmob,
+        'hcomp': hcomp
+    }
+
+    # Calculate spectral power features (for EEG + EOG)
+    freqs, psd = sp_sig.welch(epochs, sf, **kwargs_welch)
+    if ch_type != 'emg':
+        bp = bandpower_from_psd_ndarray(psd, freqs, bands=bands)
+        for j, (_, _, b) in enumerate(bands):
+            feat[b] = bp[j]
+
+    # Add power ratios for EEG
+    # TODO: when some bands are not included, 
+    # this results in key error
+    if ch_type == 'eeg':
+        delta = feat['sdelta'] + feat['fdelta']
+        feat['dt'] = delta / feat['theta']
+        feat['ds'] = delta / feat['sigma']
+        feat['db'] = delta / feat['beta']
+        feat['at'] = feat['alpha'] / feat['theta']
+
+    # Add total power
+    idx_broad = np.logical_and(freqs >= freq_broad[0], freqs <= freq_broad[1])
+    dx = freqs[1] - freqs[0]
+    feat['abspow'] = trapezoid(psd[:, idx_broad], dx=dx)
+
+    # Calculate entropy and fractal dimension features
+    feat['perm'] = np.apply_along_axis(
+        ant.perm_entropy, axis=1, arr=epochs, normalize=True)
+    feat['higuchi'] = np.apply_along_axis(
+        ant.higuchi_fd, axis=1, arr=epochs)
+    feat['petrosian'] = ant.petrosian_fd(epochs, axis=1)
+    return feat
+
+
 class SleepStaging:
     """
     Automatic sleep staging of polysomnography data.
@@ -210,12 +280,15 @@ class SleepStaging:
         self.data = data
         self.metadata = metadata
 
-    def fit(self, epoch_sec=30, bands=None):
+    def fit(self, epoch_sec=30, bands=None, artifact_epochs=None):
         """Extract features from data.
         Returns
         -------
         self : returns an instance of self.
         epoch_sec: Time window in seconds to be used for feature extraction. Defaults to 30 seconds.
+        artifact_epochs: Boolean array with one value per epoch. Features are not computed for
+            epochs flagged as True and these epochs do not enter the rolling normalizations.
+            Their rows are left as NaN in the features. Defaults to None (use all epochs).
         """
         #######################################################################
         # MAIN PARAMETERS
@@ -223,16 +296,7 @@ class SleepStaging:
     
         # Bandpass filter
         freq_broad = (0.4, 30)
-        # FFT & bandpower parameters
-        win_sec = min(5, epoch_sec)  # = 2 / freq_broad[0]
         sf = self.sf
-        win = int(win_sec * sf)
-        kwargs_welch = dict(window='hamming', nperseg=win, average='median')
-        if bands is None:
-          bands = [
-              (0.4, 1, 'sdelta'), (1, 4, 'fdelta'), (4, 8, 'theta'),
-              (8, 12, 'alpha'), (12, 16, 'sigma'), (16, 30, 'beta')
-          ]
     
         #######################################################################
         # CALCULATE FEATURES
@@ -247,51 +311,25 @@ class SleepStaging:
                 self.data[i, :], sf, l_freq=freq_broad[0], h_freq=freq_broad[1], verbose=False)
             # - Extract epochs. Data is now of shape (n_epochs, n_samples).
             times, epochs = sliding_window(dt_filt, sf=sf, window=epoch_sec)
+            n_epochs = epochs.shape[0]
+            if artifact_epochs is not None:
+                artifact_epochs = np.asarray(artifact_epochs, dtype=bool)[:n_epochs]
+                assert len(artifact_epochs) == n_epochs, f'artifact_epochs must have {n_epochs} values'
+                clean_idx = np.flatnonzero(~artifact_epochs)
+                # only featurize the clean epochs
+                times, epochs = times[clean_idx], epochs[clean_idx]
+            else:
+                clean_idx = np.arange(n_epochs)
     
-            # Calculate standard descriptive statistics
-            hmob, hcomp = ant.hjorth_params(epochs, axis=1)
-    
-            feat = {
-                'std': np.std(epochs, ddof=1, axis=1),
-                'iqr': sp_stats.iqr(epochs, rng=(25, 75), axis=1),
-                'skew': sp_stats.skew(epochs, axis=1),
-                'kurt': sp_stats.kurtosis(epochs, axis=1),
-                'nzc': ant.num_zerocross(epochs, axis=1),
-                'hmob': hmob,
-                'hcomp': hcomp
-            }
-    
-            # Calculate spectral power features (for EEG + EOG)
-            freqs, psd = sp_sig.welch(epochs, sf, **kwargs_welch)
-            if c != 'emg':
-                bp = bandpower_from_psd_ndarray(psd, freqs, bands=bands)
-                for j, (_, _, b) in enumerate(bands):
-                    feat[b] = bp[j]
-    
-            # Add power ratios for EEG
-            # TODO: when some bands are not included, 
-            # this results in key error
-            if c == 'eeg':
-                delta = feat['sdelta'] + feat['fdelta']
-                feat['dt'] = delta / feat['theta']
-                feat['ds'] = delta / feat['sigma']
-                feat['db'] = delta / feat['beta']
-                feat['at'] = feat['alpha'] / feat['theta']
-    
-            # Add total power
-            idx_broad = np.logical_and(freqs >= freq_broad[0], freqs <= freq_broad[1])
-            dx = freqs[1] - freqs[0]
-            feat['abspow'] = np.trapz(psd[:, idx_broad], dx=dx)
-    
-            # Calculate entropy and fractal dimension features
-            feat['perm'] = np.apply_along_axis(
-                ant.perm_entropy, axis=1, arr=epochs, normalize=True)
-            feat['higuchi'] = np.apply_along_axis(
-                ant.higuchi_fd, axis=1, arr=epochs)
-            feat['petrosian'] = ant.petrosian_fd(epochs, axis=1)
+            if len(clean_idx):
+                feat = epoch_features(epochs, sf, c, bands=bands, freq_broad=freq_broad, win_sec=min(5, epoch_sec))
+            else:
+                # every epoch is artifacted (e.g. electrode off), only the feature names are kept
+                feat = {name: np.empty(0) for name in epoch_features(
+                    dt_filt[None, :int(epoch_sec * sf)], sf, c, bands=bands, freq_broad=freq_broad, win_sec=min(5, epoch_sec))}
     
             # Convert to dataframe
-            feat = pd.DataFrame(feat).add_prefix(c + '_')
+            feat = pd.DataFrame(feat, index=clean_idx).add_prefix(c + '_')
             features.append(feat)
     
         #######################################################################
@@ -311,16 +349,20 @@ class SleepStaging:
         #          0.875, 0.75, 0.625, 0.5, 0.375, 0.25, 0.125]
         rollc = features.rolling(
             window=15, center=True, min_periods=1, win_type='triang').mean()
-        rollc[rollc.columns] = robust_scale(rollc, quantile_range=(5, 95))
+        if len(features):
+            rollc[rollc.columns] = robust_scale(rollc, quantile_range=(5, 95))
         rollc = rollc.add_suffix('_c7min_norm')
     
         # Now look at the past 2 minutes
         rollp = features.rolling(window=4, min_periods=1).mean()
-        rollp[rollp.columns] = robust_scale(rollp, quantile_range=(5, 95))
+        if len(features):
+            rollp[rollp.columns] = robust_scale(rollp, quantile_range=(5, 95))
         rollp = rollp.add_suffix('_p2min_norm')
     
         # Add to current set of features
         features = features.join(rollc).join(rollp)
+        # Artifacted epochs come back as rows of NaN so the index still matches the epochs
+        features = features.reindex(pd.RangeIndex(n_epochs, name='epoch'))
     
         #######################################################################
         # TEMPORAL + METADATA FEATURES AND EXPORT
@@ -352,6 +394,7 @@ class SleepStaging:
     
         # Add to self
         self._features = features
+        self._artifact_epochs = np.zeros(n_epochs, dtype=bool) if artifact_epochs is None else artifact_epochs
         self.feature_name_ = self._features.columns.tolist()
 
     def get_features(self, epoch_sec=30, bands=None):
@@ -426,9 +469,18 @@ class SleepStaging:
         clf = self._load_model(path_to_model)
         # Now we make sure that the features are aligned
         X = self._features.copy()[clf.feature_name_]
+        # Artifacted epochs are not scored, they get -1 ('Art' in yasa) and NaN probabilities
+        X = X.loc[~self._artifact_epochs]
+        if len(X) == 0:
+            # nothing to score, all -1 and NaN probabilities
+            self._predicted = np.full(len(self._features), -1)
+            self._proba = pd.DataFrame(np.nan, columns=clf.classes_, index=self._features.index)
+            return self._predicted.copy()
         # Predict the sleep stages and probabilities
-        self._predicted = clf.predict(X)
-        proba = pd.DataFrame(clf.predict_proba(X), columns=clf.classes_)
+        self._predicted = pd.Series(clf.predict(X), index=X.index).reindex(
+            self._features.index, fill_value=-1).to_numpy()
+        proba = pd.DataFrame(clf.predict_proba(X), columns=clf.classes_, index=X.index)
+        proba = proba.reindex(self._features.index)
         proba.index.name = 'epoch'
         self._proba = proba
         return self._predicted.copy()
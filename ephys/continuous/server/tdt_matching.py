@@ -0,0 +1,163 @@
+import os
+import re
+import glob
+import datetime
+import numpy as np
+from scipy.signal import correlate, correlation_lags
+from py_console import console
+from utils import fix_tdt_names
+from ttl_events import is_cache_fresh
+
+# Index of the TDT blocks (cached next to each block) and automatic matching
+# between bonsai TTL chunks and TDT blocks, replaces picking the block by hand with ui_find_file()
+
+def find_tdt_blocks(tdt_root):
+    """List every TDT block folder (any folder containing a .tsq file) under `tdt_root`."""
+    tsq_files = glob.glob(os.path.join(tdt_root, '**', '*.tsq'), recursive=True)
+    return sorted(set(os.path.dirname(file) for file in tsq_files))
+
+def tdt_index_path(block_folder):
+    return os.path.join(block_folder, "block_index.npz")
+
+def write_tdt_block_index(block_folder, pulse_sync_name, overwrite=False):
+    """
+    Parse a TDT block once and store what the pipeline needs in a small sidecar (block_index.npz)
+    inside the block folder: start date, duration, max_t, store names (with stream sampling rates)
+    and the pulse-sync onsets. The sidecar is rebuilt if the .tsq file is newer or it was
+    written for a different pulse-sync store.
+
+    Returns:
+    - The path to the sidecar.
+    """
+    index_file = tdt_index_path(block_folder)
+    tsq_files = glob.glob(os.path.join(block_folder, '*.tsq'))
+    if not overwrite and tsq_files and is_cache_fresh(tsq_files[0], index_file):
+        with np.load(index_file) as index:
+            if str(index["pulse_sync_name"]) == pulse_sync_name:
+                return index_file
+    import tdt
+    import phototdt
+    # we read a very very small portion only to get the info
+    block = tdt.read_block(block_folder, t1=0, t2=1)
+    pulse_onset = tdt.read_block(block_folder, store = fix_tdt_names(pulse_sync_name, '/')).epocs[fix_tdt_names(pulse_sync_name, '_')].onset
+    stream_names = list(block.streams.keys())
+    np.savez(
+        index_file,
+        start_date=np.array(block.info.start_date.isoformat()),
+        duration_sec=np.array(block.info.duration.total_seconds()),
+        max_t=np.array(phototdt.get_total_duration(block), dtype=np.float64),
+        stream_names=np.array(stream_names, dtype=str),
+        stream_fs=np.array([block.streams[name].fs for name in stream_names], dtype=np.float64),
+        epoc_names=np.array(list(block.epocs.keys()), dtype=str),
+        pulse_sync_name=np.array(pulse_sync_name),
+        pulse_onset=np.asarray(pulse_onset, dtype=np.float64))
+    console.success(f"Wrote TDT block index {index_file}")
+    return index_file
+
+def read_tdt_block_info(block_folder, pulse_sync_name):
+    """
+    Read the start, duration and pulse-sync onsets of a TDT block from its sidecar
+    (see write_tdt_block_index), parsing the block only if the sidecar is missing or stale.
+
+    Returns:
+    - A dict with block_folder, start_date (datetime), duration_sec, max_t, streams ({name: fs}),
+      epoc_names and pulse_onset (seconds from the start of the block).
+    """
+    index_file = write_tdt_block_index(block_folder, pulse_sync_name)
+    with np.load(index_file) as index:
+        return {
+            "block_folder": block_folder,
+            "start_date": datetime.datetime.fromisoformat(str(index["start_date"])),
+            "duration_sec": float(index["duration_sec"]),
+            "max_t": float(index["max_t"]),
+            "streams": dict(zip(index["stream_names"].tolist(), index["stream_fs"].tolist())),
+            "epoc_names": index["epoc_names"].tolist(),
+            "pulse_onset": index["pulse_onset"],
+        }
+
+def index_tdt_blocks(tdt_root, pulse_sync_name):
+    """
+    Read the info of every TDT block under `tdt_root` once, so that all sessions can be matched against it.
+    Blocks that fail to read (e.g. still recording, missing the pulse-sync store) are skipped.
+    """
+    tdt_index = []
+    for block_folder in find_tdt_blocks(tdt_root):
+        try:
+            tdt_index.append(read_tdt_block_info(block_folder, pulse_sync_name))
+        except Exception as e:
+            console.warn(f"Could not index TDT block {block_folder}: {e}")
+    console.info(f"Indexed {len(tdt_index)} TDT blocks in {tdt_root}")
+    return tdt_index
+
+def session_datetime(file):
+    """Parse the `\\d{8}T\\d{6}` session timestamp from a bonsai file name."""
+    return datetime.datetime.strptime(re.search(r'\d{8}T\d{6}', os.path.basename(file)).group(), '%Y%m%dT%H%M%S')
+
+def pulse_train_score(onsets_a, onsets_b, max_lag_sec=120, bin_sec=0.05):
+    """
+    Cross-correlate two pulse trains given as absolute times in seconds.
+
+    Trains are binned at `bin_sec` (with +-1 bin tolerance) and correlated with an FFT
+    over lags up to `max_lag_sec`, which absorbs the clock offset between computers.
+
+    Returns:
+    - score: Fraction of pulses that coincide at the best lag (0 to 1).
+    - lag_sec: Best lag, such that onsets_a ~ onsets_b + lag_sec.
+    """
+    if len(onsets_a) == 0 or len(onsets_b) == 0:
+        return 0.0, None
+    start = max(onsets_a[0], onsets_b[0]) - max_lag_sec
+    end = min(onsets_a[-1], onsets_b[-1]) + max_lag_sec
+    if end <= start:
+        return 0.0, None
+    n_bins = int(np.ceil((end - start) / bin_sec)) + 1
+
+    def binned(onsets):
+        onsets = onsets[(onsets >= start) & (onsets < end)]
+        return np.bincount(((onsets - start) / bin_sec).astype(np.int64), minlength=n_bins).astype(np.float64)
+
+    train_a = binned(onsets_a)
+    train_b = binned(onsets_b)
+    n_pulses = min(train_a.sum(), train_b.sum())
+    if n_pulses == 0:
+        return 0.0, None
+    train_a = np.minimum(np.convolve(train_a, np.ones(3), mode='same'), 1)
+    corr = correlate(train_a, train_b, mode='full', method='fft')
+    lags = correlation_lags(len(train_a), len(train_b), mode='full') * bin_sec
+    keep = np.abs(lags) <= max_lag_sec
+    best = np.argmax(corr[keep])
+    return float(corr[keep][best] / n_pulses), float(lags[keep][best])
+
+def match_tdt_block(chunk_start, chunk_duration_sec, bonsai_onset_sec, tdt_index, min_score=0.5, max_lag_sec=120):
+    """
+    Find the TDT block that was recorded together with a bonsai TTL chunk.
+
+    Candidates are the blocks overlapping the chunk in time (with `max_lag_sec` of slack),
+    and the one whose pulse-sync train best cross-correlates with the bonsai pulses wins.
+
+    Parameters:
+    - chunk_start: datetime of the first ttl file in the chunk.
+    - chunk_duration_sec: Duration of the chunk in seconds.
+    - bonsai_onset_sec: Pulse onsets received by bonsai, in seconds from chunk_start.
+    - tdt_index: Output of index_tdt_blocks().
+
+    Returns:
+    - The matching entry of tdt_index (with 'score' and 'lag_sec' added) or None.
+    """
+    chunk_t0 = chunk_start.timestamp()
+    bonsai_abs = chunk_t0 + np.asarray(bonsai_onset_sec, dtype=np.float64)
+    best = None
+    for block in tdt_index:
+        block_t0 = block["start_date"].timestamp()
+        overlap = min(chunk_t0 + chunk_duration_sec, block_t0 + block["duration_sec"]) - max(chunk_t0, block_t0)
+        if overlap < -max_lag_sec:
+            continue
+        score, lag_sec = pulse_train_score(bonsai_abs, block_t0 + block["pulse_onset"], max_lag_sec=max_lag_sec)
+        console.log(f"TDT block {os.path.basename(block['block_folder'])}: score {score:.2f}, lag {lag_sec} sec")
+        if score >= min_score and (best is None or score > best["score"]):
+            best = dict(block, score=score, lag_sec=lag_sec)
+    if best is None:
+        console.warn(f"No TDT block matched the chunk starting at {chunk_start}")
+    else:
+        console.success(f"Matched chunk starting at {chunk_start} with {best['block_folder']} (score {best['score']:.2f})")
+    return best
@@ -0,0 +1,91 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+from accel_features import open_accel_memmap, accel_epoch_features, session_accel_features, apply_accel_features
+
+class TestAccelFeatures(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.sf = 250
+        rng = np.random.default_rng(7)
+        # 100 epochs of 2.5 sec plus a partial epoch, gravity on z, active in the second half
+        n = 100 * 625 + 100
+        self.acc = rng.normal(0, 0.01, size=(n, 3)).astype(np.float32)
+        self.acc[:, 2] += 1
+        self.acc[n // 2:] += rng.normal(0, 0.5, size=(n - n // 2, 3)).astype(np.float32)
+        self.acc_file = os.path.join(self.tmp.name, "sub-MLA1_ses-20231203T110016_accel.bin")
+        self.acc.tofile(self.acc_file)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_memmap_and_copy_in_the_same_pass(self):
+        acc = open_accel_memmap(self.acc_file)
+        self.assertEqual(acc.shape, self.acc.shape)
+        out = np.lib.format.open_memmap(os.path.join(self.tmp.name, "acceldata.npy"), mode='w+', dtype=np.float32, shape=acc.shape)
+        accel_epoch_features(acc, self.sf, 2.5, block_epochs=7, out=out)
+        np.testing.assert_array_equal(out, self.acc)
+
+    def test_features_match_full_computation(self):
+        features = accel_epoch_features(open_accel_memmap(self.acc_file), self.sf, 2.5, block_epochs=7)
+        self.assertEqual(len(features), 100)
+        epochs = self.acc[:100 * 625].astype(np.float64).reshape(100, 625, 3)
+        expected = pd.DataFrame({
+            'accel_vm': np.linalg.norm(epochs, axis=-1).mean(axis=1),
+            'accel_odba': np.abs(epochs - epochs.mean(axis=1, keepdims=True)).sum(axis=-1).mean(axis=1),
+            'accel_var': epochs.var(axis=1).sum(axis=-1),
+        }, index=pd.RangeIndex(100, name='epoch'))
+        pd.testing.assert_frame_equal(features, expected)
+        # gravity does not count as activity
+        self.assertLess(features['accel_odba'].iloc[:49].max(), 0.1)
+        self.assertGreater(features['accel_odba'].iloc[51:].min(), 0.5)
+
+    def test_session_features_follow_the_eeg_chunk(self):
+        # 3 eeg channels at 1 kHz in 10 min files, the second file has no accel file and
+        # the third one starts a new chunk (staging session) after a gap
+        config = {"selected_channels": [1, 2, 3], "aq_freq_hz": 1000, "bonsai_timer_period": "00:10:00"}
+        folder = os.path.join(self.tmp.name, "eeg")
+        os.makedirs(folder)
+        sessions = ["20231203T110000", "20231203T111000", "20231203T140000"]
+        n_eeg = 600_000
+        for i, session in enumerate(sessions):
+            np.zeros((n_eeg, 3), dtype=np.float32).tofile(os.path.join(folder, f"sub-MLA1_ses-{session}_eeg.bin"))
+            if i != 1:
+                acc = np.zeros((n_eeg // 4, 3), dtype=np.float32)
+                acc[:, 2] = 1
+                # activity in the first epoch of each file
+                acc[:625, 0] += np.where(np.arange(625) % 2, 0.5, -0.5)
+                acc.tofile(os.path.join(folder, f"sub-MLA1_ses-{session}_accel.bin"))
+        features = session_accel_features(config, folder, "20231203T110000", 2.5)
+        # 2 files of 600 s in the first session, the missing one reads as NaN
+        self.assertEqual(len(features), 480)
+        self.assertGreater(features['accel_odba'].iloc[0], 0.1)
+        self.assertAlmostEqual(features['accel_odba'].iloc[1], 0)
+        self.assertTrue(features['accel_odba'].iloc[240:].isna().all())
+        self.assertTrue(os.path.isfile(os.path.join(folder, "sub-MLA1_ses-20231203T110000_desc-epoch2.5s_accelfeatures.csv.gz")))
+        # read back from the cache, a different epoch length is computed again
+        pd.testing.assert_frame_equal(session_accel_features(config, folder, "20231203T110000", 2.5), features, check_dtype=False)
+        self.assertEqual(len(session_accel_features(config, folder, "20231203T110000", 5)), 240)
+        # the second session starts at its own first sample
+        npy_file = os.path.join(self.tmp.name, "acceldata.npy")
+        second = session_accel_features(config, folder, "20231203T140000", 2.5, npy_file=npy_file)
+        self.assertEqual(len(second), 240)
+        self.assertGreater(second['accel_odba'].iloc[0], 0.1)
+        self.assertEqual(np.load(npy_file).shape, (150_000, 3))
+
+    def test_apply_accel_features(self):
+        features = pd.DataFrame({'accel_vm': [1.0, 1.2, np.nan], 'accel_odba': [0.01, 0.4, np.nan], 'accel_var': [0, 0, 0]},
+                                index=pd.RangeIndex(3, name='epoch'))
+        classified = np.array([2, 2, 2, 0])
+        same, columns = apply_accel_features(classified, features)
+        np.testing.assert_array_equal(same, classified)
+        self.assertEqual(list(columns), ['accel_vm', 'accel_odba'])
+        self.assertEqual(len(columns['accel_odba']), 4)
+        overridden, _ = apply_accel_features(classified, features, odba_threshold=0.1)
+        np.testing.assert_array_equal(overridden, [2, 0, 2, 0])
+
+if __name__ == '__main__':
+    unittest.main()
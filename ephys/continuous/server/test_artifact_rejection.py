@@ -0,0 +1,47 @@
+import unittest
+import numpy as np
+from artifact_rejection import epoch_view, rolling_std_artifacts, power_envelope_artifacts
+
+class TestArtifactRejection(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.sf = 100
+        self.data = rng.normal(size=(2, self.sf * 60 * 10))
+        # epochs 10 and 11 (2.5 s at 100 Hz) have a big artifact on the first channel
+        self.data[0, 2500:3000] *= 50
+
+    def test_epoch_view_is_a_view(self):
+        view = epoch_view(self.data, 250)
+        self.assertEqual(view.shape, (2, 240, 250))
+        self.assertTrue(np.shares_memory(view, self.data))
+
+    def test_rolling_std_flags_epochs(self):
+        artifacts = rolling_std_artifacts(self.data, self.sf, 2.5)
+        np.testing.assert_array_equal(artifacts.starts, [2500])
+        np.testing.assert_array_equal(artifacts.ends, [3000])
+        # asking for both channels to agree rejects nothing
+        self.assertEqual(len(rolling_std_artifacts(self.data, self.sf, 2.5, n_chan_reject=2)), 0)
+
+    def test_power_envelope_inside_artifact(self):
+        artifacts = power_envelope_artifacts(self.data, self.sf, threshold_factor=6)
+        self.assertGreater(len(artifacts), 0)
+        self.assertTrue(np.all(artifacts.starts >= 2400))
+        self.assertTrue(np.all(artifacts.ends <= 3100))
+
+    def test_staging_all_epochs_artifacted(self):
+        # e.g. the electrode was off the whole recording
+        from predict import predict_electrode
+        n_epochs = self.data.shape[1] // 250
+        labels, proba = predict_electrode(self.data[0], self.data[1], self.sf, artifact_epochs=np.ones(n_epochs, dtype=bool))
+        np.testing.assert_array_equal(labels, -1)
+        self.assertEqual(len(proba), n_epochs)
+        self.assertTrue(proba.isna().all().all())
+        # some clean epochs are still scored
+        artifact_epochs = np.ones(n_epochs, dtype=bool)
+        artifact_epochs[:100] = False
+        labels, proba = predict_electrode(self.data[0], self.data[1], self.sf, artifact_epochs=artifact_epochs)
+        self.assertTrue(np.all(labels[100:] == -1) and not np.any(labels[:100] == -1))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+from bin_archive import compress_bin, decompress_bin, BinArchive, open_bin, bin_sources, encode_block, decode_block
+from utils import read_stack_chunks, bin_nsamples, exclude_windows_bin
+from ttl_events import extract_ttl_events
+from camera_frames import read_demux, count_camera_channels, read_camera_index
+
+class TestBinArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.rng = np.random.default_rng(48)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.tmp.name, name)
+
+    def write_eeg(self, name, n_samples, num_channels=3, tail=b""):
+        data = np.cumsum(self.rng.normal(size=(n_samples, num_channels)), axis=0).astype(np.float32)
+        # values that only survive a bit exact round trip
+        data[:4, 0] = [np.nan, -0.0, np.inf, np.float32(1e-45)]
+        with open(self.path(name), "wb") as f:
+            f.write(data.tobytes() + tail)
+        return self.path(name), data
+
+    def test_bit_exact_round_trip(self):
+        for codec in ["zlib", "lzma"]:
+            eeg_file, _ = self.write_eeg(f"sub-A_ses-20240101T100000_eeg_{codec}.bin", 10_007, tail=b"\x01\x02\x03")
+            archive = compress_bin(eeg_file, 3, block_samples=1000, codec=codec)
+            restored = decompress_bin(archive, self.path(f"restored_{codec}.bin"))
+            with open(eeg_file, "rb") as a, open(restored, "rb") as b:
+                self.assertEqual(a.read(), b.read())
+        # mostly zero ttl compresses a lot
+        ttl = np.zeros((100_000, 8), dtype=np.int8)
+        ttl[1000:1050, 2] = 1
+        ttl_file = self.path("sub-A_ses-20240101T100000_ttl_in.bin")
+        ttl.tofile(ttl_file)
+        archive = compress_bin(ttl_file, 8, np.int8)
+        self.assertTrue(archive.endswith("_ttl_in.binz"))
+        self.assertLess(os.path.getsize(archive), os.path.getsize(ttl_file) / 50)
+        np.testing.assert_array_equal(np.asarray(open_bin(archive, 8, np.int8)), ttl)
+
+    def test_block_codec(self):
+        block = self.rng.integers(-128, 127, size=(500, 8)).astype(np.int8)
+        np.testing.assert_array_equal(decode_block(encode_block(block), np.int8, 8), block)
+        block = self.rng.normal(size=(500, 3)).astype(np.float32)
+        self.assertEqual(decode_block(encode_block(block, delta=False), np.float32, 3, delta=False).tobytes(), block.tobytes())
+
+    def test_random_access(self):
+        eeg_file, data = self.write_eeg("sub-A_ses-20240101T100000_eeg.bin", 5_000)
+        archive = BinArchive(compress_bin(eeg_file, 3, block_samples=256))
+        self.assertEqual(archive.shape, (5_000, 3))
+        for start, stop in [(0, 1), (255, 257), (1000, 4000), (4990, 6000), (3000, 3000)]:
+            self.assertEqual(archive[start:stop].tobytes(), data[start:stop].tobytes())
+        self.assertEqual(archive[-1].tobytes(), data[-1].tobytes())
+        self.assertEqual(archive[10:20, 1].tobytes(), data[10:20, 1].tobytes())
+        with self.assertRaises(ValueError):
+            open_bin(archive.path, 4)
+
+    def test_read_stack_chunks_transparent(self):
+        files = [self.write_eeg(f"sub-A_ses-20240101T1{i}0000_eeg.bin", 3_000 + i)[0] for i in range(3)]
+        archives = [compress_bin(file, 3, block_samples=500) for file in files]
+        expected, expected_n = read_stack_chunks(files, 3, return_nsamples=True)
+        stacked, nsamples = read_stack_chunks(archives, 3, return_nsamples=True)
+        self.assertEqual(stacked.tobytes(), expected.tobytes())
+        self.assertEqual(nsamples, expected_n)
+        self.assertEqual([bin_nsamples(file, 3) for file in archives], expected_n)
+        # a window across the file boundaries, from the raw files and from the archives
+        for chunk in [files, [files[0], archives[1], archives[2]]]:
+            window, window_n = read_stack_chunks(chunk, 3, return_nsamples=True, window=(2_500, 6_100))
+            self.assertEqual(window.tobytes(), expected[:, 2_500:6_100].tobytes())
+            self.assertEqual(window_n, [500, 3_001, 99])
+        self.assertEqual(bin_sources(files + archives), files)
+        self.assertEqual(bin_sources([files[0], archives[1]]), [files[0], archives[1]])
+
+    def test_ttl_and_camera_readers(self):
+        ttl = np.zeros((20_000, 4), dtype=np.int8)
+        ttl[100:200, 1] = 1
+        ttl[15_000:15_010, 3] = 1
+        ttl_file = self.path("sub-A_ses-20240101T100000_ttl_in.bin")
+        ttl.tofile(ttl_file)
+        archive = compress_bin(ttl_file, 4, np.int8, block_samples=1000)
+        names = ["a", "b", "c", "d"]
+        events, nsamples = extract_ttl_events([ttl_file], names, block_samples=3000)
+        archived, archived_n = extract_ttl_events([archive], names, block_samples=3000)
+        self.assertTrue(events.equals(archived))
+        self.assertEqual(nsamples, archived_n)
+        # camera frame counter as a 4th float32 channel
+        eeg_file, data = self.write_eeg("sub-A_ses-20240101T100000_eeg.bin", 4_000, num_channels=4)
+        data[:, 3] = np.arange(4_000) // 33
+        data.tofile(eeg_file)
+        eeg, frames = read_demux(eeg_file, 3, 1, block_samples=700)
+        archived_eeg, archived_frames = read_demux(compress_bin(eeg_file, 4, block_samples=500), 3, 1, block_samples=700)
+        self.assertEqual(eeg.tobytes(), archived_eeg.tobytes())
+        self.assertTrue(frames.equals(archived_frames))
+
+    def test_camera_channel_round_trip(self):
+        # 3 eeg channels + the camera frame counter, archived the way main() does it
+        eeg_file, data = self.write_eeg("sub-A_ses-20240101T100000_eeg.bin", 5_000, num_channels=4)
+        data[:, 3] = np.arange(5_000) // 33
+        data.tofile(eeg_file)
+        archive = compress_bin(eeg_file, 4, block_samples=600)
+        self.assertEqual(count_camera_channels(eeg_file, 3), 1)
+        self.assertEqual(count_camera_channels(archive, 3), 1)
+        self.assertEqual(count_camera_channels(archive, 4), 0)
+        expected = read_stack_chunks([eeg_file], 3, camera_channels=count_camera_channels(eeg_file, 3))
+        expected_index = read_camera_index(eeg_file)
+        os.remove(eeg_file)
+        stacked = read_stack_chunks([archive], 3, camera_channels=count_camera_channels(archive, 3))
+        self.assertEqual(stacked.tobytes(), expected.tobytes())
+        self.assertTrue(read_camera_index(archive).equals(expected_index))
+
+    def test_exclude_windows_from_archive(self):
+        eeg_file, data = self.write_eeg("sub-A_ses-20240101T100000_eeg.bin", 5_000, tail=b"\x01")
+        archive = compress_bin(eeg_file, 3, block_samples=700)
+        out = self.path("out_eeg.bin")
+        # the last window runs past the compressed size of the archive
+        kept = exclude_windows_bin(archive, 100, 3, out, [(1, 2.5), (30, 31), (49, None)])
+        expected = np.delete(data, np.r_[100:250, 3000:3100, 4900:5000], axis=0)
+        self.assertEqual(kept, len(expected))
+        self.assertEqual(np.fromfile(out, dtype=np.float32).tobytes(), expected.tobytes())
+
+if __name__ == '__main__':
+    unittest.main()
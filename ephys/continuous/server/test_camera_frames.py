@@ -0,0 +1,55 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+from camera_frames import count_camera_channels, frame_runs, read_demux, frame_to_sample, sample_to_frame, write_camera_index, read_camera_index
+from utils import read_stack_chunks
+
+class TestCameraFrames(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        rng = np.random.default_rng(8)
+        # 10 sec at 1 kHz, 3 eeg channels + a 30 fps frame counter
+        self.n = 10_000
+        self.eeg = rng.normal(size=(3, self.n)).astype(np.float32)
+        self.frames = (np.arange(self.n) * 30 // 1000 + 100).astype(np.float32)
+        self.eeg_file = os.path.join(self.tmp.name, "sub-MLA1_ses-20231203T110016_eeg.bin")
+        np.column_stack([self.eeg.T, self.frames]).astype(np.float32).tofile(self.eeg_file)
+        self.plain_file = os.path.join(self.tmp.name, "sub-MLA1_ses-20231203T120016_eeg.bin")
+        self.eeg.T.copy().tofile(self.plain_file)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_count_camera_channels(self):
+        self.assertEqual(count_camera_channels(self.eeg_file, 3), 1)
+        self.assertEqual(count_camera_channels(self.plain_file, 3), 0)
+
+    def test_frame_runs_across_blocks(self):
+        frame, start = frame_runs(np.array([5, 5, 6, 6]), offset=10, prev_frame=4)
+        np.testing.assert_array_equal(frame, [5, 6])
+        np.testing.assert_array_equal(start, [10, 12])
+        frame, start = frame_runs(np.array([6, 7]), offset=14, prev_frame=6)
+        np.testing.assert_array_equal(start, [15])
+
+    def test_read_demux_and_lookups(self):
+        eeg, frame_index = read_demux(self.eeg_file, 3, block_samples=777)
+        np.testing.assert_array_equal(eeg, self.eeg)
+        self.assertEqual(len(frame_index), 300)
+        self.assertEqual(frame_index['n_samples'].sum(), self.n)
+        samples = np.array([0, 33, 34, 9_999])
+        np.testing.assert_array_equal(sample_to_frame(frame_index, samples), self.frames[samples])
+        first_samples = frame_to_sample(frame_index, [100, 101, 399, 5000])
+        np.testing.assert_array_equal(first_samples, [0, 34, 9_967, -1])
+        write_camera_index(self.eeg_file, frame_index)
+        self.assertTrue(read_camera_index(self.eeg_file).equals(frame_index))
+
+    def test_read_stack_chunks_with_camera(self):
+        data, nsamples = read_stack_chunks([self.eeg_file], 3, return_nsamples=True, camera_channels=1)
+        np.testing.assert_array_equal(data, self.eeg)
+        self.assertEqual(nsamples, [self.n])
+        self.assertTrue(os.path.isfile(self.eeg_file.replace("_eeg.bin", "_camframes.csv.gz")))
+
+if __name__ == '__main__':
+    unittest.main()
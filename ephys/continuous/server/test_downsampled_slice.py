@@ -0,0 +1,51 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+import polars as pl
+from bonsai_dat_to_npy_eeg import find_downsampled_slice, slice_downsampled_eeg, downsampled_eeg_path
+
+class TestDownsampledSlice(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.eeg_folder = os.path.join(self.tmp.name, "eeg")
+        os.makedirs(self.eeg_folder)
+        self.config = {"subject_id": "A", "selected_channels": [0, 1], "aq_freq_hz": 1000,
+                       "down_freq_hz": 100, "bonsai_timer_period": "01:00:00"}
+        self.nsamples = [1005, 2003, 1500]
+        self.files = []
+        for hour, n in enumerate(self.nsamples):
+            file = os.path.join(self.eeg_folder, f"sub-A_ses-20240101T0{hour}0000_eeg.bin")
+            np.zeros((n, 2), dtype=np.float32).tofile(file)
+            self.files.append(file)
+        # downsampled output of the whole chunk, rows numbered so we can check the slice
+        total_rows = -(-sum(self.nsamples) // 10)
+        self.day_file = downsampled_eeg_path(self.config, self.eeg_folder, "20240101T000000")
+        pd.DataFrame({"EEG1": np.arange(total_rows, dtype=np.float64)}).to_csv(self.day_file, index=False)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_find_slice(self):
+        found = find_downsampled_slice(self.config, self.files[1:], self.eeg_folder)
+        downsampled_file, start_row, n_rows, nsamples = found
+        self.assertEqual(downsampled_file, self.day_file)
+        self.assertEqual(nsamples, self.nsamples[1:])
+        # sample 1005 is the first one kept at row 101 (1010 / 10)
+        self.assertEqual(start_row, 101)
+        self.assertEqual(start_row + n_rows, -(-sum(self.nsamples) // 10))
+        self.assertIsNone(find_downsampled_slice(self.config, [self.files[0], self.files[2]], self.eeg_folder))
+
+    def test_slice_written(self):
+        output_folder = os.path.join(self.tmp.name, "aligned", "eeg")
+        os.makedirs(output_folder)
+        outfilename, nsamples = slice_downsampled_eeg(self.config, self.files[:2], output_folder)
+        self.assertEqual(os.path.basename(outfilename), "sub-A_ses-20240101T000000_desc-down10_eeg.csv.gz")
+        rows = pl.read_csv(outfilename)["EEG1"].to_numpy()
+        np.testing.assert_array_equal(rows, np.arange(0, 301))
+        self.assertEqual(nsamples, self.nsamples[:2])
+
+if __name__ == '__main__':
+    unittest.main()
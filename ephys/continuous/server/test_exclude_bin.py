@@ -0,0 +1,52 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+from utils import exclude_and_write_bin, exclude_windows_bin, exclude_windows_bins, kept_sample_ranges, copy_byte_ranges
+
+class TestExcludeBin(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.sf = 100
+        # 3 channels, values encode the sample so we can check what was kept
+        self.data = np.repeat(np.arange(1000, dtype=np.float32)[:, None], 3, axis=1) + np.array([0, 0.25, 0.5], dtype=np.float32)
+        self.file = os.path.join(self.tmp.name, "sub-A_ses-20240101T000000_eeg.bin")
+        self.data.tofile(self.file)
+        self.out = os.path.join(self.tmp.name, "out_eeg.bin")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def read_out(self):
+        return np.fromfile(self.out, dtype=np.float32).reshape(-1, 3)
+
+    def test_kept_sample_ranges(self):
+        kept = kept_sample_ranges(1000, [(100, 200), (150, 300), (900, 2000)])
+        self.assertEqual(list(kept), [(0, 100), (300, 900)])
+        self.assertEqual(list(kept_sample_ranges(10, [])), [(0, 10)])
+
+    def test_exclude_and_write_bin(self):
+        exclude_and_write_bin(self.file, self.sf, 3, self.out, exclude_start_time=2, exclude_end_time=3.5)
+        np.testing.assert_array_equal(self.read_out(), np.delete(self.data, np.s_[200:350], axis=0))
+        with self.assertRaises(ValueError):
+            exclude_and_write_bin(self.file, self.sf, 3, self.out, exclude_start_time=0, exclude_end_time=3)
+
+    def test_multiple_windows(self):
+        kept = exclude_windows_bin(self.file, self.sf, 3, self.out, [(1, 2), (5, 6.5), (9.5, None)])
+        expected = np.delete(self.data, np.r_[100:200, 500:650, 950:1000], axis=0)
+        self.assertEqual(kept, len(expected))
+        np.testing.assert_array_equal(self.read_out(), expected)
+
+    def test_fallback_without_copy_file_range(self):
+        with mock.patch("os.copy_file_range", side_effect=OSError("not supported")):
+            copy_byte_ranges(self.file, self.out, [(0, 120), (1200, 1212)], buffer_bytes=50)
+        np.testing.assert_array_equal(self.read_out(), self.data[[0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 100]])
+
+    def test_batch(self):
+        outputs = exclude_windows_bins([(self.file, self.out, [(0, 1)]), (self.file, self.out + "2", [(9, None)])], self.sf, 3, n_workers=2)
+        self.assertEqual(outputs, {self.out: 900, self.out + "2": 900})
+
+if __name__ == '__main__':
+    unittest.main()
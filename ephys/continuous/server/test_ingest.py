@@ -0,0 +1,106 @@
+import os
+import json
+import time
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+import yaml
+import mne
+from scipy.signal import decimate
+from ingest import pipeline_taps, StreamingDecimator, IngestDaemon, read_journal
+
+CONFIG = {
+    "subject_id": "MLA1",
+    "aq_freq_hz": 1000,
+    "down_freq_hz": 100,
+    "selected_channels": [0, 1, 2],
+    "channel_names": ["EEG1", "EEG2", "EMG"],
+    "bandpass": {"eeg": [0.5, 30], "emg": [10, 100]},
+    "bonsai_timer_period": "00:01:00",
+}
+
+class TestIngest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.rng = np.random.default_rng(43)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_streaming_matches_batch(self):
+        taps, q = pipeline_taps(CONFIG)
+        data = self.rng.normal(size=(3, 50_000)) + 3
+        decimator = StreamingDecimator(taps, q)
+        cuts = [0, 7_001, 7_002, 31_337, 50_000]
+        out = np.concatenate([decimator.push(data[:, a:b]) for a, b in zip(cuts[:-1], cuts[1:])] + [decimator.flush()], axis=1)
+        self.assertEqual(out.shape, (3, 5_000))
+        # block boundaries do not matter
+        whole = StreamingDecimator(taps, q)
+        whole.offset = data[:, :7_001].mean(axis=1, keepdims=True)
+        np.testing.assert_allclose(np.concatenate([whole.push(data), whole.flush()], axis=1), out, atol=1e-9)
+        # same filters as filter_data() + decimate() away from the edges, where the batch version pads
+        centered = data - data[:, :7_001].mean(axis=1, keepdims=True)
+        batch = mne.filter.filter_data(centered, 1000, 0.5, 30, picks=[0, 1], verbose=0)
+        batch = mne.filter.filter_data(batch, 1000, 10, 100, picks=[2], verbose=0)
+        batch = decimate(batch, q, ftype='fir')
+        edge = taps.shape[1] // q
+        np.testing.assert_allclose(out[:, edge:-edge], batch[:, edge:-edge], atol=1e-6)
+
+    def test_daemon_follows_journal(self):
+        root = self.tmp.name
+        os.makedirs(os.path.join(root, "MLA1", "2024-03-01", "eeg"))
+        with open(os.path.join(root, "MLA1", "config.yaml"), "w") as f:
+            yaml.safe_dump(CONFIG, f)
+        journal = os.path.join(root, "finalized.jsonl")
+        files = []
+        data = self.rng.normal(size=(3, 4 * 60_000)).astype(np.float32)
+        for i in range(4):
+            rel = f"MLA1/2024-03-01/eeg/sub-MLA1_ses-20240301T10{i:02d}00_eeg.bin"
+            data[:, i * 60_000:(i + 1) * 60_000].T.tofile(os.path.join(root, rel))
+            files.append(rel)
+
+        def publish(rel):
+            with open(journal, "a") as f:
+                f.write(json.dumps({"path": rel}) + "\n")
+
+        daemon = IngestDaemon(root)
+        publish(files[0])
+        publish(files[1])
+        # half written line is left for later
+        with open(journal, "a") as f:
+            f.write('{"path": ')
+        self.assertEqual(daemon.poll(), 2)
+        outfile = os.path.join(root, "MLA1", "2024-03-01", "eeg", "sub-MLA1_ses-20240301T100000_desc-down10_eeg.csv.gz")
+        rows = len(pd.read_csv(outfile))
+        self.assertGreater(rows, 11_000)
+        # a restarted daemon picks up where the other one was
+        with open(journal, "a") as f:
+            f.write(f'"{files[2]}"}}\n')
+        publish(files[3])
+        daemon = IngestDaemon(root)
+        self.assertEqual(daemon.poll(), 2)
+        daemon.close_idle(now=time.time() + 3600)
+        self.assertEqual(daemon.sessions, {})
+        self.assertFalse(os.path.exists(outfile + ".ingest.npz"))
+        streamed = pd.read_csv(outfile)
+        self.assertEqual(list(streamed.columns), CONFIG["channel_names"])
+        taps, q = pipeline_taps(CONFIG)
+        decimator = StreamingDecimator(taps, q)
+        expected = np.concatenate([decimator.push(data[:, :60_000])] + [decimator.push(data[:, i * 60_000:(i + 1) * 60_000]) for i in range(1, 4)] + [decimator.flush()], axis=1)
+        np.testing.assert_allclose(streamed.to_numpy().T, expected, rtol=1e-9, atol=1e-9)
+
+    def test_read_journal_truncated(self):
+        journal = os.path.join(self.tmp.name, "finalized.jsonl")
+        with open(journal, "w") as f:
+            f.write('{"path": "a"}\n{"path": "b"}\n')
+        entries, offset = read_journal(journal)
+        self.assertEqual([e["path"] for e in entries], ["a", "b"])
+        with open(journal, "w") as f:
+            f.write('{"path": "c"}\n')
+        entries, _ = read_journal(journal, offset)
+        self.assertEqual([e["path"] for e in entries], ["c"])
+
+if __name__ == '__main__':
+    unittest.main()
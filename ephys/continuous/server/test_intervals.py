@@ -0,0 +1,54 @@
+import unittest
+import numpy as np
+from intervals import IntervalSet
+
+class TestIntervalSet(unittest.TestCase):
+
+    def test_from_mask(self):
+        mask = np.array([0, 1, 1, 0, 0, 1, 0, 1, 1, 1], dtype=bool)
+        intervals = IntervalSet.from_mask(mask)
+        np.testing.assert_array_equal(intervals.starts, [1, 5, 7])
+        np.testing.assert_array_equal(intervals.ends, [3, 6, 10])
+        np.testing.assert_array_equal(intervals.to_mask(len(mask)), mask)
+
+    def test_from_indices_matches_mask(self):
+        indices = np.array([9, 1, 2, 5, 7, 8])
+        mask = np.zeros(10, dtype=bool)
+        mask[indices] = True
+        self.assertEqual(IntervalSet.from_indices(indices), IntervalSet.from_mask(mask))
+
+    def test_normalize_merges_overlaps(self):
+        intervals = IntervalSet([10, 0, 3, 20], [12, 4, 6, 20])
+        np.testing.assert_array_equal(intervals.starts, [0, 10])
+        np.testing.assert_array_equal(intervals.ends, [6, 12])
+
+    def test_union_and_intersection(self):
+        a = IntervalSet([0, 10], [5, 15])
+        b = IntervalSet([3, 15, 30], [12, 20, 31])
+        self.assertEqual(a | b, IntervalSet([0, 30], [20, 31]))
+        self.assertEqual(a & b, IntervalSet([3, 10], [5, 12]))
+        # touching half-open intervals do not intersect
+        self.assertEqual(len(IntervalSet([0], [5]) & IntervalSet([5], [8])), 0)
+
+    def test_filter_and_dilate(self):
+        intervals = IntervalSet([0, 10, 20], [1, 13, 25])
+        self.assertEqual(intervals.filter_min_length(3), IntervalSet([10, 20], [13, 25]))
+        self.assertEqual(intervals.dilate(2, limit=26), IntervalSet([0, 8, 18], [3, 15, 26]))
+        self.assertEqual(intervals.dilate(4), IntervalSet([0, 6], [5, 29]))
+        self.assertEqual(intervals.length_distribution(), {1: 1, 3: 1, 5: 1})
+
+    def test_contains(self):
+        intervals = IntervalSet([2, 10], [4, 12])
+        np.testing.assert_array_equal(intervals.contains(np.arange(13)),
+                                      IntervalSet([2, 10], [4, 12]).to_mask(13))
+        self.assertTrue(intervals.contains(3))
+        self.assertFalse(IntervalSet().contains(3))
+
+    def test_epoch_mask(self):
+        # 10 samples per epoch, artifacts touch epochs 0, 2 and 3
+        intervals = IntervalSet([5, 29], [10, 31])
+        np.testing.assert_array_equal(intervals.epoch_mask(5, 10),
+                                      [True, False, True, True, False])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+import os
+import time
+import tempfile
+import unittest
+import multiprocessing
+from job_queue import enqueue, claim, heartbeat, complete, fail, summary, run_worker, connect, LeaseLost, filter_step, predict_step
+
+def record(job, log_file):
+    # O_APPEND writes of one short line do not interleave between processes
+    with open(log_file, "a") as f:
+        f.write(f"{job['animal']} {job['date']} {job['step']} {job['attempts']} {os.getpid()}\n")
+
+def worker_process(queue, log_file):
+    def filter_step(job):
+        time.sleep(0.05)
+        if job["date"] == "2024-01-03" and job["attempts"] == 1:
+            # the machine goes down mid job, nothing is reported
+            os._exit(1)
+        record(job, log_file)
+
+    def predict_step(job):
+        if job["date"] == "2024-01-02" and job["attempts"] == 1:
+            raise RuntimeError("NAS hiccup")
+        record(job, log_file)
+
+    handlers = {"filter": filter_step, "predict": predict_step}
+    # keep polling while someone else holds a lease that may still expire
+    while True:
+        run_worker(queue, handlers, lease_sec=1, heartbeat_sec=0.2, retry_delay_sec=0, exit_when_idle=True)
+        counts = summary(queue)
+        if not counts.get("pending") and not counts.get("running"):
+            return
+        time.sleep(0.1)
+
+class TestJobQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.queue = os.path.join(self.tmp.name, "jobs.sqlite")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_lease_and_retries(self):
+        self.assertEqual(enqueue(self.queue, "MLA1", ["2024-01-01"], ["filter", "predict"], max_attempts=2), 2)
+        self.assertEqual(enqueue(self.queue, "MLA1", ["2024-01-01"], ["filter"]), 0)
+        job = claim(self.queue, "a", lease_sec=10)
+        self.assertEqual(job["step"], "filter")
+        # predict waits for filter, nothing else to take
+        self.assertIsNone(claim(self.queue, "b", lease_sec=10))
+        heartbeat(self.queue, job, lease_sec=10)
+        # "a" stops answering, "b" takes over after the lease
+        stolen = claim(self.queue, "b", lease_sec=10, now=time.time() + 11)
+        self.assertEqual((stolen["id"], stolen["attempts"]), (job["id"], 2))
+        with self.assertRaises(LeaseLost):
+            complete(self.queue, job)
+        complete(self.queue, stolen)
+        job = claim(self.queue, "a", lease_sec=10)
+        self.assertEqual(job["step"], "predict")
+        fail(self.queue, job, "boom", retry_delay_sec=100)
+        # waiting for the retry delay
+        self.assertIsNone(claim(self.queue, "a"))
+        job = claim(self.queue, "a", now=time.time() + 101)
+        fail(self.queue, job, "boom again")
+        self.assertEqual(summary(self.queue), {"done": 1, "failed": 1})
+        con = connect(self.queue)
+        self.assertIn("boom again", con.execute("SELECT error FROM jobs WHERE step = 'predict'").fetchone()[0])
+        con.close()
+
+    def test_requires_only_queued_steps(self):
+        # days filtered before the queue existed, predict has nothing to wait for
+        enqueue(self.queue, "MLA1", ["2024-01-01"], ["predict"])
+        self.assertEqual(claim(self.queue, "a")["step"], "predict")
+        # filter queued first, a later predict waits for it
+        enqueue(self.queue, "MLA1", ["2024-01-02"], ["filter"])
+        enqueue(self.queue, "MLA1", ["2024-01-02"], ["predict"])
+        self.assertEqual(claim(self.queue, "a")["step"], "filter")
+        self.assertIsNone(claim(self.queue, "a"))
+
+    def test_steps_fail_without_output(self):
+        job = {"animal": "MLA1", "date": "2024-01-01", "base_folder": self.tmp.name}
+        with open(os.path.join(self.tmp.name, "config.yaml"), "w") as f:
+            f.write("down_freq_hz: 100\n")
+        with self.assertRaises(FileNotFoundError):
+            filter_step(job)
+        # run_and_save_predictions() only logs the missing eeg folder
+        with self.assertRaises(RuntimeError):
+            predict_step(job)
+
+    def test_workers_share_the_backlog(self):
+        dates = [f"2024-01-{day:02d}" for day in range(1, 9)]
+        enqueue(self.queue, "MLA1", dates, ["filter", "predict"])
+        log_file = os.path.join(self.tmp.name, "done.log")
+        context = multiprocessing.get_context("spawn")
+        workers = [context.Process(target=worker_process, args=(self.queue, log_file)) for _ in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(timeout=120)
+        self.assertEqual(summary(self.queue), {"done": 16})
+        with open(log_file) as f:
+            done = [line.split() for line in f]
+        # every job ran to completion exactly once
+        self.assertEqual(sorted((date, step) for _, date, step, _, _ in done), sorted((date, step) for date in dates for step in ["filter", "predict"]))
+        attempts = {(date, step): int(attempt) for _, date, step, attempt, _ in done}
+        self.assertEqual(attempts[("2024-01-03", "filter")], 2)
+        self.assertEqual(attempts[("2024-01-02", "predict")], 2)
+        # the work was spread
+        self.assertGreater(len({pid for *_, pid in done}), 1)
+        # predict always after its filter
+        order = [(date, step) for _, date, step, _, _ in done]
+        for date in dates:
+            self.assertLess(order.index((date, "filter")), order.index((date, "predict")))
+
+if __name__ == '__main__':
+    unittest.main()
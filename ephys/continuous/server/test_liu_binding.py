@@ -0,0 +1,45 @@
+import os
+import datetime
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+import polars as pl
+from liu_binding import group_sessions, merge_sessions
+
+class TestMergeSessions(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.base_folder = self.tmp.name
+        # two experimental days with a 09:00 cutoff, the 02:00 file belongs to the first day
+        self.sessions = ["20240101T100000", "20240101T220000", "20240102T020000", "20240102T100000"]
+        self.rows = [100, 50, 70, 30]
+        start = 0
+        for session, n_rows in zip(self.sessions, self.rows):
+            folder = os.path.join(self.base_folder, session[:8], "eeg")
+            os.makedirs(folder, exist_ok=True)
+            df = pd.DataFrame({"EEG1": np.arange(start, start + n_rows, dtype=float), "EMG1": np.zeros(n_rows)})
+            df.to_csv(os.path.join(folder, f"sub-LY1_ses-{session}_desc-down10_eeg.csv.gz"), index=False)
+            start += n_rows
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_group_sessions(self):
+        files = [f"/a/sub-LY1_ses-{session}_desc-down10_eeg.csv.gz" for session in self.sessions]
+        groups = group_sessions(files, datetime.time(9, 0, 0))
+        self.assertEqual(sorted(groups), [datetime.date(2024, 1, 1), datetime.date(2024, 1, 2)])
+        self.assertEqual(groups[datetime.date(2024, 1, 1)], files[:3])
+
+    def test_merge_sessions(self):
+        for output_format, extension in [("csv", "csv.gz"), ("parquet", "parquet")]:
+            outputs = merge_sessions(self.base_folder, "LY1", "09:00:00", output_format=output_format, n_workers=2)
+            day1 = os.path.join(self.base_folder, "day01", f"sub-LY1_ses-20240101T100000.{extension}")
+            day2 = os.path.join(self.base_folder, "day02", f"sub-LY1_ses-20240102T100000.{extension}")
+            self.assertEqual(outputs, {day1: 220, day2: 30})
+            merged = pl.read_parquet(day1) if output_format == "parquet" else pl.read_csv(day1)
+            np.testing.assert_array_equal(merged["EEG1"].to_numpy(), np.arange(220))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import os
+import json
+import time
+import tempfile
+import threading
+import unittest
+import warnings
+import numpy as np
+import pandas as pd
+from live_staging import BinTailer, LiveStaging, HypnoWriter, smooth_centered, CENTERED_EPOCHS
+
+MODEL = os.path.join(os.path.dirname(os.path.abspath(__file__)), "clf_eeg+emg_lgb_gbdt_custom.joblib")
+
+def simulate_bonsai(folder, data, file_samples, write_samples, delay=0.001):
+    # writes (n_samples, n_channels) float32 frames like bonsai, a new file every file_samples
+    # and in pieces that do not respect the frame boundaries
+    for file_idx, start in enumerate(range(0, len(data), file_samples)):
+        fn = os.path.join(folder, f"box1_eegdata2024-03-01T10_{file_idx:02d}_00.bin")
+        raw = data[start:start + file_samples].tobytes()
+        step = write_samples * data.shape[1] * 4 + 3
+        with open(fn, "wb") as f:
+            for pos in range(0, len(raw), step):
+                f.write(raw[pos:pos + step])
+                f.flush()
+                time.sleep(delay)
+
+class TestLiveStaging(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.rng = np.random.default_rng(44)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_tailer_follows_growing_files(self):
+        data = self.rng.normal(size=(30_000, 3)).astype(np.float32)
+        writer = threading.Thread(target=simulate_bonsai, args=(self.tmp.name, data, 12_000, 700))
+        tailer = BinTailer(self.tmp.name, "box1_eegdata", 3)
+        writer.start()
+        blocks = []
+        while writer.is_alive():
+            blocks.append(tailer.read())
+        writer.join()
+        # the last file is only left when a newer one shows up, read what is left
+        blocks.append(tailer.read())
+        tailer.close()
+        np.testing.assert_array_equal(np.concatenate(blocks, axis=1), data.T)
+
+    def test_smoothing_matches_rolling(self):
+        features = self.rng.normal(size=(40, 5))
+        batch = pd.DataFrame(features).rolling(window=CENTERED_EPOCHS, center=True, min_periods=1, win_type='triang').mean()
+        for lag in [0, 3, 7]:
+            for t in range(40):
+                center = t - lag
+                if center < 0:
+                    continue
+                online = smooth_centered(features[max(t - CENTERED_EPOCHS + 1, 0):t + 1], min(lag, t))
+                if min(center + 7, 39) <= t:
+                    # the whole window is there
+                    np.testing.assert_allclose(online, batch.iloc[center], atol=1e-12)
+
+    def test_scores_every_epoch(self):
+        config = {"down_freq_hz": 100, "channel_names": ["EEG1", "EEG2", "EMG1"]}
+        csv_file = os.path.join(self.tmp.name, "live_hypno.csv")
+        state_file = os.path.join(self.tmp.name, "box1_live_state.json")
+        staging = LiveStaging(config, MODEL, epoch_sec=2.5, lag_epochs=2, min_epochs=20,
+                              on_epoch=[HypnoWriter(csv_file, state_file)])
+        # slow waves half of the time, the rest fast activity and emg bursts
+        t = np.arange(100 * 150) / 100
+        slow = (np.sin(2 * np.pi * t / 60) > 0)
+        eeg = np.where(slow, 3 * np.sin(2 * np.pi * 2 * t), 0) + self.rng.normal(size=(2, len(t)))
+        emg = self.rng.normal(size=len(t)) * np.where(slow, 0.2, 2)
+        data = np.vstack([eeg, emg])
+        results = []
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            for start in range(0, data.shape[1], 777):
+                results += staging.push(data[:, start:start + 777])
+        epochs = [result["epoch"] for result in results]
+        self.assertEqual(epochs, list(range(epochs[0], epochs[0] + len(epochs))))
+        self.assertEqual(epochs[0], 20 - 1 - 2)
+        self.assertGreater(len(epochs), 30)
+        self.assertTrue(all(result["label"] in staging.clf.classes_ for result in results))
+        self.assertTrue(all(0 < result["confidence"] <= 1 for result in results))
+        written = pd.read_csv(csv_file)
+        self.assertEqual(len(written), len(results))
+        with open(state_file) as f:
+            self.assertEqual(json.load(f)["epoch"], epochs[-1])
+
+if __name__ == '__main__':
+    unittest.main()
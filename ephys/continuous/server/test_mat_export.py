@@ -0,0 +1,54 @@
+import os
+import tempfile
+import unittest
+import importlib.util
+import numpy as np
+import scipy.io
+from mat_export import export_channel, export_accusleep_mats, mat_workers
+
+class TestMatExport(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        rng = np.random.default_rng(6)
+        self.eeg = rng.normal(size=(4, 10_001)).astype(np.float32)
+        self.eeg_file = os.path.join(self.tmp.name, "filtered.npy")
+        np.save(self.eeg_file, self.eeg)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_export_accusleep_mats(self):
+        written = export_accusleep_mats(self.eeg_file, self.tmp.name, [2, 3], n_workers=2, chunk_samples=3000)
+        self.assertEqual(len(written), 5)
+        eeg0 = scipy.io.loadmat(os.path.join(self.tmp.name, "eeg_channel00.mat"))["EEG"]
+        self.assertEqual(eeg0.dtype, np.float64)
+        np.testing.assert_array_equal(eeg0.ravel(), self.eeg[0])
+        emg = scipy.io.loadmat(os.path.join(self.tmp.name, "eeg_channel03.mat"))["EMG"]
+        np.testing.assert_array_equal(emg.ravel(), self.eeg[3])
+        emg_diff = scipy.io.loadmat(os.path.join(self.tmp.name, "emg_diff.mat"))["EMG"]
+        np.testing.assert_array_equal(emg_diff.ravel(), self.eeg[2].astype(np.float64) - self.eeg[3])
+
+    def test_mat_workers_fit_the_budget(self):
+        # 24 h at 1 kHz is 1.4 Gb per worker (float64 + savemat copy)
+        n_samples = 24 * 3600 * 1000
+        self.assertEqual(mat_workers(n_samples, 16, memory_budget=5 * 2**30), 3)
+        self.assertEqual(mat_workers(n_samples, 2, memory_budget=100 * 2**30), 2)
+        self.assertEqual(mat_workers(n_samples, 16, memory_budget=0), 1)
+
+    @unittest.skipUnless(importlib.util.find_spec("h5py"), "h5py not installed")
+    def test_export_channel_h5(self):
+        import h5py
+        fn = os.path.join(self.tmp.name, "emg_diff.mat")
+        export_channel(self.eeg_file, [2, 3], "EMG", fn, fmt="h5", chunk_samples=3000)
+        with open(fn, "rb") as f:
+            header = f.read(128)
+        self.assertTrue(header.startswith(b"MATLAB 7.3 MAT-file"))
+        self.assertEqual(header[-2:], b"IM")
+        with h5py.File(fn, "r") as f:
+            self.assertEqual(f["EMG"].shape, (10_001, 1))
+            self.assertEqual(f["EMG"].attrs["MATLAB_class"], b"double")
+            np.testing.assert_array_equal(f["EMG"][:, 0], self.eeg[2].astype(np.float64) - self.eeg[3])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import os
+import sys
+import glob
+import types
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+import pandas as pd
+import polars as pl
+from time_map import TimeMap
+from photometry_resample import rational_ratio, resample_photometry, joint_output_path
+
+class TestPhotometryResample(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.fs = 1017.25
+        self.down_freq_hz = 100
+        # 1 hour of a slow sine (well below the EEG Nyquist) on the TDT clock
+        n = int(3600 * self.fs)
+        self.signal = lambda t: np.sin(2 * np.pi * 0.2 * t)
+        self.windows = []
+
+        def read_block(folder, t1=0, t2=0, store=None):
+            self.windows.append((t1, t2))
+            first, last = int(np.ceil(t1 * self.fs)), min(int(np.ceil(t2 * self.fs)), n)
+            times = np.arange(first, max(last, first)) / self.fs
+            stream = types.SimpleNamespace(data=self.signal(times).astype(np.float32), start_time=first / self.fs, fs=self.fs)
+            return types.SimpleNamespace(streams={store: stream})
+
+        self.modules = mock.patch.dict(sys.modules, {"tdt": types.SimpleNamespace(read_block=read_block)})
+        self.modules.start()
+        # EEG started 20 sec after TDT and runs 30 ppm fast
+        self.time_map = TimeMap([0.0, 3000.0], [20.0, 20.0 + 3000.0 * (1 - 30e-6)])
+        self.eeg_file = os.path.join(self.tmp.name, "sub-MLA1_ses-20231203T110016_desc-down10_eeg.csv.gz")
+        n_eeg = 3000 * self.down_freq_hz
+        pd.DataFrame({"EEG1": np.arange(n_eeg, dtype=float), "EMG1": np.zeros(n_eeg)}).to_csv(self.eeg_file, index=False)
+
+    def tearDown(self):
+        self.modules.stop()
+        self.tmp.cleanup()
+
+    def test_rational_ratio(self):
+        up, down = rational_ratio(self.fs, self.down_freq_hz)
+        self.assertAlmostEqual(self.fs * up / down, self.down_freq_hz, delta=0.01)
+
+    def test_resample_photometry(self):
+        output_folder = resample_photometry(self.eeg_file, "block", self.time_map, self.down_freq_hz, ["_465A"], chunk_sec=600)
+        self.assertEqual(output_folder, joint_output_path(self.eeg_file))
+        self.assertEqual(len(glob.glob(os.path.join(output_folder, "*.parquet"))), 5)
+        # only the window of each chunk is read
+        self.assertTrue(all(t2 - t1 < 620 for t1, t2 in self.windows))
+        joint = pl.scan_parquet(os.path.join(output_folder, "*.parquet")).collect()
+        self.assertEqual(joint.columns, ["sample", "time_sec", "tdt_sec", "EEG1", "EMG1", "_465A"])
+        self.assertEqual(joint.height, 3000 * self.down_freq_hz)
+        np.testing.assert_array_equal(joint["EEG1"].to_numpy(), np.arange(joint.height))
+        expected = self.signal(self.time_map.samples_to_tdt(joint["sample"].to_numpy(), self.down_freq_hz))
+        np.testing.assert_allclose(joint["_465A"].to_numpy(), expected, atol=2e-3)
+
+if __name__ == '__main__':
+    unittest.main()
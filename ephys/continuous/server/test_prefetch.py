@@ -0,0 +1,80 @@
+import os
+import time
+import tempfile
+import threading
+import unittest
+from prefetch import Prefetcher, warm_cache
+
+class TestPrefetcher(unittest.TestCase):
+
+    def test_overlaps_io_and_compute(self):
+        loaded = []
+
+        def load(day):
+            # a NAS read
+            time.sleep(0.1)
+            loaded.append(day)
+            return day * 10
+
+        start = time.monotonic()
+        results = []
+        for day, data in Prefetcher(range(5), load, lookahead=1):
+            results.append((day, data))
+            # the compute
+            time.sleep(0.1)
+        elapsed = time.monotonic() - start
+        self.assertEqual(results, [(day, day * 10) for day in range(5)])
+        # 5 reads + 5 computes one after the other would take 1 s
+        self.assertLess(elapsed, 0.8)
+
+    def test_lookahead_bounds_the_buffer(self):
+        lock = threading.Lock()
+        state = {"loaded": 0, "used": 0, "max_ahead": 0}
+
+        def load(day):
+            with lock:
+                state["loaded"] += 1
+                state["max_ahead"] = max(state["max_ahead"], state["loaded"] - state["used"])
+            return day
+
+        for lookahead in [1, 3]:
+            state.update(loaded=0, used=0, max_ahead=0)
+            for day, _ in Prefetcher(range(20), load, lookahead=lookahead):
+                time.sleep(0.01)
+                with lock:
+                    state["used"] += 1
+            # the day in use plus `lookahead` days
+            self.assertEqual(state["max_ahead"], lookahead + 1)
+
+    def test_errors_and_early_exit(self):
+        def load(day):
+            if day == 2:
+                raise FileNotFoundError(f"day {day}")
+            return day
+
+        seen = []
+        prefetcher = Prefetcher(range(5), load, lookahead=2)
+        with self.assertRaises(FileNotFoundError):
+            for day, _ in prefetcher:
+                seen.append(day)
+        self.assertEqual(seen, [0, 1])
+        self.assertFalse(prefetcher._thread.is_alive())
+        # leaving the loop stops the thread even with an endless input
+        prefetcher = Prefetcher(iter(int, 1), lambda day: day, lookahead=2)
+        for _ in prefetcher:
+            break
+        prefetcher.close()
+        self.assertFalse(prefetcher._thread.is_alive())
+        # lookahead 0 is a plain loop
+        self.assertEqual(list(Prefetcher(range(3), lambda day: -day, lookahead=0)), [(0, 0), (1, -1), (2, -2)])
+
+    def test_warm_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            files = [os.path.join(tmp, f"{i}_eeg.bin") for i in range(3)]
+            for i, file in enumerate(files):
+                with open(file, "wb") as f:
+                    f.write(b"\0" * 1000 * (i + 1))
+            self.assertEqual(warm_cache(files + [os.path.join(tmp, "missing.bin")]), 6000)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import os
+import time
+import datetime
+import tempfile
+import unittest
+import numpy as np
+import yaml
+from session_catalog import update_catalog, find_files, session_dates, derived_from
+from utils import read_config
+
+class TestSessionCatalog(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.tmp.name, "beelink1")
+        self.catalog = os.path.join(self.tmp.name, "catalog.sqlite")
+        self.animal_folder = os.path.join(self.root, "MLA1")
+        os.makedirs(self.animal_folder)
+        with open(os.path.join(self.animal_folder, "config.yaml"), "w") as f:
+            yaml.safe_dump({"selected_channels": [0, 1], "ttl_names": ["a", "b", "c", "d"], "subject_id": "MLA1"}, f)
+        for date, ts in [("2024-01-01", "20240101T100000"), ("2024-01-02", "20240102T100000")]:
+            for kind in ["eeg", "ttl"]:
+                os.makedirs(os.path.join(self.animal_folder, date, kind))
+            np.zeros((1000, 2), dtype=np.float32).tofile(self.path(date, "eeg", f"sub-MLA1_ses-{ts}_eeg.bin"))
+            np.zeros((1000, 4), dtype=np.int8).tofile(self.path(date, "ttl", f"sub-MLA1_ses-{ts}_ttl_in.bin"))
+        open(self.path("2024-01-01", "eeg", "sub-MLA1_ses-20240101T100000_desc-down10_eeg.csv.gz"), "w").close()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def path(self, *parts):
+        return os.path.join(self.animal_folder, *parts)
+
+    def test_catalog(self):
+        counts = update_catalog(self.root, self.catalog)
+        self.assertEqual(counts, {"added": 6, "updated": 0, "removed": 0, "unchanged": 0})
+        self.assertEqual(session_dates("MLA1", self.catalog), ["2024-01-01", "2024-01-02"])
+        self.assertEqual(session_dates("MLA1", self.catalog, start_date=datetime.date(2024, 1, 2)), ["2024-01-02"])
+        eeg_folder = self.path("2024-01-01", "eeg")
+        eeg_file = os.path.join(eeg_folder, "sub-MLA1_ses-20240101T100000_eeg.bin")
+        self.assertEqual(find_files(self.catalog, kind="eeg", folder=eeg_folder), [eeg_file])
+        self.assertEqual(derived_from(eeg_file.replace("_eeg.bin", "_desc-down10_eeg.csv.gz"), self.catalog), [eeg_file])
+        self.assertEqual(read_config(self.animal_folder, catalog=self.catalog)["subject_id"], "MLA1")
+        import sqlite3
+        con = sqlite3.connect(self.catalog)
+        n_samples = dict(con.execute("SELECT kind, n_samples FROM files WHERE session_date = '2024-01-02'"))
+        con.close()
+        self.assertEqual(n_samples, {"eeg": 1000, "ttl": 1000})
+
+    def test_incremental_update(self):
+        update_catalog(self.root, self.catalog)
+        self.assertEqual(update_catalog(self.root, self.catalog)["unchanged"], 6)
+        # bonsai appended to a file and another one was deleted
+        ttl_file = self.path("2024-01-02", "ttl", "sub-MLA1_ses-20240102T100000_ttl_in.bin")
+        with open(ttl_file, "ab") as f:
+            f.write(np.zeros((10, 4), dtype=np.int8).tobytes())
+        os.utime(ttl_file, (time.time() + 5, time.time() + 5))
+        os.remove(self.path("2024-01-01", "eeg", "sub-MLA1_ses-20240101T100000_desc-down10_eeg.csv.gz"))
+        counts = update_catalog(self.root, self.catalog)
+        self.assertEqual(counts, {"added": 0, "updated": 1, "removed": 1, "unchanged": 4})
+        self.assertEqual(find_files(self.catalog, kind="eeg_down"), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+import os
+import sys
+import time
+import types
+import datetime
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+from tdt_matching import pulse_train_score, match_tdt_block, session_datetime, read_tdt_block_info, index_tdt_blocks, tdt_index_path
+
+class TestTDTMatching(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(2)
+        # irregular pulse trains so that only one lag lines them up
+        self.tdt_onsets = np.cumsum(rng.uniform(0.5, 1.5, size=2000))
+        self.start = datetime.datetime(2023, 12, 3, 11, 0, 16)
+
+    def test_pulse_train_score_finds_lag(self):
+        bonsai = self.tdt_onsets[100:1500] + 7.3 + np.random.default_rng(3).normal(0, 0.01, 1400)
+        score, lag = pulse_train_score(bonsai, self.tdt_onsets, max_lag_sec=30)
+        self.assertGreater(score, 0.9)
+        self.assertAlmostEqual(lag, 7.3, delta=0.1)
+        score, _ = pulse_train_score(bonsai, self.tdt_onsets + 500, max_lag_sec=30)
+        self.assertLess(score, 0.5)
+
+    def test_match_tdt_block(self):
+        blocks = [
+            {"block_folder": "block_a", "start_date": self.start, "duration_sec": 2000.0, "pulse_onset": self.tdt_onsets},
+            {"block_folder": "block_b", "start_date": self.start + datetime.timedelta(seconds=30),
+             "duration_sec": 2000.0, "pulse_onset": np.sort(np.random.default_rng(4).uniform(0, 2000, 2000))},
+            {"block_folder": "block_c", "start_date": self.start + datetime.timedelta(days=1), "duration_sec": 2000.0, "pulse_onset": self.tdt_onsets},
+        ]
+        # bonsai chunk started 2 minutes after the TDT block
+        chunk_start = self.start + datetime.timedelta(seconds=120)
+        bonsai_onsets = self.tdt_onsets[self.tdt_onsets > 120] - 120
+        match = match_tdt_block(chunk_start, 3600, bonsai_onsets, blocks)
+        self.assertEqual(match["block_folder"], "block_a")
+        self.assertIsNone(match_tdt_block(chunk_start, 3600, bonsai_onsets, blocks[1:]))
+
+    def test_session_datetime(self):
+        self.assertEqual(session_datetime("/a/b/sub-MLA148_ses-20231203T144807_ttl_in.bin"),
+                         datetime.datetime(2023, 12, 3, 14, 48, 7))
+
+class TestTDTBlockIndex(unittest.TestCase):
+
+    def setUp(self):
+        # synthetic block directory, tdt.read_block is replaced by a fake that counts the reads
+        self.tmp = tempfile.TemporaryDirectory()
+        self.block_folder = os.path.join(self.tmp.name, "Experiment", "MLA147148-231203-110016")
+        os.makedirs(self.block_folder)
+        self.tsq = os.path.join(self.block_folder, "MLA147148-231203-110016.tsq")
+        open(self.tsq, "wb").close()
+        self.onsets = np.arange(0, 100, 1.0) + 0.25
+        self.start = datetime.datetime(2023, 12, 3, 11, 0, 16)
+        self.reads = []
+
+        def read_block(folder, t1=0, t2=0, store=None):
+            self.reads.append((folder, store))
+            return types.SimpleNamespace(
+                info=types.SimpleNamespace(start_date=self.start, duration=datetime.timedelta(seconds=100.5)),
+                streams={"_465A": types.SimpleNamespace(fs=1017.25), "_405A": types.SimpleNamespace(fs=1017.25)},
+                epocs={"PC0_": types.SimpleNamespace(onset=self.onsets)})
+
+        fake_tdt = types.SimpleNamespace(read_block=read_block)
+        fake_phototdt = types.SimpleNamespace(get_total_duration=lambda block: 100.4)
+        self.modules = mock.patch.dict(sys.modules, {"tdt": fake_tdt, "phototdt": fake_phototdt})
+        self.modules.start()
+
+    def tearDown(self):
+        self.modules.stop()
+        self.tmp.cleanup()
+
+    def test_index_is_written_once(self):
+        info = read_tdt_block_info(self.block_folder, "PC0")
+        self.assertTrue(os.path.isfile(tdt_index_path(self.block_folder)))
+        self.assertEqual(info["start_date"], self.start)
+        self.assertEqual(info["duration_sec"], 100.5)
+        self.assertEqual(info["max_t"], 100.4)
+        self.assertEqual(info["streams"], {"_465A": 1017.25, "_405A": 1017.25})
+        self.assertEqual(info["epoc_names"], ["PC0_"])
+        np.testing.assert_array_equal(info["pulse_onset"], self.onsets)
+        n_reads = len(self.reads)
+        # second time comes from the sidecar
+        index = index_tdt_blocks(self.tmp.name, "PC0")
+        self.assertEqual(len(self.reads), n_reads)
+        self.assertEqual(index[0]["block_folder"], self.block_folder)
+        np.testing.assert_array_equal(index[0]["pulse_onset"], self.onsets)
+
+    def test_index_is_rebuilt_when_stale(self):
+        read_tdt_block_info(self.block_folder, "PC0")
+        n_reads = len(self.reads)
+        # block kept recording after the index was written
+        future = time.time() + 10
+        os.utime(self.tsq, (future, future))
+        read_tdt_block_info(self.block_folder, "PC0")
+        self.assertGreater(len(self.reads), n_reads)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+import yaml
+from time_map import TimeMap, pair_pulses, read_time_maps
+
+class TestTimeMap(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(5)
+        # 6 hours of ~1 Hz pulses on the TDT clock
+        self.tdt_onsets = np.cumsum(rng.uniform(0.9, 1.1, size=6 * 3600))
+        # EEG clock: offset, 40 ppm drift and a slow wobble, sampled at 1 kHz
+        self.true_eeg = lambda t: 12.3 + t * (1 + 40e-6) + 0.002 * np.sin(t / 3000)
+        eeg_onsets = np.round(self.true_eeg(self.tdt_onsets) * 1000) / 1000
+        # bonsai misses a few pulses and gets an extra one
+        eeg_onsets = np.delete(eeg_onsets, [50, 5000, 12000])
+        self.eeg_onsets = np.sort(np.append(eeg_onsets, 4000.5))
+
+    def test_pair_pulses(self):
+        eeg_idx, tdt_idx = pair_pulses(self.eeg_onsets, self.tdt_onsets)
+        self.assertEqual(len(eeg_idx), len(self.tdt_onsets) - 3)
+        np.testing.assert_allclose(self.eeg_onsets[eeg_idx], self.true_eeg(self.tdt_onsets[tdt_idx]), atol=1e-3)
+
+    def test_fit_and_convert(self):
+        time_map = TimeMap.fit(self.eeg_onsets, self.tdt_onsets)
+        self.assertLess(time_map.residual_sec, 2e-3)
+        self.assertAlmostEqual(1 / time_map.slope - 1, 40e-6, delta=2e-6)
+        # any EEG sample maps back onto the TDT clock within a sample
+        tdt_times = np.linspace(100, self.tdt_onsets[-1], 1_000_000)
+        eeg_times = self.true_eeg(tdt_times)
+        np.testing.assert_allclose(time_map.to_tdt(eeg_times), tdt_times, atol=2e-3)
+        np.testing.assert_allclose(time_map.to_eeg(time_map.to_tdt(eeg_times)), eeg_times, atol=1e-9)
+        np.testing.assert_allclose(time_map.samples_to_tdt(np.array([1000 * 100]), 1000), time_map.to_tdt(np.array([100.0])))
+        # extrapolates past the first pulse
+        self.assertAlmostEqual(float(time_map.to_tdt(self.true_eeg(0.0))), 0.0, delta=5e-3)
+
+    def test_params_roundtrip(self):
+        time_map = TimeMap.fit(self.eeg_onsets, self.tdt_onsets)
+        with tempfile.TemporaryDirectory() as tmp:
+            params_file = os.path.join(tmp, "alignment_params.yaml")
+            with open(params_file, "w") as f:
+                yaml.safe_dump({"session.csv.gz": {"time_map": {"value": time_map.to_dict()}},
+                                "old_session.csv.gz": {"eeg_t0_sec": {"value": 1.0}}}, f)
+            loaded = read_time_maps(params_file)
+        self.assertEqual(list(loaded), ["session.csv.gz"])
+        np.testing.assert_array_equal(loaded["session.csv.gz"].tdt_sec, time_map.tdt_sec)
+        self.assertEqual(loaded["session.csv.gz"].n_pairs, time_map.n_pairs)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+from ttl_events import find_edges, extract_ttl_events, load_chunk_events, ttl_events_path, interpolate_timestamps, select_edges, RISING, FALLING
+
+def naive_edges(ttl):
+    # what the alignment scripts used to do: normalize, then np.diff per channel
+    normalized = (ttl != 0).astype(float).T
+    diff = np.diff(normalized, prepend=0, axis=1)
+    return [(np.where(d > 0)[0], np.where(d < 0)[0]) for d in diff]
+
+class TestTTLEvents(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(1)
+        # slow toggling channels with values 1..n like bonsai writes them
+        self.n_channels = 10
+        toggles = rng.random((5000, self.n_channels)) < 0.01
+        state = np.cumsum(toggles, axis=0) % 2
+        self.ttl = (state * np.arange(1, self.n_channels + 1)).astype(np.int8)
+
+    def test_find_edges_matches_diff(self):
+        samples, channels, edges, _ = find_edges(self.ttl, block_samples=777)
+        for channel, (onsets, offsets) in enumerate(naive_edges(self.ttl)):
+            np.testing.assert_array_equal(samples[(channels == channel) & (edges == RISING)], onsets)
+            np.testing.assert_array_equal(samples[(channels == channel) & (edges == FALLING)], offsets)
+        self.assertTrue(np.all(np.diff(samples) >= 0))
+
+    def test_extract_ttl_events_across_files(self):
+        names = [f"ttl{i}" for i in range(self.n_channels)]
+        with tempfile.TemporaryDirectory() as tmp:
+            files = []
+            for idx, part in enumerate(np.array_split(self.ttl, 3)):
+                files.append(os.path.join(tmp, f"part{idx}_ttl_in.bin"))
+                part.tofile(files[-1])
+            events, nsamples = extract_ttl_events(files, names, block_samples=500)
+        self.assertEqual(sum(nsamples), self.ttl.shape[0])
+        for channel, (onsets, offsets) in enumerate(naive_edges(self.ttl)):
+            np.testing.assert_array_equal(select_edges(events, names[channel], RISING), onsets)
+            np.testing.assert_array_equal(select_edges(events, channel, FALLING), offsets)
+
+    def test_cached_tables_match_full_scan(self):
+        names = [f"ttl{i}" for i in range(self.n_channels)]
+        # force channels to be high (and low) across file boundaries
+        self.ttl[1995:2005, :5] = 3
+        self.ttl[1998:2003, 5:] = 0
+        with tempfile.TemporaryDirectory() as tmp:
+            files = []
+            for idx, part in enumerate(np.split(self.ttl, [2000, 3500])):
+                files.append(os.path.join(tmp, f"sub-A_ses-2024010{idx}T000000_ttl_in.bin"))
+                part.tofile(files[-1])
+            expected, expected_nsamples = extract_ttl_events(files, names)
+            cached, nsamples = load_chunk_events(files, names)
+            self.assertTrue(all(os.path.isfile(ttl_events_path(f)) for f in files))
+            # second call reads the tables only
+            cached_again, _ = load_chunk_events(files, names)
+        self.assertEqual(nsamples, expected_nsamples)
+        pd.testing.assert_frame_equal(cached, expected)
+        pd.testing.assert_frame_equal(cached_again, expected)
+
+    def test_interpolate_timestamps(self):
+        timestamps = pd.DataFrame({
+            "ms": [0.0, 250.0, 500.0],
+            "datetime": ["2024-01-01 00:00:00.000", "2024-01-01 00:00:00.250", "2024-01-01 00:00:00.500"]})
+        out = interpolate_timestamps(np.array([0, 3, 251, 510]), timestamps, buffer=250, sf=1000)
+        np.testing.assert_allclose(out["ms"].to_numpy(), [0, 3, 251, 510])
+        self.assertEqual(pd.Timestamp(out["datetime"].iloc[3]), pd.Timestamp("2024-01-01 00:00:00.510"))
+        rounded = interpolate_timestamps(np.array([3, 251]), timestamps, buffer=250, sf=1000, round=True)
+        np.testing.assert_allclose(rounded["ms"].to_numpy(), [0, 250])
+
+if __name__ == '__main__':
+    unittest.main()
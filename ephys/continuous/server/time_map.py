@@ -0,0 +1,187 @@
+import numpy as np
+from scipy.linalg import solveh_banded
+
+
+def pair_pulses(eeg_onsets, tdt_onsets, tolerance_sec=0.25, segment_sec=600):
+    """
+    Pair the pulses received by bonsai with the ones sent by TDT.
+
+    The recording is walked one segment at a time and each TDT pulse is paired with the nearest
+    bonsai pulse, predicted with the offset measured on the previous segment. This keeps the pairing
+    right when the clocks drift for hours, or a few pulses are missing on either side.
+
+    Parameters:
+    - eeg_onsets: Sorted pulse onsets in the EEG clock (seconds).
+    - tdt_onsets: Sorted pulse onsets in the TDT clock (seconds).
+    - tolerance_sec: Maximum distance between a predicted and a received pulse.
+    - segment_sec: Length of the segments (TDT seconds) used to update the offset.
+
+    Returns:
+    - eeg_idx, tdt_idx: Indices of the paired pulses on each array.
+    """
+    eeg_onsets = np.asarray(eeg_onsets, dtype=np.float64)
+    tdt_onsets = np.asarray(tdt_onsets, dtype=np.float64)
+    if len(eeg_onsets) < 2 or len(tdt_onsets) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    segment = ((tdt_onsets - tdt_onsets[0]) // segment_sec).astype(np.int64)
+    bounds = np.flatnonzero(np.diff(segment, prepend=-1, append=segment[-1] + 1))
+    offset = eeg_onsets[0] - tdt_onsets[0]
+    eeg_idx, tdt_idx = [], []
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        predicted = tdt_onsets[start:end] + offset
+        nearest = np.clip(np.searchsorted(eeg_onsets, predicted), 1, len(eeg_onsets) - 1)
+        # pick the closest of the two neighbours
+        left_closer = (predicted - eeg_onsets[nearest - 1]) < (eeg_onsets[nearest] - predicted)
+        nearest = np.where(left_closer, nearest - 1, nearest)
+        residual = eeg_onsets[nearest] - predicted
+        ok = np.abs(residual) <= tolerance_sec
+        if ok.any():
+            offset += np.median(residual[ok])
+        eeg_idx.append(nearest[ok])
+        tdt_idx.append(np.arange(start, end)[ok])
+    eeg_idx = np.concatenate(eeg_idx)
+    tdt_idx = np.concatenate(tdt_idx)
+    # a bonsai pulse can only be used once
+    _, first = np.unique(eeg_idx, return_index=True)
+    return eeg_idx[first], tdt_idx[first]
+
+
+def _linear_spline_fit(x, y, knots):
+    # least squares continuous piecewise-linear fit with fixed knots
+    # each sample only touches its two neighbouring knots, so the normal equations are tridiagonal
+    n_knots = len(knots)
+    seg = np.clip(np.searchsorted(knots, x, side="right") - 1, 0, n_knots - 2)
+    u = (x - knots[seg]) / (knots[seg + 1] - knots[seg])
+    w_left, w_right = 1 - u, u
+    diag = np.bincount(seg, w_left ** 2, minlength=n_knots) + np.bincount(seg + 1, w_right ** 2, minlength=n_knots)
+    off_diag = np.bincount(seg, w_left * w_right, minlength=n_knots - 1)[:n_knots - 1]
+    rhs = np.bincount(seg, w_left * y, minlength=n_knots) + np.bincount(seg + 1, w_right * y, minlength=n_knots)
+    banded = np.zeros((2, n_knots))
+    banded[0, 1:] = off_diag
+    banded[1] = diag
+    return solveh_banded(banded, rhs)
+
+
+def _interp(x, xp, fp):
+    # like np.interp but extrapolates linearly with the first/last segment
+    x = np.asarray(x, dtype=np.float64)
+    idx = np.clip(np.searchsorted(xp, x, side="right") - 1, 0, len(xp) - 2)
+    slope = (fp[idx + 1] - fp[idx]) / (xp[idx + 1] - xp[idx])
+    return fp[idx] + slope * (x - xp[idx])
+
+
+class TimeMap:
+    """
+    Piecewise-linear map between the EEG clock (bonsai) and the TDT clock.
+
+    The map is stored as its breakpoints (knots), so converting any number of times is a
+    vectorized np.searchsorted (O(log n_knots) per time) in either direction.
+
+    Parameters:
+    - eeg_sec: Increasing knot times in the EEG clock (seconds from the first EEG sample).
+    - tdt_sec: Increasing knot times in the TDT clock (seconds from the start of the block).
+    """
+
+    def __init__(self, eeg_sec, tdt_sec):
+        self.eeg_sec = np.asarray(eeg_sec, dtype=np.float64).ravel()
+        self.tdt_sec = np.asarray(tdt_sec, dtype=np.float64).ravel()
+        assert self.eeg_sec.shape == self.tdt_sec.shape, "eeg_sec and tdt_sec must have the same length"
+        assert len(self.eeg_sec) >= 2, "A TimeMap needs at least 2 knots"
+        assert np.all(np.diff(self.eeg_sec) > 0) and np.all(np.diff(self.tdt_sec) > 0), "Knots must be strictly increasing"
+        self.residual_sec = None
+        self.n_pairs = None
+
+    @classmethod
+    def fit(cls, eeg_onsets, tdt_onsets, segment_sec=600, tolerance_sec=0.25, outlier_mad=5):
+        """
+        Fit the map from all the pulses received by bonsai and sent by TDT.
+
+        Pulses are paired with pair_pulses() and a continuous piecewise-linear function with one
+        knot every `segment_sec` is fit by least squares. Pairs further than `outlier_mad` MADs
+        from the first fit (e.g. pulses that arrived late) are dropped before the final fit.
+
+        Parameters:
+        - eeg_onsets: Pulse onsets in the EEG clock (seconds).
+        - tdt_onsets: Pulse onsets in the TDT clock (seconds).
+        - segment_sec: Spacing of the knots in seconds.
+
+        Returns:
+        - A TimeMap, with `residual_sec` (max absolute residual) and `n_pairs` set.
+        """
+        eeg_onsets = np.asarray(eeg_onsets, dtype=np.float64)
+        tdt_onsets = np.asarray(tdt_onsets, dtype=np.float64)
+        eeg_idx, tdt_idx = pair_pulses(eeg_onsets, tdt_onsets, tolerance_sec=tolerance_sec, segment_sec=segment_sec)
+        assert len(eeg_idx) >= 2, "Need at least 2 paired pulses to fit a TimeMap"
+        x, y = eeg_onsets[eeg_idx], tdt_onsets[tdt_idx]
+        n_segments = max(int(np.ceil((x[-1] - x[0]) / segment_sec)), 1)
+        # knots on the paired pulses, so that every segment has data
+        knot_idx = np.unique(np.linspace(0, len(x) - 1, n_segments + 1).round().astype(np.int64))
+        knots = x[knot_idx]
+        values = _linear_spline_fit(x, y, knots)
+        residual = y - _interp(x, knots, values)
+        mad = np.median(np.abs(residual - np.median(residual)))
+        keep = np.abs(residual) <= max(outlier_mad * 1.4826 * mad, 1e-6)
+        if not keep.all():
+            x, y = x[keep], y[keep]
+            values = _linear_spline_fit(x, y, knots)
+        time_map = cls(knots, values)
+        time_map.residual_sec = float(np.abs(y - time_map.to_tdt(x)).max())
+        time_map.n_pairs = int(len(x))
+        return time_map
+
+    def __len__(self):
+        return len(self.eeg_sec)
+
+    def __repr__(self):
+        return f"TimeMap(n_knots={len(self)}, drift_ppm={1e6 * (self.slope - 1):.2f})"
+
+    @property
+    def slope(self):
+        """Average rate of the TDT clock relative to the EEG clock."""
+        return (self.tdt_sec[-1] - self.tdt_sec[0]) / (self.eeg_sec[-1] - self.eeg_sec[0])
+
+    def to_tdt(self, eeg_sec):
+        """Convert EEG times (seconds) to TDT times (seconds). Scalars and arrays work."""
+        return _interp(eeg_sec, self.eeg_sec, self.tdt_sec)
+
+    def to_eeg(self, tdt_sec):
+        """Convert TDT times (seconds) to EEG times (seconds). Scalars and arrays work."""
+        return _interp(tdt_sec, self.tdt_sec, self.eeg_sec)
+
+    def samples_to_tdt(self, samples, sf):
+        """Convert EEG sample indices at `sf` Hz (e.g. down_freq_hz) to TDT times in seconds."""
+        return self.to_tdt(np.asarray(samples, dtype=np.float64) / sf)
+
+    def tdt_to_samples(self, tdt_sec, sf):
+        """Convert TDT times to (fractional) EEG sample indices at `sf` Hz."""
+        return self.to_eeg(tdt_sec) * sf
+
+    def to_dict(self):
+        """Plain lists/floats, ready for yaml.safe_dump in alignment_params.yaml."""
+        return {
+            "eeg_sec": self.eeg_sec.tolist(),
+            "tdt_sec": self.tdt_sec.tolist(),
+            "residual_sec": self.residual_sec,
+            "n_pairs": self.n_pairs,
+        }
+
+    @classmethod
+    def from_dict(cls, values):
+        time_map = cls(values["eeg_sec"], values["tdt_sec"])
+        time_map.residual_sec = values.get("residual_sec")
+        time_map.n_pairs = values.get("n_pairs")
+        return time_map
+
+
+def read_time_maps(params_file):
+    """
+    Read the time maps stored by the alignment in alignment_params.yaml.
+
+    Returns:
+    - A dict of {session_eeg_file: TimeMap}. Sessions aligned before time maps existed are skipped.
+    """
+    import yaml
+    with open(params_file) as f:
+        params = yaml.safe_load(f)
+    return {session: TimeMap.from_dict(session_params["time_map"]["value"])
+            for session, session_params in params.items() if "time_map" in session_params}
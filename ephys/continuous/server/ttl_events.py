@@ -0,0 +1,277 @@
+import os
+import re
+import argparse
+import numpy as np
+import pandas as pd
+from py_console import console
+from bin_archive import open_bin, is_archive, archive_nsamples, bin_sources
+
+# Edge codes used in the event tables
+RISING = 1
+FALLING = -1
+# ~4M samples per block keeps the boolean state of 8 channels around 32 Mb
+DEFAULT_BLOCK_SAMPLES = 2**22
+
+
+def open_ttl_memmap(ttl_file, num_channels, dtype=np.int8):
+    """
+    Memory-map a demultiplexed bonsai TTL file without reading it
+    (a .binz archive is opened as a BinArchive, which reads block by block).
+
+    Returns:
+    - A read-only array of shape (n_samples, num_channels). Trailing bytes that do
+      not make a full sample are ignored, same as read_stack_chunks().
+    """
+    return open_bin(ttl_file, num_channels, dtype)
+
+def _pack_rows(state):
+    # pack the on/off state of every channel into one unsigned integer per sample
+    # so that changes in any channel are found with a single comparison
+    packed = np.packbits(state, axis=1, bitorder='little')
+    n_bytes = packed.shape[1]
+    if n_bytes == 1:
+        return packed[:, 0]
+    width = next(w for w in (2, 4, 8) if w >= n_bytes)
+    padded = np.zeros((packed.shape[0], width), dtype=np.uint8)
+    padded[:, :n_bytes] = packed
+    return padded.view(f'<u{width}').ravel()
+
+def find_edges(ttl, prev_state=None, offset=0, block_samples=DEFAULT_BLOCK_SAMPLES):
+    """
+    Find rising and falling edges of all TTL channels in one pass.
+
+    A channel is considered high whenever its value is not zero, so there is no need
+    to normalize the raw int8 values (1, 2, ..., 8 depending on the channel) first.
+
+    Parameters:
+    - ttl: Array (or memmap) of shape (n_samples, n_channels).
+    - prev_state: Boolean state of each channel right before the first sample.
+      Defaults to all low, which matches np.diff(..., prepend=0).
+    - offset: Value added to the returned sample indices (e.g. samples in previous files).
+    - block_samples: Number of samples processed at a time.
+
+    Returns:
+    - samples, channels, edges: int64, int8 and int8 arrays sorted by sample.
+    - last_state: Boolean state of each channel at the last sample, to chain files.
+    """
+    n_samples, n_channels = ttl.shape
+    if prev_state is None:
+        prev_state = np.zeros(n_channels, dtype=bool)
+    samples, channels, edges = [], [], []
+    for block_start in range(0, n_samples, block_samples):
+        state = np.asarray(ttl[block_start:block_start + block_samples]) != 0
+        packed = _pack_rows(state)
+        before = np.empty_like(packed)
+        before[0] = _pack_rows(prev_state[None, :])[0]
+        before[1:] = packed[:-1]
+        changed = np.flatnonzero(packed != before)
+        if len(changed):
+            state_before = state[changed - 1]
+            state_before[changed == 0] = prev_state
+            state_after = state[changed]
+            rows, chans = np.nonzero(state_after != state_before)
+            samples.append(offset + block_start + changed[rows])
+            channels.append(chans.astype(np.int8))
+            edges.append(np.where(state_after[rows, chans], RISING, FALLING).astype(np.int8))
+        prev_state = state[-1]
+    if not samples:
+        return (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int8),
+                np.empty(0, dtype=np.int8), prev_state)
+    return (np.concatenate(samples).astype(np.int64), np.concatenate(channels),
+            np.concatenate(edges), prev_state)
+
+def extract_ttl_events(ttl_files, ttl_names, dtype=np.int8, block_samples=DEFAULT_BLOCK_SAMPLES):
+    """
+    Build the edge table of a continuous chunk of bonsai TTL files.
+
+    Files are memory-mapped and scanned in blocks, the channel state is carried across
+    files so that a pulse crossing a file boundary is not counted twice.
+
+    Parameters:
+    - ttl_files: List of ttl_in.bin files belonging to one continuous chunk.
+    - ttl_names: config['ttl_names'], one name per channel.
+
+    Returns:
+    - events: DataFrame with columns sample (index within the chunk), channel,
+      channel_name and edge (1 rising, -1 falling).
+    - nsamples: Number of samples in each file (same as read_stack_chunks(return_nsamples=True)).
+    """
+    num_channels = len(ttl_names)
+    samples, channels, edges = [], [], []
+    nsamples = []
+    offset = 0
+    state = None
+    for file_idx, ttl_file in enumerate(ttl_files):
+        console.log(f"Finding TTL edges in {ttl_file} ({file_idx+1}/{len(ttl_files)})")
+        ttl = open_ttl_memmap(ttl_file, num_channels, dtype=dtype)
+        file_samples, file_channels, file_edges, state = find_edges(
+            ttl, prev_state=state, offset=offset, block_samples=block_samples)
+        samples.append(file_samples)
+        channels.append(file_channels)
+        edges.append(file_edges)
+        nsamples.append(ttl.shape[0])
+        offset += ttl.shape[0]
+    events = events_table(np.concatenate(samples or [[]]), np.concatenate(channels or [[]]),
+                          np.concatenate(edges or [[]]), ttl_names)
+    console.info(f"Found {len(events)} TTL edges in {offset} samples")
+    return events, nsamples
+
+def events_table(samples, channels, edges, ttl_names):
+    return pd.DataFrame({
+        "sample": np.asarray(samples, dtype=np.int64),
+        "channel": np.asarray(channels, dtype=np.int8),
+        "channel_name": pd.Categorical.from_codes(np.asarray(channels, dtype=np.int8), categories=list(ttl_names)),
+        "edge": np.asarray(edges, dtype=np.int8),
+    })
+
+def find_ttl_channel(ttl_names, pattern):
+    """
+    Index of the first channel whose name contains `pattern` (e.g. 'photometry').
+    Falls back to the first channel, which is what the alignment scripts have always used.
+    """
+    matches = [idx for idx, name in enumerate(ttl_names) if pattern in name]
+    if not matches:
+        console.warn(f"Pattern `{pattern}` not found in ttl names {ttl_names}. Using channel 0")
+        return 0
+    return matches[0]
+
+def select_edges(events, channel, edge=RISING):
+    """Sample indices of `edge` events on `channel` (index or name)."""
+    if isinstance(channel, str):
+        rows = events["channel_name"] == channel
+    else:
+        rows = events["channel"] == channel
+    return events.loc[rows & (events["edge"] == edge), "sample"].to_numpy()
+
+def interpolate_timestamps(samples, timestamps, buffer, sf, round=False):
+    """
+    Convert sample indices into bonsai timestamps.
+
+    Bonsai writes one timestamp every `buffer` samples. The timestamp of any sample is
+    the one of its buffer plus the remainder times the sampling period, this assumes
+    constant sampling rate between known timestamps.
+
+    Parameters:
+    - samples: Array of sample indices.
+    - timestamps: DataFrame read from the bonsai timestamps file. The first column is
+      in milliseconds and the second one is a datetime.
+    - buffer: Samples per timestamp (sf / 4).
+    - sf: Sampling frequency in Hz.
+    - round: If True, return the timestamp of the buffer (rounded down) instead of interpolating.
+
+    Returns:
+    - A DataFrame with the same columns as `timestamps`, one row per sample.
+    """
+    buffer_idx, remainder = np.divmod(np.asarray(samples, dtype=np.int64), int(buffer))
+    out = timestamps.iloc[buffer_idx].copy()
+    if round:
+        return out
+    sampling_period_ms = 1 / sf * 1000
+    offset_ms = sampling_period_ms * remainder
+    ms_col, dt_col = out.columns[0], out.columns[1]
+    out[ms_col] = out[ms_col].to_numpy() + offset_ms
+    out[dt_col] = pd.to_datetime(out[dt_col]) + pd.to_timedelta(offset_ms, unit='ms')
+    return out
+
+
+#################################################################
+#           Edge table cache next to the ttl_in.bin files       #
+#################################################################
+
+def ttl_events_path(ttl_file):
+    """sub-X_ses-Y_ttl_in.bin (or .binz) -> sub-X_ses-Y_ttl_events.csv.gz (same folder)"""
+    if re.search(r'ttl_in\.binz?$', ttl_file):
+        return re.sub(r'ttl_in\.binz?$', 'ttl_events.csv.gz', ttl_file)
+    return f"{os.path.splitext(ttl_file)[0]}_ttl_events.csv.gz"
+
+def ttl_nsamples(ttl_file, num_channels, dtype=np.int8):
+    # O(1), no need to read the file to know how many samples it has
+    if is_archive(ttl_file):
+        return archive_nsamples(ttl_file)
+    return os.path.getsize(ttl_file) // (np.dtype(dtype).itemsize * num_channels)
+
+def is_cache_fresh(source_file, cache_file):
+    # same rule as make: the cache is good if it was written after the source
+    return os.path.isfile(cache_file) and os.path.getmtime(cache_file) >= os.path.getmtime(source_file)
+
+def write_ttl_events(ttl_file, ttl_names, overwrite=False, dtype=np.int8):
+    """
+    One-time extraction of the edges of a single ttl_in.bin file into a small csv.gz table
+    (sample, channel, channel_name, edge) stored next to it.
+    Samples are indices within the file and the state before the first sample is assumed low.
+
+    Returns:
+    - The path to the edge table.
+    """
+    events_file = ttl_events_path(ttl_file)
+    if not overwrite and is_cache_fresh(ttl_file, events_file):
+        console.log(f"TTL edge table up to date: {events_file}")
+        return events_file
+    ttl = open_ttl_memmap(ttl_file, len(ttl_names), dtype=dtype)
+    samples, channels, edges, _ = find_edges(ttl)
+    events = events_table(samples, channels, edges, ttl_names)
+    events.to_csv(events_file, index=False)
+    console.success(f"Wrote {len(events)} TTL edges from {ttl.shape[0]} samples to {events_file}")
+    return events_file
+
+def read_ttl_events(ttl_file, ttl_names, dtype=np.int8):
+    """
+    Read the edge table of a ttl_in.bin file, extracting it first if missing or stale.
+    """
+    events_file = write_ttl_events(ttl_file, ttl_names, dtype=dtype)
+    events = pd.read_csv(events_file, dtype={"sample": np.int64, "channel": np.int8, "edge": np.int8})
+    return events_table(events["sample"], events["channel"], events["edge"], ttl_names)
+
+def load_chunk_events(ttl_files, ttl_names, dtype=np.int8):
+    """
+    Same output as extract_ttl_events() but built from the per-file edge tables,
+    so the int8 samples are only scanned once (the first time).
+
+    Each table assumes all channels low before its first sample. When a channel is still
+    high at the end of a file, the rising edge at sample 0 of the next file is dropped,
+    or a falling edge is added if the channel went low exactly at the file boundary.
+    """
+    tables = []
+    nsamples = []
+    offset = 0
+    high_at_end = np.zeros(len(ttl_names), dtype=bool)
+    for ttl_file in ttl_files:
+        events = read_ttl_events(ttl_file, ttl_names, dtype=dtype)
+        starts_high = np.zeros(len(ttl_names), dtype=bool)
+        first = events.loc[(events["sample"] == 0) & (events["edge"] == RISING), "channel"].to_numpy()
+        starts_high[first] = True
+        continued = np.flatnonzero(high_at_end & starts_high)
+        ended = np.flatnonzero(high_at_end & ~starts_high)
+        events = events.loc[~((events["sample"] == 0) & events["channel"].isin(continued))]
+        boundary = events_table(np.zeros(len(ended), dtype=np.int64), ended,
+                                np.full(len(ended), FALLING), ttl_names)
+        events = pd.concat([boundary, events], ignore_index=True)
+        events["sample"] += offset
+        tables.append(events)
+        # a channel is high at the end of the file if its last edge is a rising one
+        last_edge = events.groupby("channel", observed=True)["edge"].last()
+        high_at_end = high_at_end.copy()
+        high_at_end[last_edge.index.to_numpy()] = last_edge.to_numpy() == RISING
+        n = ttl_nsamples(ttl_file, len(ttl_names), dtype=dtype)
+        nsamples.append(n)
+        offset += n
+    if not tables:
+        return events_table([], [], [], ttl_names), nsamples
+    events = pd.concat(tables, ignore_index=True).sort_values(["sample", "channel"], kind="stable", ignore_index=True)
+    events["channel_name"] = pd.Categorical(events["channel_name"], categories=list(ttl_names))
+    return events, nsamples
+
+
+if __name__ == '__main__':
+    from utils import read_config
+    from rlist_files import list_files
+    parser = argparse.ArgumentParser(description='Extract the TTL edge table of every ttl_in.bin file under a folder (one-time step)')
+    parser.add_argument('--ttl_folder', required=True, help='Folder to search (recursively) for ttl_in.bin files')
+    parser.add_argument('--config_folder', required=True, help='Path to the config folder (needs ttl_names)')
+    parser.add_argument('--overwrite', action='store_true', help='Extract again even if the edge table is up to date')
+    args = parser.parse_args()
+    config = read_config(args.config_folder)
+    ttl_files = bin_sources(list_files(args.ttl_folder, pattern="ttl_in.bin", recursive=True, full_names=True))
+    console.info(f"Found {len(ttl_files)} ttl_in.bin files in {args.ttl_folder}")
+    for ttl_file in ttl_files:
+        write_ttl_events(ttl_file, config['ttl_names'], overwrite=args.overwrite)
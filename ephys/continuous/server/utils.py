@@ -12,6 +12,11 @@ import re
 import mne
 import pytz
 import pathlib
+from ttl_events import find_edges, interpolate_timestamps, RISING
+from camera_frames import read_demux, write_camera_index
+from bin_archive import is_archive, open_bin, archive_nsamples, bin_sources
+from intervals import IntervalSet
+from session_catalog import find_files
 
 def get_last_modif_utc(file_path):
     fname = pathlib.Path(file_path)
@@ -56,8 +61,12 @@ def read_yaml(filename):
   return cfg
 
 # check for config available
-def read_config(config_folder):
-  config_file = list_files(path = config_folder, pattern="config.yaml", full_names=True)
+def read_config(config_folder, catalog=None):
+  if catalog is not None:
+    # query the session catalog instead of listing the folder
+    config_file = find_files(catalog, kind="config", folder=config_folder)
+  else:
+    config_file = list_files(path = config_folder, pattern="config.yaml", full_names=True)
   if not config_file:
     console.error(f"config.yaml not found in {config_folder}", severe=True)
     sys.exit()
@@ -121,7 +130,45 @@ def chunk_file_list(file_list, expected_delta_min, discontinuity_tolerance):
     return chunks
 
 
-def read_stack_chunks(file_chunk, num_channels, dtype=np.float32, return_nsamples = False):
+def bin_nsamples(file, num_channels, dtype=np.float32):
+  # samples per channel of a demultiplexed .bin file, from its size alone (no reading)
+  # .binz archives (bin_archive.py) have it in their index
+  if is_archive(file):
+    return archive_nsamples(file)
+  return os.path.getsize(file) // (np.dtype(dtype).itemsize * num_channels)
+
+def _read_window(file_chunk, num_channels, dtype, camera_channels, window):
+  # only the samples [start, stop) of the stacked chunk, files outside the window are not opened
+  start, stop = window
+  combined_data, nsamples = [], []
+  offset = 0
+  for file in file_chunk:
+    n = bin_nsamples(file, num_channels + camera_channels, dtype)
+    first, last = max(start - offset, 0), min(stop - offset, n)
+    if first < last:
+      console.log(f"Read samples {first}:{last} from file {file}")
+      data = open_bin(file, num_channels + camera_channels, dtype)[first:last]
+      # camera counters are dropped, their index is only written when the whole file is read
+      combined_data.append(np.asarray(data)[:, :num_channels].T)
+    nsamples.append(max(last - first, 0))
+    offset += n
+  combined_data = np.hstack(combined_data) if combined_data else np.empty((num_channels, 0), dtype=dtype)
+  return combined_data, nsamples
+
+def read_stack_chunks(file_chunk, num_channels, dtype=np.float32, return_nsamples = False, camera_channels = 0, window = None):
+  """
+  Read and stack horizontally the .bin (or .binz archive) files of a continuous chunk.
+
+  Parameters:
+  - window: Optional (start, stop) sample range of the stacked chunk, only that part of the files is read.
+    nsamples then has the samples read from each file.
+
+  Returns:
+  - Array of shape (num_channels, n_samples) (and nsamples, the samples of each file, if return_nsamples).
+  """
+  if window is not None:
+    combined_data, nsamples = _read_window(file_chunk, num_channels, dtype, camera_channels, window)
+    return (combined_data, nsamples) if return_nsamples else combined_data
   num_files = len(file_chunk)
   combined_data = [None] * num_files
   # we need to store the number of nsamples for alignment purposes
@@ -129,8 +176,15 @@ def read_stack_chunks(file_chunk, num_channels, dtype=np.float32, return_nsample
   for file_idx, file in enumerate(file_chunk):
     
     console.log(f"Read data from file {file} ({file_idx+1}/{num_files})")
+    if camera_channels:
+      # split camera frame counters while reading, only their run-length index is saved
+      eeg_array, frame_index = read_demux(file, num_channels, camera_channels, dtype=dtype)
+      write_camera_index(file, frame_index)
+      nsamples.append(eeg_array.shape[1])
+      combined_data[file_idx] = eeg_array
+      continue
     # data is stored as np.float32
-    eeg_array = np.fromfile(file, dtype=dtype)
+    eeg_array = open_bin(file, num_channels, dtype).read().ravel() if is_archive(file) else np.fromfile(file, dtype=dtype)
     # first integer division, then blowup.
     n_samples_all_channels = eeg_array.shape[0] // num_channels
     nsamples.append(n_samples_all_channels)
@@ -138,17 +192,6 @@ def read_stack_chunks(file_chunk, num_channels, dtype=np.float32, return_nsample
     # subset and reshape
     eeg_array = eeg_array.reshape(n_samples_all_channels, num_channels).T
 
-    # remove camera stamp if present
-    #if has_camera:
-    #  cam_index = np.where(['cam' in value for value in list(channel_map.values())])
-    #  cam_array = eeg_array[cam_index[0], :]
-    #  eeg_array = np.delete(eeg_array, cam_index, axis=0)
-    #  # save camera
-    #  suffix = f"_camframes.npy"
-    #  outfile = os.path.join(ephys_folder, f"{Path(eeg_file).stem}{suffix}")
-    #  console.success(f"Saving camera frames as {outfile}")
-    #  np.save(outfile, cam_array)
-
     #if file_idx == 0:
         # For the first file, initialize combined_data with the shape of eeg_array
         # concat enforces same dimensions in all arrays
@@ -270,34 +313,32 @@ def find_pulse_onset(ttl_file, ttl_idx, timestamps_file, buffer, round=False):
   This function reads the ttl pulse file
   Subsets the ttl_file array on ttl_idx
   buffer is sf / 4
-  Finds pulse onset by calling np diff and looking for the moments where np.diff is positive
+  Finds pulse onset as the rising edges of the channel (see ttl_events.find_edges)
   There's two ways to call this. You can either return the rounded down timestamp (round=True) 
   # or interpolate from the closest timestamp assuming constant sampling rate.
   Rerturns the timestamps according to sampling frequency (sf)
   """
   sf = 4 * buffer
-  ttl_events = np.load(ttl_file)
+  # memory map so we only touch the channel we need
+  ttl_events = np.load(ttl_file, mmap_mode='r')
   # todo find in config
-  photo_events = ttl_events[ttl_idx, :].flatten()
-  pulse_onset = np.where(np.diff(photo_events, prepend=0) > 0)[0]
-  # get division and remainder
-  div_array = np.array([divmod(i, buffer) for i in pulse_onset])
-  # TODO div_array[:, 0] has the rounded version
-  # timestamps.iloc[div_array[:, 0], :] + sampling_period * div_array[:, 1] is the way to calculate the proper timestamp
-  # this assumes constant sampling rate between known timestamps
+  photo_events = ttl_events[ttl_idx, :].reshape(-1, 1)
+  samples, _, edges, _ = find_edges(photo_events)
+  pulse_onset = samples[edges == RISING]
   timestamps = pd.read_csv(timestamps_file)
   # TODO: not sure this works for all sf 
-  sampling_period_ms = 1/sf * 1000
-  out = timestamps.iloc[div_array[:,0], :].copy()
-  if round:
-    return out
-  else:
-    out.iloc[:, 0] = out.iloc[:, 0] + sampling_period_ms * div_array[:, 1]
-    dt = (sampling_period_ms * div_array[:, 1]).astype('timedelta64[ms]')
-    out.iloc[:, 1] = pd.to_datetime(out.iloc[:,1]) + dt
-    return out
+  return interpolate_timestamps(pulse_onset, timestamps, buffer, sf, round=round)
 
 
+def fix_tdt_names(string, append): 
+  # if the epocs have less than 3 letters, they would be stored as
+  # "PC0/" but can only be accessed using "PC0_" on the dict
+  # this little helper gives a hand to avoid errors if they happened to occur
+  if len(string) < 4:
+    return f"{string}{append}"
+  else:
+    return string
+
 def ui_find_file(title=None, initialdir=None, file_type=None):
     """
     Find a file using a GUI.
@@ -343,44 +384,132 @@ def ui_find_file(title=None, initialdir=None, file_type=None):
 
     return result
 
+def kept_sample_ranges(n_samples, exclude_windows):
+  """
+  Complement of the excluded sample windows.
+
+  Parameters:
+  - n_samples: Number of samples (frames of all channels) in the file.
+  - exclude_windows: List of (start_sample, end_sample) to remove, end is exclusive. They can overlap.
+
+  Returns:
+  - An IntervalSet with the samples to keep.
+  """
+  excluded = IntervalSet(*zip(*exclude_windows)) if exclude_windows else IntervalSet()
+  excluded = excluded & IntervalSet([0], [n_samples])
+  starts = np.concatenate([[0], excluded.ends])
+  ends = np.concatenate([excluded.starts, [n_samples]])
+  return IntervalSet(starts, ends)
+
+def copy_byte_ranges(src_file, dst_file, byte_ranges, buffer_bytes=64 * 2**20):
+  """
+  Copy [start, end) byte ranges of src_file back to back into dst_file.
+  Uses os.copy_file_range (kernel side copy, no data through python) and falls back
+  to buffered reads/writes where it is not available (e.g. across some network mounts).
+
+  Returns:
+  - Number of bytes written.
+  """
+  written = 0
+  use_copy_file_range = hasattr(os, 'copy_file_range')
+  # unbuffered destination, both paths write at the file descriptor position
+  with open(src_file, 'rb') as src, open(dst_file, 'wb', buffering=0) as dst:
+    for start, end in byte_ranges:
+      offset = start
+      while offset < end:
+        count = min(buffer_bytes, end - offset)
+        n = None
+        if use_copy_file_range:
+          try:
+            n = os.copy_file_range(src.fileno(), dst.fileno(), count, offset)
+          except OSError:
+            use_copy_file_range = False
+        if n is None:
+          src.seek(offset)
+          n = dst.write(src.read(count))
+        if n == 0:
+          raise IOError(f"Unexpected end of {src_file} at byte {offset}")
+        offset += n
+        written += n
+  return written
+
+def exclude_windows_bin(file, sf, num_channels, output_file, exclude_windows_sec, dtype=np.float32):
+  """
+  Writes a copy of a columnMajor .bin file without the given time windows, in one streaming pass.
+  Windows are converted to whole multichannel frames so channels never get shifted.
+
+  Parameters:
+  - file: Path to the input .bin file.
+  - output_file: Path where the output .bin file will be saved.
+  - sf: Sampling frequency (samples per second).
+  - num_channels: Number of channels in the file.
+  - exclude_windows_sec: List of (start, end) in seconds, end can be None (until the end of the file).
+  - dtype: Data type of the data. Default is np.float32.
+
+  Returns:
+  - Number of samples kept.
+  """
+  n_samples = bin_nsamples(file, num_channels, dtype)
+  windows = [(int(start * sf), n_samples if end is None else int(end * sf)) for start, end in exclude_windows_sec]
+  return _write_kept_samples(file, num_channels, output_file, windows, dtype)
+
+def _write_kept_samples(file, num_channels, output_file, exclude_windows, dtype):
+  # exclude_windows in samples, the copy is done in whole frames of all channels
+  frame_bytes = np.dtype(dtype).itemsize * num_channels
+  n_samples = bin_nsamples(file, num_channels, dtype)
+  kept = kept_sample_ranges(n_samples, exclude_windows)
+  if is_archive(file):
+    # compressed bytes do not map to frames, decode the kept samples block by block into a raw .bin
+    archive = open_bin(file, num_channels, dtype)
+    with open(output_file, 'wb') as f:
+      for start, end in kept:
+        for block_start in range(start, end, archive.block_samples):
+          f.write(archive.read(block_start, min(block_start + archive.block_samples, end)).tobytes())
+  else:
+    copy_byte_ranges(file, output_file, [(start * frame_bytes, end * frame_bytes) for start, end in kept])
+  console.success(f"Wrote {kept.total_length}/{n_samples} samples of {file} to {output_file}")
+  return kept.total_length
+
+def exclude_windows_bins(jobs, sf, num_channels, dtype=np.float32, n_workers=4):
+  """
+  Run exclude_windows_bin() on many files. `jobs` is a list of (file, output_file, exclude_windows_sec).
+  Copies are I/O bound and os.copy_file_range releases the GIL, so files are processed in threads.
+
+  Returns:
+  - A dict of {output_file: samples kept}.
+  """
+  from concurrent.futures import ThreadPoolExecutor
+  with ThreadPoolExecutor(max_workers=n_workers) as executor:
+    futures = {output_file: executor.submit(exclude_windows_bin, file, sf, num_channels, output_file, windows, dtype)
+               for file, output_file, windows in jobs}
+    return {output_file: future.result() for output_file, future in futures.items()}
+
 def exclude_and_write_bin(file, sf, num_channels, output_file, exclude_start_time=0, exclude_end_time=None, dtype=np.float32):
-    """
-    Reads EEG data from a columnMajor .bin file, excludes a specified time range, and writes the modified data back to a new .bin file.
-    
-    Parameters:
-    - file: Path to the input .bin file.
-    - output_file: Path where the output .bin file will be saved.
-    - num_channels: Number of EEG channels.
-    - exclude_start_time: Start time (in seconds) to exclude.
-    - exclude_end_time: End time (in seconds) to exclude.
-    - sf: Sampling frequency (samples per second).
-    - dtype: Data type of the EEG data. Default is np.float32.
-    """
-    
-    # Read the entire dataset from file
-    eeg_array = np.fromfile(file, dtype=dtype)
-    n_samples_all_channels = eeg_array.shape[0] // num_channels
-    
-    # Convert times to sample indices
-    exclude_start = int(exclude_start_time * sf)
-    if exclude_end_time is None:
-      exclude_end = n_samples_all_channels
-    else:
-      exclude_end = int(exclude_end_time * sf)
-    
-    # Ensure exclude_end does not exceed the dataset
-    if exclude_end > n_samples_all_channels:
-        exclude_end = n_samples_all_channels
+  """
+  Reads EEG data from a columnMajor .bin file, excludes a specified time range, and writes the modified data back to a new .bin file.
+  Data is streamed from file to file (see exclude_windows_bin), nothing is loaded in memory.
+  
+  Parameters:
+  - file: Path to the input .bin file.
+  - output_file: Path where the output .bin file will be saved.
+  - num_channels: Number of EEG channels.
+  - exclude_start_time: Start time (in seconds) to exclude.
+  - exclude_end_time: End time (in seconds) to exclude.
+  - sf: Sampling frequency (samples per second).
+  - dtype: Data type of the EEG data. Default is np.float32.
+  """
+  n_samples_all_channels = bin_nsamples(file, num_channels, dtype)
+  # Convert times to sample indices
+  exclude_start = int(exclude_start_time * sf)
+  if exclude_end_time is None:
+    exclude_end = n_samples_all_channels
+  else:
+    exclude_end = int(exclude_end_time * sf)
+  # Ensure exclude_end does not exceed the dataset
+  exclude_end = min(exclude_end, n_samples_all_channels)
 
-    # Check that exclude_start and exclude_end are within valid bounds
-    if not 0 < exclude_start < exclude_end <= n_samples_all_channels:
-        raise ValueError("Invalid exclusion range based on the provided times and sampling frequency.")
+  # Check that exclude_start and exclude_end are within valid bounds
+  if not 0 < exclude_start < exclude_end <= n_samples_all_channels:
+    raise ValueError("Invalid exclusion range based on the provided times and sampling frequency.")
 
-    # Perform the exclusion and concatenation
-    global_exclude_start = exclude_start * num_channels
-    global_exclude_end = exclude_end * num_channels
-    
-    modified_eeg_array = np.concatenate((eeg_array[:global_exclude_start], eeg_array[global_exclude_end:]))
-    
-    # Write the modified array to a new .bin file, ensuring ColumnMajor format if needed
-    modified_eeg_array.tofile(output_file)
+  _write_kept_samples(file, num_channels, output_file, [(exclude_start, exclude_end)], dtype)